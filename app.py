@@ -1,4 +1,4 @@
-from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, jsonify, flash, abort, send_file, make_response
+from flask import Flask, render_template, request, redirect, url_for, session, send_from_directory, jsonify, flash, abort, make_response, Response, stream_with_context, has_request_context, g
 import subprocess
 import os
 import io
@@ -16,6 +16,39 @@ from flask_wtf.csrf import CSRFProtect
 from dotenv import load_dotenv
 import time
 import platform
+import threading
+import hashlib
+import json
+import uuid
+import fcntl
+from contextlib import contextmanager, ExitStack
+from collections import OrderedDict, deque
+import selectors
+import glob
+import re
+import stat
+import base64
+import tempfile
+import ipaddress
+import socket
+import zipfile
+import tarfile
+import cProfile
+import hmac
+import shutil
+import ctypes
+import errno
+import multiprocessing
+import bisect
+import calendar
+import queue
+import sqlite3
+import atexit
+from sqlalchemy import event, insert, inspect as sa_inspect
+from sqlalchemy.engine import Engine
+from sqlalchemy.dialects import sqlite as sqlite_dialect, postgresql as postgresql_dialect, mysql as mysql_dialect
+from concurrent.futures import ThreadPoolExecutor, ProcessPoolExecutor, as_completed
+from profile_render import ProfileRenderer, atomic_write, render_profile_batch
 
 load_dotenv() 
 
@@ -45,12 +78,87 @@ CONFIG_PATHS = {
 
 MIN_CERT_EXPIRE = 1
 MAX_CERT_EXPIRE = 365
+# Срок, который client.sh подставляет, если он не указан
+DEFAULT_CERT_EXPIRE = 3650
+
+CLIENT_SCRIPT = './client.sh'
+DOALL_SCRIPT = '/root/antizapret/doall.sh'
+
+# Ресурсы, которые изменяет каждая опция client.sh (для блокировок задач)
+CLIENT_OPTION_RESOURCES = {
+    '1': ('openvpn',), '2': ('openvpn',), '3': ('openvpn',),
+    '4': ('wireguard',), '5': ('wireguard',), '6': ('wireguard',),
+    '7': ('openvpn', 'wireguard'), '8': ('openvpn', 'wireguard')
+}
+# Действия client.sh для журнала (просмотр списков не журналируется)
+CLIENT_OPTION_ACTIONS = {
+    '1': 'client.add', '2': 'client.delete', '4': 'client.add', '5': 'client.delete',
+    '7': 'clients.recreate', '8': 'clients.backup'
+}
+
+WIREGUARD_INTERFACES = ('antizapret', 'vpn')
+OPENVPN_STATUS_GLOB = os.getenv('OPENVPN_STATUS_GLOB', '/etc/openvpn/server/logs/*-status.log')
+STATS_INTERVAL = int(os.getenv('STATS_INTERVAL', '60'))
+
+WIREGUARD_DIR = '/etc/wireguard'
+EASYRSA_DIR = '/etc/openvpn/easyrsa3'
+EASYRSA_BIN = '/usr/share/easy-rsa/easyrsa'
+OPENVPN_SERVER_KEYS_DIR = '/etc/openvpn/server/keys'
+OPENVPN_CLIENT_KEYS_DIR = '/etc/openvpn/client/keys'
+CLIENT_PROFILES_DIR = '/root/antizapret/client'
+# Опции 4/5/6 client.sh выполняются на Python (WireGuardPeerManager)
+USE_NATIVE_WIREGUARD = os.getenv('USE_NATIVE_WIREGUARD', 'true').lower() == 'true'
+# Опция 1 client.sh рендерит профили на Python (OpenVPNClientManager)
+USE_NATIVE_OPENVPN = os.getenv('USE_NATIVE_OPENVPN', 'true').lower() == 'true'
+
+JOB_WORKERS = int(os.getenv('JOB_WORKERS', '2'))
+# Сохранения списков в течение этого времени объединяются в один запуск doall.sh
+DOALL_DEBOUNCE = float(os.getenv('DOALL_DEBOUNCE', '3'))
+BULK_MAX_CLIENTS = int(os.getenv('BULK_MAX_CLIENTS', '1000'))
+# Токен для сбора /metrics без сессии (Authorization: Bearer ...)
+METRICS_TOKEN = os.getenv('METRICS_TOKEN', '')
+# Сколько последних файлов профилирования хранить в instance/profiles
+PROFILE_KEEP = int(os.getenv('PROFILE_KEEP', '50'))
+# Число клиентов на странице таблиц главной
+CLIENTS_PAGE_SIZE = int(os.getenv('CLIENTS_PAGE_SIZE', '100'))
+# Нормализация списков хостов и IP при сохранении
+NORMALIZE_LISTS = os.getenv('NORMALIZE_LISTS', 'true').lower() == 'true'
+# Списки хостов больше этого размера не встраиваются в форму редактора целиком
+EDITOR_INLINE_LIMIT = int(os.getenv('EDITOR_INLINE_LIMIT', str(256 * 1024)))
+# Сертификаты, истекающие в пределах этого числа дней, выделяются на странице сертификатов
+CERT_EXPIRING_DAYS = int(os.getenv('CERT_EXPIRING_DAYS', '30'))
+# Хранилище инкрементальных снимков PKI и WireGuard и число хранимых снимков
+BACKUP_DIR = os.getenv('BACKUP_DIR', '/root/antizapret/backups')
+BACKUP_KEEP = int(os.getenv('BACKUP_KEEP', '30'))
+RECREATE_WORKERS = int(os.getenv('RECREATE_WORKERS', str(os.cpu_count() or 1)))
+# Сколько последних строк вывода скрипта хранится в памяти и в БД
+JOB_OUTPUT_LINES = int(os.getenv('JOB_OUTPUT_LINES', '2000'))
 
 # Настройка БД
-app.config['SQLALCHEMY_DATABASE_URI'] = 'sqlite:///users.db'
+DATABASE_URL = os.getenv('DATABASE_URL', 'sqlite:///users.db')
+app.config['SQLALCHEMY_DATABASE_URI'] = DATABASE_URL
 app.config['SQLALCHEMY_TRACK_MODIFICATIONS'] = False
+app.config['SQLALCHEMY_ENGINE_OPTIONS'] = {
+    'pool_size': int(os.getenv('DB_POOL_SIZE', '5')),
+    'max_overflow': int(os.getenv('DB_MAX_OVERFLOW', '10'))
+}
+if DATABASE_URL.startswith('sqlite'):
+    # Соединения используются потоками задач и сборщиков, а не только потоком запроса
+    app.config['SQLALCHEMY_ENGINE_OPTIONS']['connect_args'] = {'timeout': 30, 'check_same_thread': False}
 db = SQLAlchemy(app)
 
+@event.listens_for(Engine, 'connect')
+def configure_sqlite_connection(dbapi_connection, connection_record):
+    """WAL: читатели не ждут писателей; NORMAL в WAL не теряет целостность при сбое"""
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
+    cursor = dbapi_connection.cursor()
+    cursor.execute('PRAGMA journal_mode=WAL')
+    cursor.execute('PRAGMA synchronous=NORMAL')
+    cursor.execute(f"PRAGMA busy_timeout={int(os.getenv('DB_BUSY_TIMEOUT', '5000'))}")
+    cursor.execute('PRAGMA temp_store=MEMORY')
+    cursor.close()
+
 # Модель пользователя для работы с БД
 class User(db.Model):
     id = db.Column(db.Integer, primary_key=True)
@@ -63,254 +171,3773 @@ class User(db.Model):
     def check_password(self, password):
         return check_password_hash(self.password_hash, password)
 
-class ScriptExecutor:
-    def __init__(self):
-        self.min_cert_expire = MIN_CERT_EXPIRE
-        self.max_cert_expire = MAX_CERT_EXPIRE
+# Модель фоновой задачи (client.sh, doall.sh)
+class Job(db.Model):
+    id = db.Column(db.String(32), primary_key=True)
+    kind = db.Column(db.String(32), nullable=False)
+    params = db.Column(db.Text, nullable=False, default='{}')
+    status = db.Column(db.String(16), nullable=False, default='queued', index=True)
+    message = db.Column(db.Text)
+    stdout = db.Column(db.Text, nullable=False, default='')
+    # Число строк stdout, вытесненных из сохранённого хвоста (номер первой строки в stdout)
+    stdout_offset = db.Column(db.Integer, nullable=False, default=0)
+    stderr = db.Column(db.Text, nullable=False, default='')
+    exit_code = db.Column(db.Integer)
+    username = db.Column(db.String(80))
+    pid = db.Column(db.Integer)
+    created_at = db.Column(db.Float, nullable=False, index=True)
+    started_at = db.Column(db.Float)
+    finished_at = db.Column(db.Float)
+    result = db.Column(db.Text)
+    # Задача не начнётся раньше этого времени (отложенный запуск doall.sh)
+    scheduled_at = db.Column(db.Float)
+
+    def to_dict(self, with_output=True):
+        data = {
+            'id': self.id,
+            'kind': self.kind,
+            'params': json.loads(self.params or '{}'),
+            'status': self.status,
+            'finished': self.status in ('succeeded', 'failed'),
+            'success': self.status == 'succeeded',
+            'message': self.message,
+            'exit_code': self.exit_code,
+            'username': self.username,
+            'created_at': self.created_at,
+            'started_at': self.started_at,
+            'finished_at': self.finished_at,
+            'scheduled_at': self.scheduled_at,
+            'result': json.loads(self.result) if self.result else None
+        }
+        if with_output:
+            data['output'] = self.stdout
+            data['stderr'] = self.stderr
+        return data
+
+# Журнал действий администраторов
+class AuditLog(db.Model):
+    id = db.Column(db.Integer, primary_key=True)
+    timestamp = db.Column(db.Float, nullable=False, index=True)
+    username = db.Column(db.String(80), index=True)
+    remote_addr = db.Column(db.String(64))
+    action = db.Column(db.String(32), nullable=False, index=True)
+    target = db.Column(db.String(255))
+    details = db.Column(db.Text)
+
+    def to_dict(self):
+        return {
+            'id': self.id,
+            'timestamp': self.timestamp,
+            'username': self.username,
+            'remote_addr': self.remote_addr,
+            'action': self.action,
+            'target': self.target,
+            'details': json.loads(self.details) if self.details else None
+        }
+
+# Счётчики трафика клиентов: сырые точки и агрегаты по минутам и часам
+class TrafficSample(db.Model):
+    __table_args__ = (db.UniqueConstraint('resolution', 'bucket', 'client', 'protocol', 'interface'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    resolution = db.Column(db.String(8), nullable=False)
+    bucket = db.Column(db.Integer, nullable=False, index=True)
+    client = db.Column(db.String(64), nullable=False, index=True)
+    protocol = db.Column(db.String(16), nullable=False)
+    interface = db.Column(db.String(64), nullable=False)
+    rx = db.Column(db.BigInteger, nullable=False, default=0)
+    tx = db.Column(db.BigInteger, nullable=False, default=0)
+
+def upsert(model, values, index_elements, set_):
+    """INSERT с обновлением при конфликте уникального ключа для диалекта текущей БД"""
+    dialect = db.engine.dialect.name
+    if dialect == 'sqlite':
+        return sqlite_dialect.insert(model).values(**values).on_conflict_do_update(index_elements=index_elements, set_=set_)
+    if dialect == 'postgresql':
+        return postgresql_dialect.insert(model).values(**values).on_conflict_do_update(index_elements=index_elements, set_=set_)
+    if dialect in ('mysql', 'mariadb'):
+        return mysql_dialect.insert(model).values(**values).on_duplicate_key_update(**set_)
+    raise RuntimeError(f"Upsert не поддерживается для СУБД {dialect}")
+
+# Последнее известное состояние подключения клиента
+class ClientSession(db.Model):
+    __table_args__ = (db.UniqueConstraint('client', 'protocol', 'interface'),)
+
+    id = db.Column(db.Integer, primary_key=True)
+    client = db.Column(db.String(64), nullable=False, index=True)
+    protocol = db.Column(db.String(16), nullable=False)
+    interface = db.Column(db.String(64), nullable=False)
+    endpoint = db.Column(db.String(64))
+    session_id = db.Column(db.String(64))
+    last_handshake = db.Column(db.Integer)
+    rx_counter = db.Column(db.BigInteger, nullable=False, default=0)
+    tx_counter = db.Column(db.BigInteger, nullable=False, default=0)
+    rx_total = db.Column(db.BigInteger, nullable=False, default=0)
+    tx_total = db.Column(db.BigInteger, nullable=False, default=0)
+    updated_at = db.Column(db.Integer, nullable=False)
+
+class ScriptExecutor:
+    def __init__(self, wireguard_manager=None, openvpn_manager=None, recreator=None):
+        self.min_cert_expire = MIN_CERT_EXPIRE
+        self.max_cert_expire = MAX_CERT_EXPIRE
+        self.wireguard_manager = wireguard_manager
+        self.openvpn_manager = openvpn_manager
+        self.recreator = recreator
+
+    def build_command(self, option, client_name, cert_expire=None):
+        if not option.isdigit():
+            raise ValueError("Некорректный параметр option")
+
+        safe_client_name = shlex.quote(client_name)
+        command = [CLIENT_SCRIPT, option, safe_client_name]
+
+        if cert_expire:
+            if not cert_expire.isdigit() or not (self.min_cert_expire <= int(cert_expire) <= self.max_cert_expire):
+                raise ValueError("Некорректный срок действия сертификата")
+            command.append(cert_expire)
+        return command
+
+    def run_command(self, command, on_line=None, cwd=None, env=None):
+        """Запускает команду и читает stdout/stderr построчно.
+
+        Каждая строка передаётся в on_line(stream, line) по мере появления, а в памяти
+        остаётся только последние JOB_OUTPUT_LINES строк каждого потока.
+        """
+        process = subprocess.Popen(command, stdout=subprocess.PIPE, stderr=subprocess.PIPE, shell=False, cwd=cwd,
+                                   env=dict(os.environ, **env) if env else None)
+        tails = {'stdout': deque(maxlen=JOB_OUTPUT_LINES), 'stderr': deque(maxlen=JOB_OUTPUT_LINES)}
+        partial = {'stdout': b'', 'stderr': b''}
+
+        def emit(stream, raw_line):
+            line = raw_line.decode('utf-8', errors='replace').rstrip('\r\n')
+            tails[stream].append(line)
+            if on_line is not None:
+                on_line(stream, line)
+
+        with selectors.DefaultSelector() as selector:
+            selector.register(process.stdout, selectors.EVENT_READ, 'stdout')
+            selector.register(process.stderr, selectors.EVENT_READ, 'stderr')
+            while selector.get_map():
+                for key, _ in selector.select():
+                    stream = key.data
+                    chunk = os.read(key.fd, 65536)
+                    if not chunk:
+                        selector.unregister(key.fileobj)
+                        if partial[stream]:
+                            emit(stream, partial[stream])
+                            partial[stream] = b''
+                        continue
+                    *lines, partial[stream] = (partial[stream] + chunk).split(b'\n')
+                    for raw_line in lines:
+                        emit(stream, raw_line)
+
+        returncode = process.wait()
+        stdout = '\n'.join(tails['stdout']) + ('\n' if tails['stdout'] else '')
+        stderr = '\n'.join(tails['stderr']) + ('\n' if tails['stderr'] else '')
+        if returncode != 0:
+            raise subprocess.CalledProcessError(returncode, command, output=stdout, stderr=stderr)
+        return stdout, stderr
+
+    def run_bash_script(self, option, client_name, cert_expire=None, on_line=None):
+        command = self.build_command(option, client_name, cert_expire)
+        status = 'error'
+        started = time.perf_counter()
+        try:
+            result = self._run_option(option, client_name, cert_expire, command, on_line)
+            status = 'ok'
+            return result
+        finally:
+            metrics.observe('subprocess_duration_seconds', time.perf_counter() - started,
+                            script='client.sh', option=option, status=status)
+
+    def _run_option(self, option, client_name, cert_expire, command, on_line):
+        if option in ('4', '5', '6') and self.wireguard_manager is not None and self.wireguard_manager.available():
+            return self.wireguard_manager.run_option(option, client_name, on_line)
+        if option == '1' and self.openvpn_manager is not None and self.openvpn_manager.available():
+            return self.openvpn_manager.run_option(option, client_name, cert_expire, on_line)
+        if option == '7' and self.recreator is not None and self.recreator.available():
+            return self.recreator.run_option(option, client_name, on_line)
+        return self.run_command(command, on_line)
+
+    def run_doall(self, on_line=None):
+        status = 'error'
+        started = time.perf_counter()
+        try:
+            result = self.run_command([DOALL_SCRIPT], on_line)
+            status = 'ok'
+            return result
+        finally:
+            metrics.observe('subprocess_duration_seconds', time.perf_counter() - started,
+                            script='doall.sh', option='', status=status)
+
+class ConfigFileHandler:
+    FILE_TYPES = ('openvpn', 'wg', 'amneziawg')
+
+    def __init__(self, config_paths, history_size=32):
+        self.config_paths = config_paths
+        # Индекс конфигураций: строится один раз и перестраивается только
+        # при изменении mtime одного из отслеживаемых каталогов
+        self._lock = threading.Lock()
+        self._index = None
+        self._dir_mtimes = {}
+        self._clients = {}
+        self._version = None
+        self._sorted = {}
+        # Предыдущие версии списка клиентов для ответов в режиме дельты
+        self._history = OrderedDict()
+        self._history_size = history_size
+        self.hits = 0
+        self.misses = 0
+
+    def _collect_files(self, paths, extension, dir_mtimes):
+        collected = []
+        for directory in paths:
+            dir_mtimes[directory] = self._get_mtime(directory)
+            if os.path.exists(directory):
+                for root, _, files in os.walk(directory):
+                    dir_mtimes[root] = self._get_mtime(root)
+                    collected.extend(os.path.join(root, f) for f in files if f.endswith(extension))
+        return collected
+
+    @staticmethod
+    def _get_mtime(path):
+        try:
+            return os.stat(path).st_mtime_ns
+        except OSError:
+            return None
+
+    def _is_stale(self):
+        if self._index is None:
+            return True
+        return any(self._get_mtime(path) != mtime for path, mtime in self._dir_mtimes.items())
+
+    def _build_index(self):
+        dir_mtimes = {}
+        openvpn_files = self._collect_files(self.config_paths["openvpn"], '.ovpn', dir_mtimes)
+        wg_files = self._collect_files(self.config_paths["wg"], '.conf', dir_mtimes)
+        amneziawg_files = self._collect_files(self.config_paths["amneziawg"], '.conf', dir_mtimes)
+        self._index = (openvpn_files, wg_files, amneziawg_files)
+        self._dir_mtimes = dir_mtimes
+        self._clients = self._group_clients(self._index)
+        # Отсортированные списки клиентов по типам для постраничного вывода на главной
+        self._sorted = {}
+        for file_type in self.FILE_TYPES:
+            names = sorted((name for name, entry in self._clients.items() if file_type in entry), key=str.lower)
+            self._sorted[file_type] = (names, [name.lower() for name in names])
+
+        digest = hashlib.sha256()
+        for file_path in sorted(openvpn_files + wg_files + amneziawg_files):
+            digest.update(file_path.encode('utf-8', errors='surrogateescape') + b'\0')
+        self._version = digest.hexdigest()[:20]
+        self._history[self._version] = self._clients
+        self._history.move_to_end(self._version)
+        while len(self._history) > self._history_size:
+            self._history.popitem(last=False)
+
+    def _group_clients(self, index):
+        """Группирует файлы по клиентам: клиент -> тип -> {'antizapret': файл, 'vpn': файл}"""
+        clients = {}
+        for file_type, files in zip(self.FILE_TYPES, index):
+            for file_path in files:
+                filename = os.path.basename(file_path)
+                client_name = self.get_client_name(file_type, file_path)
+                entry = clients.setdefault(client_name, {}).setdefault(file_type, {'antizapret': None, 'vpn': None})
+                if 'antizapret' in filename:
+                    entry['antizapret'] = filename
+                elif 'vpn' in filename:
+                    entry['vpn'] = filename
+        return clients
+
+    def _refresh(self):
+        if self._is_stale():
+            self.misses += 1
+            self._build_index()
+        else:
+            self.hits += 1
+
+    def invalidate(self):
+        with self._lock:
+            self._index = None
+
+    def get_config_files(self):
+        with self._lock:
+            self._refresh()
+            openvpn_files, wg_files, amneziawg_files = self._index
+        return list(openvpn_files), list(wg_files), list(amneziawg_files)
+
+    def get_clients(self):
+        """Возвращает (версия, клиенты); словарь клиентов нельзя изменять"""
+        with self._lock:
+            self._refresh()
+            return self._version, self._clients
+
+    def get_clients_delta(self, since_version):
+        """Возвращает (версия, добавленные/изменённые клиенты, удалённые имена) или None,
+        если версия since_version уже не хранится в истории"""
+        with self._lock:
+            self._refresh()
+            previous = self._history.get(since_version)
+            if previous is None:
+                return None
+            changed = {name: entry for name, entry in self._clients.items() if previous.get(name) != entry}
+            removed = sorted(name for name in previous if name not in self._clients)
+            return self._version, changed, removed
+
+    def get_page(self, query=None, page=1, page_size=100):
+        """Страница клиентов всех трёх таблиц с поиском по подстроке имени"""
+        query = (query or '').strip()
+        with self._lock:
+            self._refresh()
+            clients, sorted_names, version = self._clients, self._sorted, self._version
+
+        tables = {}
+        for file_type in self.FILE_TYPES:
+            names, lowered = sorted_names[file_type]
+            if query:
+                needle = query.lower()
+                names = [name for name, key in zip(names, lowered) if needle in key]
+            tables[file_type] = {'matched': len(names), 'names': names}
+
+        pages = max(1, -(-max(table['matched'] for table in tables.values()) // page_size))
+        page = min(max(page, 1), pages)
+        start = (page - 1) * page_size
+        for file_type, table in tables.items():
+            table['rows'] = [(name, clients[name][file_type]) for name in table.pop('names')[start:start + page_size]]
+        return {'version': version, 'query': query, 'page': page, 'pages': pages, 'page_size': page_size,
+                'tables': tables}
+
+    @staticmethod
+    def get_client_name(file_type, file_path):
+        name_parts = os.path.basename(file_path).split('-')
+        if file_type == 'openvpn':
+            return '-'.join(name_parts[1:-1])
+        return '-'.join(name_parts[1:-2])
+
+    def get_client_files(self, client_name):
+        openvpn_files, wg_files, amneziawg_files = self.get_config_files()
+        client_files = {}
+        for file_type, files in (('openvpn', openvpn_files), ('wg', wg_files), ('amneziawg', amneziawg_files)):
+            client_files[file_type] = [f for f in files if self.get_client_name(file_type, f) == client_name]
+        return client_files
+
+    def get_stats(self):
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'directories': len(self._dir_mtimes),
+            'version': self._version
+        }
+
+
+class AuthenticationManager:
+    def __init__(self):
+        pass
+
+    def login_required(self, f):
+        @wraps(f)
+        def decorated_function(*args, **kwargs):
+            if 'username' not in session:
+                flash('Пожалуйста, войдите в систему для доступа к этой странице.', 'info')
+                return redirect(url_for('login'))
+            return f(*args, **kwargs)
+        return decorated_function
+
+class CaptchaBudgetExceeded(Exception):
+    pass
+
+class CaptchaGenerator:
+    """Генератор капчи с пулом заранее отрисованных картинок.
+
+    Шрифт и повёрнутые глифы кэшируются, шум строится одной операцией над
+    случайным слоем, а готовые пары (текст, PNG) держит фоновый поток. Число
+    отрисовок в секунду ограничено, чтобы поток запросов /captcha.png не съедал CPU.
+    """
+
+    FONT_PATH = './static/assets/fonts/SabirMono-Regular.ttf'
+    FONT_SIZE = 42
+    WIDTH = 200
+    HEIGHT = 60
+    ANGLES = range(-15, 16, 3)
+
+    def __init__(self, pool_size=None, renders_per_second=None):
+        self.pool_size = pool_size or int(os.getenv('CAPTCHA_POOL_SIZE', '32'))
+        self.renders_per_second = renders_per_second or int(os.getenv('CAPTCHA_RENDERS_PER_SECOND', '20'))
+        self._font = None
+        self._glyphs = {}
+        self._pool = deque()
+        self._lock = threading.Lock()
+        self._wakeup = threading.Condition(self._lock)
+        self._thread = None
+        self._pid = None
+        self._window_start = 0.0
+        self._window_renders = 0
+        self.rendered = 0
+        self.rejected = 0
+
+    def generate_captcha(self):
+        text = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
+        return text
+
+    def _get_font(self):
+        if self._font is None:
+            self._font = ImageFont.truetype(self.FONT_PATH, self.FONT_SIZE)
+        return self._font
+
+    def _get_glyph(self, char, angle):
+        """Повёрнутый глиф и размеры исходного символа; строится один раз"""
+        glyph = self._glyphs.get((char, angle))
+        if glyph is None:
+            font = self._get_font()
+            bbox = font.getbbox(char)
+            char_width = bbox[2] - bbox[0]
+            char_height = bbox[3] - bbox[1]
+            char_img = Image.new('RGBA', (char_width*2, char_height*2), (255, 255, 255, 0))
+            ImageDraw.Draw(char_img).text((0, 0), char, font=font, fill=(0, 0, 0))
+            glyph = (char_img.rotate(angle, expand=1, resample=Image.BICUBIC), char_width, char_height)
+            self._glyphs[(char, angle)] = glyph
+        return glyph
+
+    def render(self, text):
+        width, height = self.WIDTH, self.HEIGHT
+        image = Image.new('RGB', (width, height), color=(255, 255, 255))
+        current_x = 22
+        y_offset = 10
+
+        for char in text:
+            char_img, char_width, char_height = self._get_glyph(char, random.choice(self.ANGLES))
+            new_width, new_height = char_img.size
+            char_x = current_x + (char_width//2) - (new_width//2)
+            char_y = y_offset + (char_height//2) - (new_height//2)
+            image.paste(char_img, (char_x, char_y), char_img)
+            current_x += char_width + 10
+
+        # Точки шума: ~1% случайных пикселей, расширенных до пятен 3x3, одной маской
+        noise = Image.frombytes('L', (width, height), os.urandom(width * height))
+        noise = noise.point(lambda value: 255 if value < 3 else 0).filter(ImageFilter.MaxFilter(3))
+        image.paste((200, 200, 200), mask=noise)
+
+        distortion = Image.new('L', (width, height), 255)
+        draw_dist = ImageDraw.Draw(distortion)
+        for _ in range(5):
+            draw_dist.line((random.randint(0, width), random.randint(0, height),
+                            random.randint(0, width), random.randint(0, height)), fill=0, width=2)
+        image = Image.composite(image, Image.new('RGB', (width, height), (255, 255, 255)), distortion)
+
+        image = image.filter(ImageFilter.GaussianBlur(radius=0.5))
+        image = ImageEnhance.Contrast(image).enhance(1.5)
+
+        img_io = io.BytesIO()
+        image.save(img_io, 'PNG')
+        return img_io.getvalue()
+
+    def _acquire_budget(self):
+        """Вызывается под self._lock; True, если в текущей секунде ещё можно рисовать"""
+        now = time.monotonic()
+        if now - self._window_start >= 1:
+            self._window_start = now
+            self._window_renders = 0
+        if self._window_renders >= self.renders_per_second:
+            return False
+        self._window_renders += 1
+        return True
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._pool.clear()
+            self._thread = threading.Thread(target=self._run, name='captcha-pool', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            with self._lock:
+                while len(self._pool) >= self.pool_size:
+                    self._wakeup.wait()
+                allowed = self._acquire_budget()
+                # Пул пополняется из того же бюджета, что и запросы
+                delay = 0 if allowed else max(1 - (time.monotonic() - self._window_start), 0.05)
+            if not allowed:
+                time.sleep(delay)
+                continue
+            try:
+                text = self.generate_captcha()
+                with metrics.timer('render_duration_seconds', kind='captcha'):
+                    png = self.render(text)
+            except Exception as e:
+                print(f"Ошибка генерации капчи: {str(e)}")
+                time.sleep(5)
+                continue
+            with self._lock:
+                self._pool.append((text, png))
+                self.rendered += 1
+
+    def take(self):
+        """Возвращает (текст, PNG) из пула или отрисовывает новую капчу в пределах бюджета"""
+        self.start()
+        with self._lock:
+            if self._pool:
+                item = self._pool.popleft()
+                self._wakeup.notify()
+                return item
+            if not self._acquire_budget():
+                self.rejected += 1
+                raise CaptchaBudgetExceeded()
+        text = self.generate_captcha()
+        with metrics.timer('render_duration_seconds', kind='captcha'):
+            png = self.render(text)
+        with self._lock:
+            self.rendered += 1
+        return text, png
+
+    def get_stats(self):
+        with self._lock:
+            return {'pool': len(self._pool), 'pool_size': self.pool_size, 'rendered': self.rendered,
+                    'rejected': self.rejected, 'renders_per_second': self.renders_per_second}
+
+class LoginRateLimiter:
+    """Ограничение попыток входа по IP и по имени пользователя.
+
+    Неудачные попытки хранятся в скользящем окне для каждого ключа, число ключей
+    ограничено (самые давние вытесняются). При превышении лимита ключ блокируется
+    с экспоненциально растущей паузой. Проверка выполняется до запроса к БД и
+    вычисления хэша пароля.
+    """
+
+    def __init__(self, ip_limit=None, username_limit=None, window=None, max_keys=None,
+                 base_backoff=None, max_backoff=None):
+        self.limits = {
+            'ip': ip_limit or int(os.getenv('LOGIN_IP_LIMIT', '10')),
+            'user': username_limit or int(os.getenv('LOGIN_USERNAME_LIMIT', '5'))
+        }
+        self.window = window or int(os.getenv('LOGIN_WINDOW', '300'))
+        self.max_keys = max_keys or int(os.getenv('LOGIN_LIMITER_MAX_KEYS', '10000'))
+        self.base_backoff = base_backoff or int(os.getenv('LOGIN_BACKOFF', '30'))
+        self.max_backoff = max_backoff or int(os.getenv('LOGIN_MAX_BACKOFF', '3600'))
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        self.failures = 0
+        self.rejected = 0
+        self.evicted = 0
+
+    def _keys(self, ip, username):
+        keys = [('ip', ip or '-')]
+        if username:
+            keys.append(('user', username.lower()[:80]))
+        return keys
+
+    def _entry(self, key, create=False):
+        entry = self._entries.get(key)
+        if entry is None:
+            if not create:
+                return None
+            entry = {'failures': deque(maxlen=self.limits[key[0]]), 'blocked_until': 0.0, 'strikes': 0}
+            self._entries[key] = entry
+            while len(self._entries) > self.max_keys:
+                self._entries.popitem(last=False)
+                self.evicted += 1
+        self._entries.move_to_end(key)
+        return entry
+
+    def check(self, ip, username=None):
+        """Возвращает 0, если попытку можно пропустить, иначе число секунд до разблокировки"""
+        now = time.time()
+        retry_after = 0
+        with self._lock:
+            for key in self._keys(ip, username):
+                entry = self._entry(key)
+                if entry is not None and entry['blocked_until'] > now:
+                    retry_after = max(retry_after, int(entry['blocked_until'] - now) + 1)
+            if retry_after:
+                self.rejected += 1
+        return retry_after
+
+    def record_failure(self, ip, username=None):
+        now = time.time()
+        with self._lock:
+            self.failures += 1
+            for key in self._keys(ip, username):
+                entry = self._entry(key, create=True)
+                failures = entry['failures']
+                while failures and failures[0] < now - self.window:
+                    failures.popleft()
+                failures.append(now)
+                if len(failures) >= self.limits[key[0]]:
+                    # Каждая следующая блокировка вдвое длиннее предыдущей
+                    entry['blocked_until'] = now + min(self.base_backoff * 2 ** entry['strikes'], self.max_backoff)
+                    entry['strikes'] += 1
+                    failures.clear()
+
+    def record_success(self, ip, username=None):
+        with self._lock:
+            for key in self._keys(ip, username):
+                self._entries.pop(key, None)
+
+    def get_stats(self):
+        now = time.time()
+        with self._lock:
+            return {
+                'tracked': len(self._entries),
+                'blocked': sum(1 for entry in self._entries.values() if entry['blocked_until'] > now),
+                'failures': self.failures,
+                'rejected': self.rejected,
+                'evicted': self.evicted
+            }
+
+class FileValidator:
+    def __init__(self, config_paths):
+        self.config_paths = config_paths
+        # Таблица поиска: тип файла -> {нормализованное имя: (путь, чистое имя)}
+        self._lock = threading.Lock()
+        self._lookup = {}
+
+    @staticmethod
+    def _normalize(name):
+        return name.replace("(", "").replace(")", "")
+
+    def _build_lookup(self, file_type):
+        lookup = {}
+        for config_dir in self.config_paths[file_type]:
+            for root, _, files in os.walk(config_dir):
+                for file in files:
+                    clean_name = self._normalize(file)
+                    # Как и при обходе дерева, выигрывает первое совпадение
+                    lookup.setdefault(clean_name, (os.path.join(root, file), clean_name))
+        return lookup
+
+    def invalidate(self):
+        with self._lock:
+            self._lookup = {}
+
+    def resolve(self, file_type, filename):
+        key = self._normalize(filename)
+        with self._lock:
+            lookup = self._lookup.get(file_type)
+            if lookup is None:
+                lookup = self._lookup[file_type] = self._build_lookup(file_type)
+                rescanned = True
+            else:
+                rescanned = False
+
+            entry = lookup.get(key)
+            if entry is not None and os.path.isfile(entry[0]):
+                return entry
+            if rescanned:
+                return None
+
+            # Промах или устаревшая запись: пересканируем каталоги один раз
+            lookup = self._lookup[file_type] = self._build_lookup(file_type)
+            return lookup.get(key)
+
+    def validate_file(self, func):
+        @wraps(func)
+        def wrapper(file_type, filename, *args, **kwargs):
+            if file_type not in self.config_paths:
+                abort(400, description="Недопустимый тип файла")
+
+            try:
+                entry = self.resolve(file_type, filename)
+            except Exception as e:
+                print(f"Аларм! ошибка: {str(e)}")
+                abort(500)
+
+            if entry is None:
+                abort(404, description="Файл не найден")
+
+            file_path, clean_name = entry
+            return func(file_path, clean_name, *args, **kwargs)
+
+        return wrapper
+
+class QRGenerator:
+    def __init__(self, max_cache_bytes=None):
+        # LRU-кэш PNG по хэшу содержимого конфигурации с ограничением по размеру в байтах
+        if max_cache_bytes is None:
+            max_cache_bytes = int(os.getenv('QR_CACHE_MAX_BYTES', str(32 * 1024 * 1024)))
+        self.max_cache_bytes = max_cache_bytes
+        self._cache = OrderedDict()
+        self._cache_bytes = 0
+        self._lock = threading.Lock()
+        self._prerender_executor = None
+
+    @staticmethod
+    def get_etag(config_text):
+        return hashlib.sha256(config_text.encode('utf-8')).hexdigest()
+
+    def _render_png(self, config_text):
+        qr = qrcode.QRCode(
+            version=1,
+            error_correction=qrcode.constants.ERROR_CORRECT_H,
+            box_size=10,
+            border=4,
+        )
+        qr.add_data(config_text)
+        qr.make(fit=True)
+
+        img = qr.make_image(fill_color="black", back_color="white", image_factory=PilImage)
+
+        img_byte_arr = io.BytesIO()
+        img.save(img_byte_arr, format='PNG')
+        return img_byte_arr.getvalue()
+
+    def _cache_put(self, key, png):
+        if len(png) > self.max_cache_bytes:
+            return
+        with self._lock:
+            if key in self._cache:
+                self._cache.move_to_end(key)
+                return
+            self._cache[key] = png
+            self._cache_bytes += len(png)
+            while self._cache_bytes > self.max_cache_bytes:
+                _, evicted = self._cache.popitem(last=False)
+                self._cache_bytes -= len(evicted)
+
+    def get_qr_png(self, config_text):
+        key = self.get_etag(config_text)
+        with self._lock:
+            png = self._cache.get(key)
+            if png is not None:
+                self._cache.move_to_end(key)
+                return png, key
+
+        with metrics.timer('render_duration_seconds', kind='qr'):
+            png = self._render_png(config_text)
+        self._cache_put(key, png)
+        return png, key
+
+    def prerender(self, file_paths):
+        """Заранее рендерит QR-коды в фоне, чтобы первый запрос попал в кэш"""
+        if not file_paths:
+            return
+        with self._lock:
+            if self._prerender_executor is None:
+                self._prerender_executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='qr-prerender')
+        for file_path in file_paths:
+            self._prerender_executor.submit(self._prerender_file, file_path)
+
+    def _prerender_file(self, file_path):
+        try:
+            with open(file_path, 'r') as file:
+                self.get_qr_png(file.read())
+        except Exception as e:
+            print(f"Ошибка предварительного рендеринга QR-кода {file_path}: {str(e)}")
+
+    def get_stats(self):
+        with self._lock:
+            return {'entries': len(self._cache), 'bytes': self._cache_bytes, 'max_bytes': self.max_cache_bytes}
+
+class ListNormalizer:
+    """Нормализация списков АнтиЗапрета перед сохранением.
+
+    Хосты приводятся к нижнему регистру, дубликаты и поддомены уже
+    перечисленных доменов удаляются. IP-адреса и подсети сводятся к
+    минимальному набору CIDR (как ipaddress.collapse_addresses, но на
+    целых числах — на списках в 100 тысяч строк стандартная реализация
+    работает несколько секунд). Подсети сводятся в пределах блока между
+    комментариями и пустыми строками. Комментарии и пустые строки остаются на
+    своих местах, нераспознанные строки остаются как есть.
+    """
+
+    @staticmethod
+    def _normalize_host(host):
+        host = host.lower().rstrip('.')
+        if host.startswith('*.'):
+            host = host[2:]
+        return host.lstrip('.')
+
+    def normalize_hosts(self, lines):
+        """Возвращает (строки, отчёт); порядок первых вхождений сохраняется"""
+        result, seen = [], set()
+        hosts = []
+        duplicates = 0
+        for line in lines:
+            stripped = line.strip()
+            if not stripped or stripped.startswith('#'):
+                result.append(stripped)
+                continue
+            host = self._normalize_host(stripped)
+            if host in seen:
+                duplicates += 1
+                continue
+            seen.add(host)
+            hosts.append(host)
+            result.append(host)
+
+        # Домен покрыт, если в списке есть любой его родитель по границе меток;
+        # проверка суффиксов по множеству эквивалентна обходу дерева перевёрнутых меток
+        covered = set()
+        for host in hosts:
+            index = host.find('.')
+            while index != -1:
+                if host[index + 1:] in seen:
+                    covered.add(host)
+                    break
+                index = host.find('.', index + 1)
+        if covered:
+            result = [line for line in result if line not in covered]
+
+        before = len(hosts) + duplicates
+        return result, {
+            'before': before,
+            'after': len(hosts) - len(covered),
+            'duplicates': duplicates,
+            'covered': len(covered),
+            'merged': 0,
+            'invalid': 0
+        }
+
+    @staticmethod
+    def _format_cidr(start, size):
+        address = socket.inet_ntop(socket.AF_INET, start.to_bytes(4, 'big'))
+        return address if size == 1 else f"{address}/{33 - size.bit_length()}"
+
+    def _range_to_cidrs(self, start, end):
+        while start <= end:
+            size = start & -start if start else 1 << 32
+            while size > end - start + 1:
+                size >>= 1
+            yield self._format_cidr(start, size)
+            start += size
+
+    def normalize_ips(self, lines):
+        """Сводит адреса и подсети каждого блока к минимальному набору CIDR"""
+        result, block = [], []
+        before = after = invalid = 0
+
+        def flush():
+            nonlocal before, after, invalid
+            if block:
+                networks, unknown = self._collapse(block)
+                result.extend(networks + unknown)
+                before += len(block)
+                after += len(networks) + len(unknown)
+                invalid += len(unknown)
+                block.clear()
+
+        for line in lines:
+            stripped = line.strip()
+            if stripped and not stripped.startswith('#'):
+                block.append(stripped)
+                continue
+            flush()
+            result.append(stripped)
+        flush()
+        return result, {
+            'before': before,
+            'after': after,
+            'duplicates': 0,
+            'covered': 0,
+            'merged': before - after,
+            'invalid': invalid
+        }
+
+    def _collapse(self, entries):
+        """(CIDR, нераспознанные строки) для одного блока записей"""
+        # Диапазон IPv4 упакован в одно число (начало << 32 | конец): так сортировка заметно быстрее
+        packed, ipv6, invalid = [], [], []
+        inet_pton, af_inet, from_bytes = socket.inet_pton, socket.AF_INET, int.from_bytes
+        for entry in entries:
+            address, _, prefix = entry.partition('/')
+            try:
+                start = from_bytes(inet_pton(af_inet, address), 'big')
+                bits = 32 - int(prefix) if prefix else 0
+                if not 0 <= bits <= 32:
+                    raise ValueError(entry)
+            except (OSError, ValueError):
+                try:
+                    network = ipaddress.ip_network(entry, strict=False)
+                except ValueError:
+                    invalid.append(entry)
+                    continue
+                if network.version == 4:
+                    packed.append((int(network.network_address) << 32) | int(network.broadcast_address))
+                else:
+                    ipv6.append(network)
+                continue
+            start = start >> bits << bits
+            packed.append((start << 32) | (start + (1 << bits) - 1))
+
+        packed.sort()
+        networks = []
+        current_start = current_end = -1
+        for item in packed:
+            start, end = item >> 32, item & 0xFFFFFFFF
+            if start <= current_end + 1 and current_end >= 0:
+                if end > current_end:
+                    current_end = end
+                continue
+            if current_end >= 0:
+                networks.extend(self._range_to_cidrs(current_start, current_end))
+            current_start, current_end = start, end
+        if current_end >= 0:
+            networks.extend(self._range_to_cidrs(current_start, current_end))
+
+        networks += [str(network) for network in ipaddress.collapse_addresses(ipv6)]
+        # Нераспознанные строки не теряются: возможно, doall.sh понимает их формат
+        return networks, invalid
+
+    def normalize(self, kind, content):
+        """Нормализует текст списка; возвращает (текст, отчёт)"""
+        lines = content.splitlines()
+        if kind == 'ips':
+            result, report = self.normalize_ips(lines)
+        else:
+            result, report = self.normalize_hosts(lines)
+        # Пустые строки подряд и в конце не нужны
+        compact = []
+        for line in result:
+            if line or (compact and compact[-1]):
+                compact.append(line)
+        while compact and not compact[-1]:
+            compact.pop()
+        return ''.join(line + '\n' for line in compact), report
+
+class VersionConflict(Exception):
+    def __init__(self, current_version):
+        super().__init__(current_version)
+        self.current_version = current_version
+
+class FileEditor:
+    """Списки хостов и IP АнтиЗапрета.
+
+    Для каждого файла в памяти держится отсортированный индекс записей
+    (перестраивается при изменении файла), по которому работают постраничное
+    чтение, поиск и поиск по префиксу. Изменения пишутся атомарно, а версия
+    (хэш содержимого) служит ETag для оптимистичной блокировки.
+    """
+
+    def __init__(self, lock_dir=None, normalizer=None):
+        self.files = {
+            "include_hosts": "/root/antizapret/config/include-hosts.txt",
+            "exclude_hosts": "/root/antizapret/config/exclude-hosts.txt",
+            "include_ips": "/root/antizapret/config/include-ips.txt"
+        }
+        self.kinds = {"include_hosts": "hosts", "exclude_hosts": "hosts", "include_ips": "ips"}
+        self.lock_dir = lock_dir
+        self.normalizer = normalizer
+        self._lock = threading.Lock()
+        self._indexes = {}
+
+    @staticmethod
+    def get_version(content):
+        return hashlib.sha1(content.encode('utf-8')).hexdigest()[:16]
+
+    @staticmethod
+    def normalize(line):
+        return line.strip().lower()
+
+    @staticmethod
+    def is_entry(line):
+        stripped = line.strip()
+        return bool(stripped) and not stripped.startswith('#')
+
+    def _read(self, file_type):
+        try:
+            with open(self.files[file_type], 'r', encoding='utf-8') as f:
+                return f.read()
+        except FileNotFoundError:
+            return ""
+
+    def get_index(self, file_type):
+        """Возвращает (версия, отсортированный список записей) с перестроением по mtime"""
+        path = self.files[file_type]
+        try:
+            file_stat = os.stat(path)
+            key = (file_stat.st_mtime_ns, file_stat.st_size, file_stat.st_ino)
+        except FileNotFoundError:
+            key = None
+        with self._lock:
+            cached = self._indexes.get(file_type)
+            if cached is not None and cached[0] == key:
+                return cached[1], cached[2]
+        content = self._read(file_type)
+        entries = sorted({self.normalize(line) for line in content.splitlines() if self.is_entry(line)})
+        version = self.get_version(content)
+        with self._lock:
+            self._indexes[file_type] = (key, version, entries)
+        return version, entries
+
+    def get_page(self, file_type, offset=0, limit=100, query=None, prefix=None):
+        version, entries = self.get_index(file_type)
+        if prefix:
+            prefix = self.normalize(prefix)
+            start = bisect.bisect_left(entries, prefix)
+            end = bisect.bisect_left(entries, prefix + '\U0010ffff', start)
+            matched = entries[start:end]
+        else:
+            matched = entries
+        if query:
+            query = self.normalize(query)
+            matched = [entry for entry in matched if query in entry]
+        return {
+            'version': version,
+            'total': len(entries),
+            'matched': len(matched),
+            'offset': offset,
+            'limit': limit,
+            'lines': matched[offset:offset + limit]
+        }
+
+    @contextmanager
+    def _file_lock(self, file_type):
+        """Сериализует изменения между потоками и воркерами"""
+        if self.lock_dir is None:
+            yield
+            return
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with open(os.path.join(self.lock_dir, f'list-{file_type}.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    @staticmethod
+    def validate_lines(lines):
+        result = []
+        for line in lines:
+            line = str(line).strip()
+            if not line:
+                continue
+            if len(line) > 253 or any(char.isspace() or ord(char) < 32 for char in line):
+                raise ValueError(f"Некорректная строка: {line[:64]}")
+            result.append(line)
+        return result
+
+    def patch(self, file_type, add=(), remove=(), expected_version=None):
+        """Добавляет и удаляет строки; при несовпадении версии бросает VersionConflict"""
+        add = self.validate_lines(add)
+        remove = {self.normalize(line) for line in self.validate_lines(remove)}
+        with self._file_lock(file_type):
+            content = self._read(file_type)
+            version = self.get_version(content)
+            if expected_version is not None and expected_version != version:
+                raise VersionConflict(version)
+
+            lines = content.splitlines(keepends=True)
+            kept = [line for line in lines if not (self.is_entry(line) and self.normalize(line) in remove)]
+            removed = len(lines) - len(kept)
+            present = {self.normalize(line) for line in kept if self.is_entry(line)}
+            added = []
+            for line in add:
+                if self.normalize(line) not in present:
+                    present.add(self.normalize(line))
+                    added.append(line + '\n')
+            if kept and added and not kept[-1].endswith('\n'):
+                kept[-1] += '\n'
+
+            new_content, report = self._normalize(file_type, ''.join(kept + added))
+            if new_content != content:
+                atomic_write(self.files[file_type], new_content)
+        return {'version': self.get_version(new_content), 'added': len(added), 'removed': removed,
+                'skipped': len(add) - len(added), 'normalized': report}
+
+    def _normalize(self, file_type, content):
+        if self.normalizer is None:
+            return content, None
+        return self.normalizer.normalize(self.kinds[file_type], content)
+
+    def update_file_content(self, file_type, content, expected_version=None):
+        """Сохраняет файл целиком; возвращает (новая версия, отчёт нормализации) или None"""
+        if file_type in self.files:
+            try:
+                content, report = self._normalize(file_type, content)
+                with self._file_lock(file_type):
+                    if expected_version and expected_version != self.get_version(self._read(file_type)):
+                        raise VersionConflict(self.get_version(self._read(file_type)))
+                    atomic_write(self.files[file_type], content)
+                return self.get_version(content), report
+            except VersionConflict:
+                raise
+            except Exception as e:
+                print(f"Ошибка записи в файл: {str(e)}")
+                return None
+        return None
+
+    def get_file_contents(self, inline_limit=None):
+        """Содержимое файлов для формы; файлы больше inline_limit не передаются целиком"""
+        file_contents = {}
+        for key, path in self.files.items():
+            try:
+                size = os.path.getsize(path)
+            except OSError:
+                size = 0
+            if inline_limit is not None and size > inline_limit:
+                file_contents[key] = {'content': None, 'size': size, 'version': self.get_index(key)[0]}
+                continue
+            content = self._read(key)
+            file_contents[key] = {'content': content, 'size': size, 'version': self.get_version(content)}
+        return file_contents
+
+class ServerMonitor:
+    """Фоновый сборщик метрик сервера с кольцевым буфером истории.
+
+    Один поток раз в MONITOR_INTERVAL секунд снимает показатели, а запросы
+    только читают последний снимок, поэтому не блокируются на psutil.
+    """
+
+    def __init__(self, interval=None, history_size=None):
+        self.interval = interval or float(os.getenv('MONITOR_INTERVAL', '2'))
+        self.history = deque(maxlen=history_size or int(os.getenv('MONITOR_HISTORY', '900')))
+        self._lock = threading.Lock()
+        # Снимок меняет _prev_*: поток сборщика и запрос до первого снимка не должны снимать его одновременно
+        self._collect_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self._prev_net = None
+        self._prev_disk = None
+        self._prev_time = None
+
+    def start(self):
+        with self._lock:
+            # После fork поток не переживает, поэтому проверяем и PID
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            psutil.cpu_percent(interval=None, percpu=True)
+            self._thread = threading.Thread(target=self._run, name='server-monitor', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            try:
+                self._collect()
+            except Exception as e:
+                print(f"Ошибка сбора метрик сервера: {str(e)}")
+            time.sleep(self.interval)
+
+    @staticmethod
+    def _rate(current, previous, elapsed):
+        if previous is None or elapsed <= 0:
+            return 0.0
+        return round(max(current - previous, 0) / elapsed, 1)
+
+    def _collect(self):
+        with self._collect_lock:
+            return self._sample()
+
+    def _sample(self):
+        now = time.time()
+        per_core = psutil.cpu_percent(interval=None, percpu=True)
+        net = psutil.net_io_counters()
+        disk = psutil.disk_io_counters()
+        elapsed = now - self._prev_time if self._prev_time else 0
+
+        sample = {
+            'timestamp': now,
+            'cpu_usage': round(sum(per_core) / len(per_core), 1) if per_core else 0.0,
+            'cpu_per_core': per_core,
+            'memory_usage': psutil.virtual_memory().percent,
+            'load_average': [round(value, 2) for value in os.getloadavg()],
+            'net_sent_rate': self._rate(net.bytes_sent, self._prev_net and self._prev_net.bytes_sent, elapsed),
+            'net_recv_rate': self._rate(net.bytes_recv, self._prev_net and self._prev_net.bytes_recv, elapsed),
+            'disk_read_rate': self._rate(disk.read_bytes, self._prev_disk and self._prev_disk.read_bytes, elapsed) if disk else 0.0,
+            'disk_write_rate': self._rate(disk.write_bytes, self._prev_disk and self._prev_disk.write_bytes, elapsed) if disk else 0.0
+        }
+        self._prev_net, self._prev_disk, self._prev_time = net, disk, now
+        with self._lock:
+            self.history.append(sample)
+        return sample
+
+    def get_latest(self):
+        self.start()
+        with self._lock:
+            if self.history:
+                return self.history[-1]
+        # Первый запрос до первого снимка: снимаем его сразу, без ожидания
+        with self._collect_lock:
+            with self._lock:
+                if self.history:
+                    return self.history[-1]
+            return self._sample()
+
+    def get_history(self, since):
+        self.start()
+        with self._lock:
+            return [sample for sample in self.history if sample['timestamp'] > since]
+
+    def get_uptime(self):
+        boot_time = psutil.boot_time()
+        current_time = time.time()
+        uptime_seconds = current_time - boot_time
+        days, remainder = divmod(uptime_seconds, 86400)
+        hours, remainder = divmod(remainder, 3600)
+        minutes, _ = divmod(remainder, 60)
+        return f"{int(days)}д {int(hours)}ч {int(minutes)}м"
+
+# Таблица для bytes.translate: занятый байт (0xff) -> 0, остальные -> 1
+FULL_BYTE_TABLE = bytes(0 if value == 0xff else 1 for value in range(256))
+
+CLIENT_NAME_RE = re.compile(r'^[a-zA-Z0-9_-]{1,32}$')
+
+def read_command_output(text):
+    """Значение как у $(...) в bash: без завершающих переводов строки"""
+    return text.rstrip('\n')
+
+def get_server_host(variable):
+    """OPENVPN_HOST/WIREGUARD_HOST из client.sh, иначе первый глобальный IPv4 (как getServerIP)"""
+    try:
+        with open(CLIENT_SCRIPT, 'r') as file:
+            for line in file:
+                if line.startswith(f'{variable}='):
+                    value = line.split('=', 1)[1].strip().strip('"\'')
+                    if value:
+                        return value
+                    break
+    except OSError:
+        pass
+
+    try:
+        output = subprocess.run(['ip', '-4', 'addr'], stdout=subprocess.PIPE, stderr=subprocess.DEVNULL, text=True).stdout
+    except OSError:
+        return ''
+    match = re.search(r'^.* inet ([^/]*)/.* scope global.*$', output, re.MULTILINE)
+    return match.group(1) if match else ''
+
+def get_profile_base_name(client_name):
+    """Имя клиента в именах файлов профилей: без префиксов antizapret- и vpn-, как в setFileName"""
+    file_name = client_name[len('antizapret-'):] if client_name.startswith('antizapret-') else client_name
+    return file_name[len('vpn-'):] if file_name.startswith('vpn-') else file_name
+
+def get_profile_file_name(client_name, server_host):
+    """Аналог setFileName из client.sh"""
+    return f"{get_profile_base_name(client_name)}-({server_host})"
+
+def x25519_public_key(private_key):
+    """Вычисляет публичный ключ X25519 (RFC 7748) - то же, что делает `wg pubkey`"""
+    p = 2 ** 255 - 19
+    scalar = bytearray(private_key)
+    scalar[0] &= 248
+    scalar[31] &= 127
+    scalar[31] |= 64
+    k = int.from_bytes(scalar, 'little')
+
+    x1, x2, z2, x3, z3 = 9, 1, 0, 9, 1
+    swap = 0
+    for t in reversed(range(255)):
+        k_t = (k >> t) & 1
+        swap ^= k_t
+        if swap:
+            x2, x3, z2, z3 = x3, x2, z3, z2
+        swap = k_t
+        a, b = (x2 + z2) % p, (x2 - z2) % p
+        aa, bb = a * a % p, b * b % p
+        e = (aa - bb) % p
+        c, d = (x3 + z3) % p, (x3 - z3) % p
+        da, cb = d * a % p, c * b % p
+        x3 = (da + cb) ** 2 % p
+        z3 = x1 * (da - cb) ** 2 % p
+        x2 = aa * bb % p
+        z2 = e * (aa + 121665 * e) % p
+    if swap:
+        x2, z2 = x3, z3
+    return (x2 * pow(z2, p - 2, p) % p).to_bytes(32, 'little')
+
+def generate_wireguard_keypair():
+    private_key = bytearray(os.urandom(32))
+    private_key[0] &= 248
+    private_key[31] &= 127
+    private_key[31] |= 64
+    return (base64.b64encode(bytes(private_key)).decode('ascii'),
+            base64.b64encode(x25519_public_key(private_key)).decode('ascii'))
+
+def generate_wireguard_psk():
+    return base64.b64encode(os.urandom(32)).decode('ascii')
+
+class WireGuardConfig:
+    """Конфигурация одного интерфейса WireGuard с блоками клиентов `# Client = <имя>`.
+
+    Адреса клиентов учитываются в битовой карте пула подсети интерфейса, поэтому
+    выделение свободного адреса не требует перебора файла и работает для подсетей
+    любого размера (/24, /16 и больше).
+    """
+
+    def __init__(self, interface, text):
+        self.interface = interface
+        self.segments = []
+        self.peers = OrderedDict()
+        self._parse(text)
+
+        address_line = next((line for line in text.splitlines() if line.startswith('Address')), None)
+        if address_line is None:
+            raise ValueError(f"В конфигурации {interface} не найден Address")
+        address = next(item.strip() for item in address_line.split('=', 1)[1].split(',') if '.' in item)
+        self.server_interface = ipaddress.ip_interface(address)
+        self.network = self.server_interface.network
+        self._bitmap = bytearray((self.network.num_addresses + 7) // 8)
+        self._used = 0
+
+        # Адрес сети, адреса до .2 (как в client.sh), адрес сервера и broadcast заняты
+        for offset in (0, 1, self.network.num_addresses - 1):
+            self._mark(offset)
+        self._mark(int(self.server_interface.ip) - int(self.network.network_address))
+        for segment in self.segments:
+            for line in segment['lines']:
+                if line.startswith('AllowedIPs'):
+                    self._mark_allowed_ips(line)
+
+    def _parse(self, text):
+        lines = text.splitlines(keepends=True)
+        index = 0
+        raw = []
+        while index < len(lines):
+            line = lines[index]
+            if line.startswith('# Client = '):
+                if raw:
+                    self.segments.append({'client': None, 'lines': raw})
+                    raw = []
+                block = [line]
+                index += 1
+                while index < len(lines):
+                    block.append(lines[index])
+                    index += 1
+                    if block[-1].startswith('AllowedIPs'):
+                        break
+                name = line.rstrip('\n')[len('# Client = '):]
+                peer = {'name': name}
+                for block_line in block:
+                    key, _, value = block_line.partition('=')
+                    key = key.strip()
+                    value = value.strip()
+                    if key == '# PrivateKey':
+                        peer['private_key'] = value
+                    elif key == 'PublicKey':
+                        peer['public_key'] = value
+                    elif key == 'PresharedKey':
+                        peer['preshared_key'] = value
+                    elif key == 'AllowedIPs':
+                        peer['allowed_ips'] = value
+                segment = {'client': name, 'lines': block}
+                self.segments.append(segment)
+                self.peers[name] = peer
+                continue
+            raw.append(line)
+            index += 1
+        if raw:
+            self.segments.append({'client': None, 'lines': raw})
+
+    def _offset(self, address):
+        offset = int(address) - int(self.network.network_address)
+        return offset if 0 <= offset < self.network.num_addresses else None
+
+    def _mark(self, offset, used=True):
+        if offset is None or not 0 <= offset < self.network.num_addresses:
+            return
+        byte, bit = divmod(offset, 8)
+        was_used = bool(self._bitmap[byte] & (1 << bit))
+        if used and not was_used:
+            self._bitmap[byte] |= 1 << bit
+            self._used += 1
+        elif not used and was_used:
+            self._bitmap[byte] &= ~(1 << bit)
+            self._used -= 1
+
+    def _mark_allowed_ips(self, line, used=True):
+        for item in line.split('=', 1)[1].split(','):
+            try:
+                network = ipaddress.ip_network(item.strip(), strict=False)
+            except ValueError:
+                continue
+            if network.version == 4 and network.prefixlen == 32:
+                self._mark(self._offset(network.network_address), used)
+
+    def allocate(self):
+        # Байты 0xff полностью заняты; ищем первый байт со свободным битом
+        free_byte = self._bitmap.translate(FULL_BYTE_TABLE).find(b'\x01')
+        if free_byte != -1:
+            for bit in range(8):
+                offset = free_byte * 8 + bit
+                if offset < self.network.num_addresses and not self._bitmap[free_byte] & (1 << bit):
+                    self._mark(offset)
+                    return self.network.network_address + offset
+        raise RuntimeError(f"The WireGuard/AmneziaWG subnet can support only {self.network.num_addresses - 3} clients")
+
+    def get_client_ip(self, name):
+        peer = self.peers.get(name)
+        if not peer or not peer.get('allowed_ips'):
+            return None
+        try:
+            return ipaddress.ip_network(peer['allowed_ips'].split(',')[0].strip(), strict=False).network_address
+        except ValueError:
+            return None
+
+    def remove_peer(self, name):
+        if name not in self.peers:
+            return False
+        for segment in self.segments:
+            if segment['client'] == name:
+                for line in segment['lines']:
+                    if line.startswith('AllowedIPs'):
+                        self._mark_allowed_ips(line, used=False)
+        self.segments = [segment for segment in self.segments if segment['client'] != name]
+        del self.peers[name]
+        return True
+
+    def add_peer(self, name, private_key, public_key, preshared_key, client_ip):
+        self._mark(self._offset(client_ip))
+        block = [
+            f"# Client = {name}\n",
+            f"# PrivateKey = {private_key}\n",
+            "[Peer]\n",
+            f"PublicKey = {public_key}\n",
+            f"PresharedKey = {preshared_key}\n",
+            f"AllowedIPs = {client_ip}/32\n",
+            "\n"
+        ]
+        self.segments.append({'client': name, 'lines': block})
+        self.peers[name] = {'name': name, 'private_key': private_key, 'public_key': public_key,
+                            'preshared_key': preshared_key, 'allowed_ips': f"{client_ip}/32"}
+
+    def render(self):
+        text = ''.join(''.join(segment['lines']) for segment in self.segments)
+        # Схлопываем повторяющиеся пустые строки, как `sed '/^$/N;/^\n$/D'` в client.sh
+        return re.sub(r'\n{3,}', '\n\n', text)
+
+class WireGuardPeerManager:
+    """Добавление и удаление клиентов WireGuard/AmneziaWG без вызова client.sh.
+
+    Оба конфига разбираются один раз за операцию, записываются атомарно, а изменения
+    применяются одним `wg syncconf` на интерфейс - в том числе для пакетных операций.
+    """
+
+    PROFILE_KINDS = (('wireguard', 'wg'), ('amneziawg', 'am'))
+
+    def __init__(self, wireguard_dir, client_dir, interfaces, renderer):
+        self.wireguard_dir = wireguard_dir
+        self.client_dir = client_dir
+        self.interfaces = interfaces
+        self.renderer = renderer
+
+    def available(self):
+        return os.path.isdir(os.path.join(self.wireguard_dir, 'templates'))
+
+    def _path(self, *parts):
+        return os.path.join(self.wireguard_dir, *parts)
+
+    def _read(self, *parts):
+        with open(self._path(*parts), 'r') as file:
+            return file.read()
+
+    def _load_server_keys(self):
+        keys = {}
+        for line in self._read('key').splitlines():
+            name, _, value = line.partition('=')
+            keys[name.strip()] = value.strip()
+        return keys
+
+    def _ensure_server_keys(self, variables):
+        """Аналог первого запуска addWireGuard: ключи сервера и конфиги интерфейсов"""
+        if os.path.exists(self._path('key')):
+            return self._load_server_keys()
+        private_key, public_key = generate_wireguard_keypair()
+        atomic_write(self._path('key'), f"PRIVATE_KEY={private_key}\nPUBLIC_KEY={public_key}\n", mode=0o600)
+        keys = {'PRIVATE_KEY': private_key, 'PUBLIC_KEY': public_key}
+        for interface in self.interfaces:
+            self.renderer.render_to(self._path('templates', f'{interface}.conf'), self._path(f'{interface}.conf'),
+                                    dict(variables, **keys), mode=0o600)
+        return keys
+
+    def load(self):
+        return {interface: WireGuardConfig(interface, self._read(f'{interface}.conf')) for interface in self.interfaces}
+
+    def list_clients(self):
+        names = set()
+        for config in self.load().values():
+            names.update(config.peers)
+        return sorted(names)
+
+    def base_variables(self):
+        """Общие переменные шаблонов: адрес сервера, IPS и ключи сервера"""
+        variables = self._base_variables()
+        variables.update(self._load_server_keys())
+        return variables
+
+    def _base_variables(self):
+        server_host = get_server_host('WIREGUARD_HOST')
+        variables = {'SERVER_HOST': server_host, 'WIREGUARD_HOST': server_host}
+        try:
+            variables['IPS'] = read_command_output(self._read('ips'))
+        except OSError:
+            variables['IPS'] = ''
+        return variables
+
+    def profile_paths(self, interface, file_name, client_dir=None):
+        """Пары (шаблон, профиль) WireGuard и AmneziaWG для интерфейса"""
+        return [(self._path('templates', f'{interface}-client-{suffix}.conf'),
+                 os.path.join(client_dir or self.client_dir, directory, interface, f"{interface}-{file_name}-{suffix}.conf"))
+                for directory, suffix in self.PROFILE_KINDS]
+
+    def client_variables(self, variables, config, client_name):
+        """Переменные шаблонов клиента, уже записанного в конфигурацию интерфейса"""
+        peer = config.peers[client_name]
+        return dict(variables, CLIENT_NAME=client_name,
+                    FILE_NAME=get_profile_file_name(client_name, variables['SERVER_HOST']),
+                    CLIENT_PRIVATE_KEY=peer.get('private_key', ''), CLIENT_PUBLIC_KEY=peer.get('public_key', ''),
+                    CLIENT_PRESHARED_KEY=peer.get('preshared_key', ''), CLIENT_IP=str(config.get_client_ip(client_name)),
+                    BASE_CLIENT_IP='.'.join(str(config.server_interface.ip).split('.')[:3]))
+
+    def _render_profiles(self, interface, variables):
+        for template_path, output_path in self.profile_paths(interface, variables['FILE_NAME']):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            self.renderer.render_to(template_path, output_path, variables)
+
+    def _sync(self, interfaces):
+        for interface in interfaces:
+            try:
+                active = subprocess.run(['systemctl', 'is-active', '--quiet', f'wg-quick@{interface}'],
+                                        stderr=subprocess.DEVNULL).returncode == 0
+            except OSError:
+                active = False
+            if not active:
+                continue
+            stripped = subprocess.run(['wg-quick', 'strip', interface], stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL, text=True, check=True).stdout
+            subprocess.run(['wg', 'syncconf', interface, '/dev/stdin'], input=stripped, text=True, check=True)
+
+    def add_clients(self, client_names, on_line=None, results=None):
+        """Добавляет (или пересоздаёт профили) клиентов; возвращает {имя: сообщение}.
+
+        Если передан results, он заполняется по мере обработки - так вызывающий код
+        видит частичный результат, даже если пул адресов закончился посреди пачки.
+        """
+        emit = on_line or (lambda stream, line: None)
+        for client_name in client_names:
+            if not CLIENT_NAME_RE.match(client_name):
+                raise ValueError(f"Некорректное имя клиента: {client_name}")
+
+        variables = self._base_variables()
+        server_keys = self._ensure_server_keys(variables)
+        variables.update(server_keys)
+        configs = self.load()
+        results = {} if results is None else results
+
+        try:
+            for client_name in client_names:
+                existing = next((configs[interface].peers[client_name] for interface in self.interfaces
+                                 if client_name in configs[interface].peers), None)
+                if existing:
+                    private_key = existing.get('private_key', '')
+                    public_key = existing.get('public_key', '')
+                    preshared_key = existing.get('preshared_key', '')
+                    emit('stdout', "A client with the specified name was already created, please choose another name")
+                else:
+                    private_key, public_key = generate_wireguard_keypair()
+                    preshared_key = generate_wireguard_psk()
+
+                client_variables = dict(variables, CLIENT_NAME=client_name,
+                                        FILE_NAME=get_profile_file_name(client_name, variables['SERVER_HOST']),
+                                        CLIENT_PRIVATE_KEY=private_key, CLIENT_PUBLIC_KEY=public_key,
+                                        CLIENT_PRESHARED_KEY=preshared_key)
+                for interface in self.interfaces:
+                    config = configs[interface]
+                    # Существующий клиент сохраняет свой адрес
+                    client_ip = config.get_client_ip(client_name)
+                    config.remove_peer(client_name)
+                    if client_ip is None or client_ip not in config.network:
+                        client_ip = config.allocate()
+                    client_variables.update(CLIENT_IP=str(client_ip),
+                                            BASE_CLIENT_IP='.'.join(str(config.server_interface.ip).split('.')[:3]))
+                    self._render_profiles(interface, client_variables)
+                    config.add_peer(client_name, private_key, public_key, preshared_key, client_ip)
+
+                results[client_name] = (f"WireGuard/AmneziaWG profile files (re)created for client '{client_name}' at "
+                                        f"{os.path.join(self.client_dir, 'wireguard')} and {os.path.join(self.client_dir, 'amneziawg')}")
+                emit('stdout', results[client_name])
+
+        finally:
+            # Клиенты, обработанные до ошибки, сохраняются, как при поочерёдных вызовах client.sh
+            self._save(configs)
+        return results
+
+    def delete_clients(self, client_names, on_line=None):
+        emit = on_line or (lambda stream, line: None)
+        server_host = get_server_host('WIREGUARD_HOST')
+        configs = self.load()
+        results = {}
+        for client_name in client_names:
+            removed = [config.remove_peer(client_name) for config in configs.values()]
+            if not any(removed):
+                results[client_name] = None
+                continue
+            file_name = get_profile_file_name(client_name, server_host)
+            for directory, _ in self.PROFILE_KINDS:
+                for interface in self.interfaces:
+                    pattern = os.path.join(self.client_dir, directory, interface, f"{interface}-{glob.escape(file_name)}-*.conf")
+                    for path in glob.glob(pattern):
+                        os.remove(path)
+            results[client_name] = f"WireGuard/AmneziaWG client '{client_name}' successfully deleted"
+            emit('stdout', '')
+            emit('stdout', results[client_name])
+
+        self._save(configs)
+        return results
+
+    def _save(self, configs):
+        for interface, config in configs.items():
+            atomic_write(self._path(f'{interface}.conf'), config.render())
+        self._sync(configs)
+
+    def run_option(self, option, client_name, on_line=None):
+        """Выполняет опции 4/5/6 client.sh и возвращает (stdout, stderr)"""
+        output = []
+
+        def emit(stream, line):
+            output.append(line)
+            if on_line is not None:
+                on_line(stream, line)
+
+        if option == '4':
+            emit('stdout', f"WireGuard/AmneziaWG - Add client {client_name}")
+            self.add_clients([client_name], emit)
+            emit('stdout', '')
+            emit('stdout', "Attention! If importing a profile file fails, shorten the filename to 32 characters "
+                           "(Windows) or 15 (Linux/Android/iOS)")
+        elif option == '5':
+            emit('stdout', f"WireGuard/AmneziaWG - Delete client {client_name}")
+            if self.delete_clients([client_name], emit)[client_name] is None:
+                message = f"Failed to delete client '{client_name}', please check if the client exists"
+                raise subprocess.CalledProcessError(23, ['client.sh', option, client_name],
+                                                    output='\n'.join(output) + '\n', stderr=message)
+        elif option == '6':
+            emit('stdout', '')
+            emit('stdout', "WireGuard/AmneziaWG client names:")
+            for name in self.list_clients():
+                emit('stdout', name)
+        else:
+            raise ValueError("Некорректный параметр option")
+        return '\n'.join(output) + '\n', ''
+
+class TrafficStatsCollector:
+    """Периодически собирает счётчики трафика WireGuard и OpenVPN.
+
+    Считает приращения по каждому клиенту и хранит их в SQLite с прореживанием:
+    сырые точки - час, минутные агрегаты - сутки, часовые - месяц.
+    """
+
+    RETENTION = (('raw', 1, 3600), ('1m', 60, 86400), ('1h', 3600, 30 * 86400))
+
+    def __init__(self, interval, wg_interfaces, openvpn_status_glob, lock_dir):
+        self.interval = interval
+        self.wg_interfaces = wg_interfaces
+        self.openvpn_status_glob = openvpn_status_glob
+        self.lock_dir = lock_dir
+        self._thread = None
+        self._pid = None
+        self._lock = threading.Lock()
+        self._leader_handle = None
+
+    @staticmethod
+    def parse_wg_dump(text):
+        """Разбирает вывод `wg show <iface> dump` (первая строка - сам интерфейс)"""
+        peers = []
+        for line in text.splitlines()[1:]:
+            fields = line.split('\t')
+            if len(fields) < 8:
+                continue
+            peers.append({
+                'public_key': fields[0],
+                'endpoint': None if fields[2] == '(none)' else fields[2],
+                'allowed_ips': fields[3],
+                'last_handshake': int(fields[4]) or None,
+                'rx': int(fields[5]),
+                'tx': int(fields[6])
+            })
+        return peers
+
+    @staticmethod
+    def parse_wg_peer_names(config_text):
+        """Сопоставляет публичные ключи пиров с именами клиентов из комментариев `# Client =`"""
+        names = {}
+        client_name = None
+        for line in config_text.splitlines():
+            line = line.strip()
+            if line.startswith('# Client ='):
+                client_name = line.split('=', 1)[1].strip()
+            elif line.startswith('PublicKey') and client_name:
+                names[line.split('=', 1)[1].strip()] = client_name
+                client_name = None
+        return names
+
+    @staticmethod
+    def parse_openvpn_status(text):
+        """Разбирает status-файл OpenVPN (форматы status-version 1 и 2/3)"""
+        sessions = []
+        columns = None
+        in_client_list = False
+        for line in text.splitlines():
+            separator = '\t' if '\t' in line else ','
+            fields = line.split(separator)
+            if fields[:2] == ['HEADER', 'CLIENT_LIST']:
+                columns = {name: index + 1 for index, name in enumerate(fields[2:])}
+            elif fields[0] == 'CLIENT_LIST':
+                layout = columns or {'Common Name': 1, 'Real Address': 2, 'Bytes Received': 5,
+                                     'Bytes Sent': 6, 'Connected Since (time_t)': 8}
+                try:
+                    sessions.append({
+                        'client': fields[layout['Common Name']],
+                        'endpoint': fields[layout['Real Address']],
+                        'rx': int(fields[layout['Bytes Received']]),
+                        'tx': int(fields[layout['Bytes Sent']]),
+                        'connected_since': fields[layout['Connected Since (time_t)']]
+                    })
+                except (KeyError, IndexError, ValueError):
+                    continue
+            elif line.startswith('Common Name,Real Address'):
+                in_client_list = True
+            elif line.startswith('ROUTING TABLE'):
+                in_client_list = False
+            elif in_client_list and len(fields) >= 5 and fields[2].isdigit() and fields[3].isdigit():
+                sessions.append({
+                    'client': fields[0],
+                    'endpoint': fields[1],
+                    'rx': int(fields[2]),
+                    'tx': int(fields[3]),
+                    'connected_since': fields[4]
+                })
+        return sessions
+
+    @classmethod
+    def wireguard_readings(cls, interface, dump, config_text):
+        """Показания для collect() из `wg show <iface> dump` и конфига интерфейса"""
+        names = cls.parse_wg_peer_names(config_text)
+        return [('wireguard', interface, names[peer['public_key']], peer['endpoint'], peer['public_key'],
+                 peer['last_handshake'], peer['rx'], peer['tx'])
+                for peer in cls.parse_wg_dump(dump) if peer['public_key'] in names]
+
+    @classmethod
+    def openvpn_readings(cls, interface, status_text, now):
+        """Показания для collect() из status-файла OpenVPN"""
+        return [('openvpn', interface, item['client'], item['endpoint'], item['connected_since'],
+                 int(now), item['rx'], item['tx'])
+                for item in cls.parse_openvpn_status(status_text)]
+
+    def _read_wireguard(self):
+        readings = []
+        for interface in self.wg_interfaces:
+            try:
+                dump = subprocess.run(['wg', 'show', interface, 'dump'], stdout=subprocess.PIPE,
+                                      stderr=subprocess.DEVNULL, text=True, check=True).stdout
+                with open(f'/etc/wireguard/{interface}.conf', 'r') as file:
+                    readings += self.wireguard_readings(interface, dump, file.read())
+            except (OSError, subprocess.CalledProcessError):
+                continue
+        return readings
+
+    def _read_openvpn(self):
+        readings = []
+        for status_file in sorted(glob.glob(self.openvpn_status_glob)):
+            interface = os.path.basename(status_file).replace('-status.log', '')
+            try:
+                with open(status_file, 'r') as file:
+                    readings += self.openvpn_readings(interface, file.read(), time.time())
+            except OSError:
+                continue
+        return readings
+
+    def collect(self, readings=None, now=None):
+        """Обрабатывает одно чтение счётчиков; readings можно передать явно (для проверки на фикстурах)"""
+        now = int(now or time.time())
+        if readings is None:
+            readings = self._read_wireguard() + self._read_openvpn()
+
+        sessions = {(row.client, row.protocol, row.interface): row for row in ClientSession.query.all()}
+        deltas = []
+        for protocol, interface, client, endpoint, session_id, last_handshake, rx, tx in readings:
+            row = sessions.get((client, protocol, interface))
+            if row is None:
+                row = ClientSession(client=client, protocol=protocol, interface=interface,
+                                    rx_counter=rx, tx_counter=tx, rx_total=0, tx_total=0)
+                db.session.add(row)
+                delta_rx, delta_tx = 0, 0
+            elif row.session_id != session_id or rx < row.rx_counter or tx < row.tx_counter:
+                # Новая сессия или сброс счётчиков интерфейса
+                delta_rx, delta_tx = rx, tx
+            else:
+                delta_rx, delta_tx = rx - row.rx_counter, tx - row.tx_counter
+
+            row.endpoint = endpoint
+            row.session_id = session_id
+            row.last_handshake = last_handshake
+            row.rx_counter, row.tx_counter = rx, tx
+            row.rx_total = (row.rx_total or 0) + delta_rx
+            row.tx_total = (row.tx_total or 0) + delta_tx
+            row.updated_at = now
+            if delta_rx or delta_tx:
+                deltas.append((client, protocol, interface, delta_rx, delta_tx))
+
+        for resolution, step, _ in self.RETENTION:
+            bucket = now - now % step
+            for client, protocol, interface, delta_rx, delta_tx in deltas:
+                db.session.execute(upsert(
+                    TrafficSample,
+                    {'resolution': resolution, 'bucket': bucket, 'client': client, 'protocol': protocol,
+                     'interface': interface, 'rx': delta_rx, 'tx': delta_tx},
+                    ('resolution', 'bucket', 'client', 'protocol', 'interface'),
+                    {'rx': TrafficSample.rx + delta_rx, 'tx': TrafficSample.tx + delta_tx}
+                ))
+
+        for resolution, _, retention in self.RETENTION:
+            TrafficSample.query.filter(TrafficSample.resolution == resolution,
+                                       TrafficSample.bucket < now - retention).delete(synchronize_session=False)
+        db.session.commit()
+        return len(readings)
+
+    def _acquire_leadership(self):
+        """Сборщик работает только в одном процессе, даже если воркеров несколько"""
+        os.makedirs(self.lock_dir, exist_ok=True)
+        handle = open(os.path.join(self.lock_dir, 'traffic-collector.lock'), 'a')
+        try:
+            fcntl.flock(handle, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except OSError:
+            handle.close()
+            return False
+        self._leader_handle = handle
+        return True
+
+    def start(self):
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='traffic-collector', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while not self._acquire_leadership():
+            time.sleep(self.interval)
+        while True:
+            try:
+                with app.app_context():
+                    self.collect()
+            except Exception as e:
+                print(f"Ошибка сбора статистики трафика: {str(e)}")
+            time.sleep(self.interval)
+
+    def get_client_summary(self, clients=None):
+        """Сводка по клиентам для таблиц на главной: протокол -> клиент -> показатели"""
+        summary = {'openvpn': {}, 'wireguard': {}}
+        query = ClientSession.query
+        if clients is not None:
+            query = query.filter(ClientSession.client.in_(clients))
+        for row in query.all():
+            item = summary[row.protocol].setdefault(row.client, {'rx': 0, 'tx': 0, 'last_handshake': None})
+            item['rx'] += row.rx_total or 0
+            item['tx'] += row.tx_total or 0
+            if row.last_handshake and (item['last_handshake'] or 0) < row.last_handshake:
+                item['last_handshake'] = row.last_handshake
+        return summary
+
+    def get_series(self, client, period):
+        resolution, window = {'hour': ('raw', 3600), 'day': ('1m', 86400), 'month': ('1h', 30 * 86400)}[period]
+        rows = db.session.query(TrafficSample.bucket, db.func.sum(TrafficSample.rx), db.func.sum(TrafficSample.tx)).filter(
+            TrafficSample.resolution == resolution,
+            TrafficSample.client == client,
+            TrafficSample.bucket >= time.time() - window
+        ).group_by(TrafficSample.bucket).order_by(TrafficSample.bucket).all()
+        return [{'timestamp': bucket, 'rx': rx, 'tx': tx} for bucket, rx, tx in rows]
+
+class OpenVPNClientManager:
+    """Выпуск и отзыв клиентских сертификатов OpenVPN.
+
+    Если PKI уже инициализирован, профили рендерятся на Python (все шесть вариантов
+    за один проход), иначе добавление выполняет client.sh (опция 1), который сам
+    инициализирует easy-rsa. При пакетном удалении все сертификаты отзываются подряд,
+    после чего CRL перегенерируется и копируется один раз.
+    """
+
+    PROFILE_DIRS = ('antizapret', 'antizapret-udp', 'antizapret-tcp', 'vpn', 'vpn-udp', 'vpn-tcp')
+    TEMPLATES_DIR = '/etc/openvpn/client/templates'
+
+    def __init__(self, executor, easyrsa_dir, client_dir, server_keys_dir, client_keys_dir, renderer):
+        self.executor = executor
+        self.easyrsa_dir = easyrsa_dir
+        self.client_dir = client_dir
+        self.server_keys_dir = server_keys_dir
+        self.client_keys_dir = client_keys_dir
+        self.renderer = renderer
+
+    def _easyrsa(self, args, on_line=None, env=None):
+        return self.executor.run_command([EASYRSA_BIN, '--batch', *args], on_line, cwd=self.easyrsa_dir, env=env)
+
+    def list_clients(self):
+        try:
+            names = os.listdir(os.path.join(self.easyrsa_dir, 'pki', 'issued'))
+        except FileNotFoundError:
+            return []
+        return sorted(name[:-len('.crt')] for name in names
+                      if name.endswith('.crt') and name != 'antizapret-server.crt')
+
+    def available(self):
+        """PKI и ключи сервера на месте - initEasyRSA из client.sh ничего бы не сделал"""
+        required = (
+            os.path.join(self.easyrsa_dir, 'pki', 'ca.crt'),
+            os.path.join(self.easyrsa_dir, 'pki', 'issued', 'antizapret-server.crt'),
+            os.path.join(self.easyrsa_dir, 'pki', 'private', 'antizapret-server.key'),
+            os.path.join(self.server_keys_dir, 'ca.crt'),
+            os.path.join(self.server_keys_dir, 'antizapret-server.crt'),
+            os.path.join(self.server_keys_dir, 'antizapret-server.key'),
+            os.path.join(self.server_keys_dir, 'crl.pem'),
+            self.TEMPLATES_DIR
+        )
+        return all(os.path.exists(path) for path in required)
+
+    @staticmethod
+    def grep_certificate(text):
+        """Аналог $(grep -A 999 'BEGIN CERTIFICATE' -- file)"""
+        lines = text.split('\n')
+        if lines and lines[-1] == '':
+            lines.pop()
+        selected = []
+        last_printed = -1
+        context_end = -1
+        for index, line in enumerate(lines):
+            if 'BEGIN CERTIFICATE' in line:
+                context_end = index + 999
+            elif index > context_end:
+                continue
+            if selected and index != last_printed + 1:
+                selected.append('--')
+            selected.append(line)
+            last_printed = index
+        return '\n'.join(selected).rstrip('\n')
+
+    def _copy_key(self, source, name):
+        with open(source, 'r') as file:
+            atomic_write(os.path.join(self.client_keys_dir, name), file.read())
+
+    def profile_paths(self, file_name, client_dir=None):
+        """Пары (шаблон, профиль) для шести вариантов профиля OpenVPN"""
+        paths = []
+        for directory in self.PROFILE_DIRS:
+            prefix, _, transport = directory.partition('-')
+            suffix = f'-{transport}' if transport else ''
+            paths.append((os.path.join(self.TEMPLATES_DIR, f'{directory}.conf'),
+                          os.path.join(client_dir or self.client_dir, 'openvpn', directory, f'{prefix}-{file_name}{suffix}.ovpn')))
+        return paths
+
+    def read_ca_cert(self):
+        with open(os.path.join(self.server_keys_dir, 'ca.crt'), 'r') as file:
+            return self.grep_certificate(file.read())
+
+    def client_variables(self, client_name, server_host, ca_cert=None, cert_expire=None):
+        """Переменные шаблонов клиента; ключи читаются из /etc/openvpn/client/keys"""
+        ca_cert = ca_cert if ca_cert is not None else self.read_ca_cert()
+        with open(os.path.join(self.client_keys_dir, f'{client_name}.crt'), 'r') as file:
+            client_cert = self.grep_certificate(file.read())
+        with open(os.path.join(self.client_keys_dir, f'{client_name}.key'), 'r') as file:
+            client_key = file.read().rstrip('\n')
+        if not ca_cert or not client_cert or not client_key:
+            raise subprocess.CalledProcessError(11, ['client.sh', '1', client_name], output='', stderr="Can't load client keys!")
+        return {
+            'CLIENT_NAME': client_name, 'CLIENT_CERT_EXPIRE': str(cert_expire or ''),
+            'SERVER_HOST': server_host, 'OPENVPN_HOST': server_host,
+            'FILE_NAME': get_profile_file_name(client_name, server_host),
+            'CA_CERT': ca_cert, 'CLIENT_CERT': client_cert, 'CLIENT_KEY': client_key
+        }
+
+    def ensure_client_keys(self, client_name):
+        """Копирует ключи клиента из PKI, если их нет в /etc/openvpn/client/keys"""
+        for source, name in ((os.path.join(self.easyrsa_dir, 'pki', 'issued', f'{client_name}.crt'), f'{client_name}.crt'),
+                             (os.path.join(self.easyrsa_dir, 'pki', 'private', f'{client_name}.key'), f'{client_name}.key')):
+            if not os.path.exists(os.path.join(self.client_keys_dir, name)):
+                self._copy_key(source, name)
+
+    def add_client(self, client_name, cert_expire=None, on_line=None, server_host=None):
+        """Аналог addOpenVPN из client.sh; возвращает сообщение о результате"""
+        emit = on_line or (lambda stream, line: None)
+        issued = os.path.join(self.easyrsa_dir, 'pki', 'issued', f'{client_name}.crt')
+        private = os.path.join(self.easyrsa_dir, 'pki', 'private', f'{client_name}.key')
+        if not os.path.exists(issued) or not os.path.exists(private):
+            self._easyrsa(['build-client-full', client_name, 'nopass'], on_line,
+                          env={'EASYRSA_CERT_EXPIRE': str(cert_expire or DEFAULT_CERT_EXPIRE)})
+            self._copy_key(issued, f'{client_name}.crt')
+            self._copy_key(private, f'{client_name}.key')
+        else:
+            emit('stdout', "A client with the specified name was already created, please choose another name")
+
+        self.ensure_client_keys(client_name)
+
+        server_host = server_host if server_host is not None else get_server_host('OPENVPN_HOST')
+        variables = self.client_variables(client_name, server_host, cert_expire=cert_expire)
+        for template_path, output_path in self.profile_paths(variables['FILE_NAME']):
+            os.makedirs(os.path.dirname(output_path), exist_ok=True)
+            self.renderer.render_to(template_path, output_path, variables)
+
+        message = f"OpenVPN profile files (re)created for client '{client_name}' at {os.path.join(self.client_dir, 'openvpn')}"
+        emit('stdout', message)
+        return message
+
+    def run_option(self, option, client_name, cert_expire=None, on_line=None):
+        """Выполняет опцию 1 client.sh и возвращает (stdout, stderr)"""
+        output = []
+
+        def emit(stream, line):
+            output.append(line)
+            if on_line is not None:
+                on_line(stream, line)
+
+        if option != '1':
+            raise ValueError("Некорректный параметр option")
+        emit('stdout', f"OpenVPN - Add client {client_name} {cert_expire or ''}")
+        self.add_client(client_name, cert_expire, emit)
+        return '\n'.join(output) + '\n', ''
+
+    def add_clients(self, clients, on_line=None):
+        """clients - список (имя, срок); возвращает {имя: (успех, сообщение)}"""
+        results = {}
+        native = self.available()
+        server_host = get_server_host('OPENVPN_HOST') if native else None
+        for client_name, cert_expire in clients:
+            try:
+                if native:
+                    results[client_name] = (True, self.add_client(client_name, cert_expire, on_line, server_host))
+                else:
+                    command = self.executor.build_command('1', client_name, cert_expire)
+                    stdout, _ = self.executor.run_command(command, on_line)
+                    results[client_name] = (True, stdout.strip().splitlines()[-1] if stdout.strip() else '')
+            except subprocess.CalledProcessError as e:
+                results[client_name] = (False, (e.stderr or e.stdout or '').strip() or f"Код завершения {e.returncode}")
+            except OSError as e:
+                results[client_name] = (False, str(e))
+        return results
+
+    def delete_clients(self, client_names, on_line=None):
+        results = {}
+        revoked = []
+        for client_name in client_names:
+            if not os.path.exists(os.path.join(self.easyrsa_dir, 'pki', 'issued', f'{client_name}.crt')):
+                results[client_name] = (False, f"Failed to delete client '{client_name}', please check if the client exists")
+                continue
+            try:
+                self._easyrsa(['revoke', client_name], on_line)
+            except subprocess.CalledProcessError as e:
+                results[client_name] = (False, (e.stderr or e.stdout or '').strip() or f"Код завершения {e.returncode}")
+                continue
+            revoked.append(client_name)
+
+        if revoked:
+            # Один gen-crl на всю пачку вместо вызова на каждого клиента
+            self._easyrsa(['gen-crl'], on_line, env={'EASYRSA_CRL_DAYS': '3650'})
+            crl_path = os.path.join(self.easyrsa_dir, 'pki', 'crl.pem')
+            os.chmod(crl_path, 0o644)
+            with open(crl_path, 'r') as file:
+                atomic_write(os.path.join(self.server_keys_dir, 'crl.pem'), file.read(), mode=0o644)
+
+        server_host = get_server_host('OPENVPN_HOST')
+        for client_name in revoked:
+            for _, path in self.profile_paths(get_profile_file_name(client_name, server_host)):
+                if os.path.exists(path):
+                    os.remove(path)
+            for extension in ('crt', 'key'):
+                path = os.path.join(self.client_keys_dir, f'{client_name}.{extension}')
+                if os.path.exists(path):
+                    os.remove(path)
+            results[client_name] = (True, f"OpenVPN client '{client_name}' successfully deleted")
+            if on_line is not None:
+                on_line('stdout', results[client_name][1])
+        return results
+
+def swap_directories(path_a, path_b):
+    """Атомарно меняет каталоги местами (renameat2 с RENAME_EXCHANGE), иначе - тремя rename"""
+    renameat2 = getattr(ctypes.CDLL(None, use_errno=True), 'renameat2', None)
+    if renameat2 is not None:
+        at_fdcwd, rename_exchange = -100, 2
+        if renameat2(at_fdcwd, os.fsencode(path_a), at_fdcwd, os.fsencode(path_b), rename_exchange) == 0:
+            return
+        if ctypes.get_errno() not in (errno.EINVAL, errno.ENOSYS):
+            raise OSError(ctypes.get_errno(), os.strerror(ctypes.get_errno()), path_b)
+    temporary_path = path_b + '.swap'
+    os.rename(path_b, temporary_path)
+    os.rename(path_a, path_b)
+    os.rename(temporary_path, path_a)
+
+class ProfileRecreator:
+    """Пересоздание профилей всех клиентов (опция 7 client.sh).
+
+    Список клиентов и общие данные (CA, ключи сервера, адрес) собираются один раз,
+    профили рендерятся пулом процессов в промежуточный каталог, который затем
+    атомарно подменяет /root/antizapret/client - таблицы на главной странице
+    не пустеют на время пересоздания.
+    """
+
+    BATCH_SIZE = 25
+
+    def __init__(self, openvpn_manager, wireguard_manager, client_dir, workers):
+        self.openvpn_manager = openvpn_manager
+        self.wireguard_manager = wireguard_manager
+        self.client_dir = client_dir
+        self.workers = workers
+
+    def available(self):
+        """Как и recreate() в client.sh, без инициализации PKI и ключей WireGuard тут не обойтись"""
+        wireguard_ready = all(os.path.exists(os.path.join(self.wireguard_manager.wireguard_dir, name))
+                              for name in ['key'] + [f'{interface}.conf' for interface in self.wireguard_manager.interfaces])
+        return self.openvpn_manager.available() and self.wireguard_manager.available() and wireguard_ready
+
+    def _collect(self, staging_dir, emit):
+        tasks = []
+        openvpn_host = get_server_host('OPENVPN_HOST')
+        ca_cert = self.openvpn_manager.read_ca_cert()
+        for client_name in self.openvpn_manager.list_clients():
+            if not CLIENT_NAME_RE.match(client_name):
+                emit('stdout', f"OpenVPN client name '{client_name}' is invalid! No profile files recreated")
+                continue
+            try:
+                self.openvpn_manager.ensure_client_keys(client_name)
+                variables = self.openvpn_manager.client_variables(client_name, openvpn_host, ca_cert=ca_cert)
+            except (OSError, subprocess.CalledProcessError) as e:
+                emit('stderr', f"OpenVPN client '{client_name}': {getattr(e, 'stderr', None) or e}")
+                continue
+            tasks.append(('OpenVPN', client_name, self.openvpn_manager.profile_paths(variables['FILE_NAME'], staging_dir), variables))
+
+        configs = self.wireguard_manager.load()
+        base_variables = self.wireguard_manager.base_variables()
+        incomplete = []
+        for client_name in sorted(set().union(*(config.peers for config in configs.values()))):
+            if not CLIENT_NAME_RE.match(client_name):
+                emit('stdout', f"WireGuard/AmneziaWG client name '{client_name}' is invalid! No profile files recreated")
+                continue
+            if not all(client_name in config.peers for config in configs.values()):
+                # Клиента нет в одном из интерфейсов - его добавит WireGuardPeerManager после подмены
+                incomplete.append(client_name)
+                continue
+            for interface, config in configs.items():
+                variables = self.wireguard_manager.client_variables(base_variables, config, client_name)
+                tasks.append(('WireGuard/AmneziaWG', client_name,
+                              self.wireguard_manager.profile_paths(interface, variables['FILE_NAME'], staging_dir), variables))
+        return tasks, incomplete
+
+    def _render(self, tasks, emit):
+        batches = [tasks[index:index + self.BATCH_SIZE] for index in range(0, len(tasks), self.BATCH_SIZE)]
+        done = 0
+        failed = 0
+        reported = set()
+
+        def report(results):
+            nonlocal done, failed
+            for label, client_name, error in results:
+                done += 1
+                if error:
+                    failed += 1
+                    emit('stderr', f"{label} client '{client_name}': {error}")
+                elif (label, client_name) not in reported:
+                    reported.add((label, client_name))
+                    emit('stdout', f"{label} profile files recreated for client '{client_name}'")
+            emit('stdout', f"Прогресс: {done}/{len(tasks)}")
+
+        if self.workers <= 1 or len(batches) <= 1:
+            for batch in batches:
+                report(render_profile_batch(batch))
+            return failed
+
+        # Не fork: воркер gunicorn многопоточный, и дочерний процесс мог бы унаследовать
+        # захваченные блокировки (logging, SQLite). Процессы forkserver импортируют
+        # profile_render и скрипт запуска (gunicorn), но не приложение и не БД
+        context = multiprocessing.get_context('forkserver')
+        context.set_forkserver_preload(['profile_render'])
+        with ProcessPoolExecutor(max_workers=min(self.workers, len(batches)), mp_context=context) as executor:
+            for future in as_completed([executor.submit(render_profile_batch, batch) for batch in batches]):
+                report(future.result())
+        return failed
+
+    def recreate(self, on_line=None):
+        emit = on_line or (lambda stream, line: None)
+        parent_dir = os.path.dirname(self.client_dir)
+        os.makedirs(parent_dir, exist_ok=True)
+        staging_dir = tempfile.mkdtemp(dir=parent_dir, prefix='.client-staging-')
+        try:
+            os.chmod(staging_dir, stat.S_IMODE(os.stat(self.client_dir).st_mode) if os.path.isdir(self.client_dir) else 0o755)
+            for directory in [os.path.join('openvpn', name) for name in self.openvpn_manager.PROFILE_DIRS] + \
+                    [os.path.join(kind, interface) for kind, _ in self.wireguard_manager.PROFILE_KINDS
+                     for interface in self.wireguard_manager.interfaces]:
+                os.makedirs(os.path.join(staging_dir, directory), exist_ok=True)
+
+            tasks, incomplete = self._collect(staging_dir, emit)
+            emit('stdout', f"Профилей к созданию: {len(tasks)}, процессов: {self.workers}")
+            failed = self._render(tasks, emit)
+
+            if os.path.isdir(self.client_dir):
+                swap_directories(staging_dir, self.client_dir)
+                shutil.rmtree(staging_dir)
+            else:
+                os.rename(staging_dir, self.client_dir)
+        except BaseException:
+            shutil.rmtree(staging_dir, ignore_errors=True)
+            raise
+
+        if incomplete:
+            self.wireguard_manager.add_clients(incomplete, emit)
+        if failed:
+            raise RuntimeError(f"Не удалось создать профили: {failed}")
+
+    def run_option(self, option, client_name, on_line=None):
+        """Выполняет опцию 7 client.sh и возвращает (stdout, stderr)"""
+        output = []
+
+        def emit(stream, line):
+            output.append(line)
+            if on_line is not None:
+                on_line(stream, line)
+
+        if option != '7':
+            raise ValueError("Некорректный параметр option")
+        emit('stdout', "(Re)create clients profile files")
+        emit('stdout', '')
+        self.recreate(emit)
+        return '\n'.join(output) + '\n', ''
+
+class ResourceLockManager:
+    """Межпроцессные блокировки ресурсов (PKI, конфиги WireGuard) на flock"""
+
+    def __init__(self, lock_dir):
+        self.lock_dir = lock_dir
+
+    @contextmanager
+    def acquire(self, resources, blocking=True):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        handles = []
+        try:
+            # Фиксированный порядок захвата исключает взаимные блокировки
+            for resource in sorted(set(resources)):
+                handle = open(os.path.join(self.lock_dir, f'{resource}.lock'), 'a')
+                handles.append(handle)
+                flags = fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB
+                fcntl.flock(handle, flags)
+            yield
+        finally:
+            for handle in reversed(handles):
+                fcntl.flock(handle, fcntl.LOCK_UN)
+                handle.close()
+
+class JobOutput:
+    """Кольцевой буфер строк вывода задачи для потоковой передачи клиентам"""
+
+    def __init__(self, max_lines):
+        self._lines = deque(maxlen=max_lines)
+        self._condition = threading.Condition()
+        self._next_seq = 1
+        self.closed = False
+
+    def append(self, stream, line):
+        with self._condition:
+            self._lines.append((self._next_seq, stream, line))
+            self._next_seq += 1
+            self._condition.notify_all()
+
+    def close(self):
+        with self._condition:
+            self.closed = True
+            self._condition.notify_all()
+
+    def read_since(self, seq, timeout):
+        """Возвращает (строки с номером больше seq, число пропущенных строк, закрыт ли буфер).
+
+        Подписчик никогда не задерживает запись: если он отстал больше чем на размер
+        буфера, старые строки для него просто пропускаются.
+        """
+        with self._condition:
+            if self._next_seq - 1 <= seq and not self.closed:
+                self._condition.wait(timeout)
+            lines = [item for item in self._lines if item[0] > seq]
+            skipped = lines[0][0] - seq - 1 if lines else 0
+            return lines, skipped, self.closed and (not lines or lines[-1][0] == self._next_seq - 1)
+
+class AuditLogger:
+    """Запись журнала действий через очередь в памяти.
+
+    Запрос только кладёт событие в очередь, а фоновый поток пишет накопленные
+    события одной транзакцией раз в AUDIT_FLUSH_INTERVAL секунд или по
+    достижении batch_size - ни один запрос не ждёт fsync базы.
+    """
+
+    def __init__(self, flush_interval=None, batch_size=500, max_queue=10000):
+        self.flush_interval = flush_interval or float(os.getenv('AUDIT_FLUSH_INTERVAL', '1'))
+        self.batch_size = batch_size
+        self._queue = queue.Queue(maxsize=max_queue)
+        self._lock = threading.Lock()
+        self._flush_lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+        self.written = 0
+        self.dropped = 0
+
+    def start(self):
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive() and self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='audit-log', daemon=True)
+            self._thread.start()
+
+    def record(self, action, target=None, details=None, username=None):
+        event_row = {
+            'timestamp': time.time(),
+            'username': username,
+            'remote_addr': None,
+            'action': action,
+            'target': str(target)[:255] if target is not None else None,
+            'details': json.dumps(details, ensure_ascii=False) if details is not None else None
+        }
+        if has_request_context():
+            event_row['username'] = username or session.get('username')
+            event_row['remote_addr'] = request.remote_addr
+        try:
+            self._queue.put_nowait(event_row)
+        except queue.Full:
+            self.dropped += 1
+            return
+        self.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.flush_interval)
+            try:
+                self.flush()
+            except Exception as e:
+                print(f"Ошибка записи журнала действий: {str(e)}")
+
+    def flush(self):
+        """Записывает всё, что накопилось в очереди; возвращает число записанных событий"""
+        total = 0
+        with self._flush_lock:
+            while True:
+                rows = []
+                while len(rows) < self.batch_size:
+                    try:
+                        rows.append(self._queue.get_nowait())
+                    except queue.Empty:
+                        break
+                if not rows:
+                    return total
+                with app.app_context():
+                    db.session.execute(insert(AuditLog), rows)
+                    db.session.commit()
+                total += len(rows)
+                self.written += len(rows)
+
+    def get_recent(self, limit=100, action=None, before=None):
+        query = AuditLog.query
+        if action:
+            query = query.filter(AuditLog.action == action)
+        if before:
+            query = query.filter(AuditLog.id < before)
+        return query.order_by(AuditLog.id.desc()).limit(limit).all()
+
+    def prune(self, keep_days):
+        AuditLog.query.filter(AuditLog.timestamp < time.time() - keep_days * 86400).delete(synchronize_session=False)
+        db.session.commit()
+
+    def get_stats(self):
+        return {'queued': self._queue.qsize(), 'written': self.written, 'dropped': self.dropped}
+
+class MetricsRegistry:
+    """Счётчики и гистограммы в текстовом формате Prometheus.
+
+    Каждый воркер gunicorn считает свои значения и периодически сбрасывает их
+    снимок в instance/metrics/<pid>.json; при выдаче /metrics снимки живых
+    воркеров суммируются, поэтому ответ не зависит от того, какой воркер его отдал.
+    """
+
+    REQUEST_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+    RENDER_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5)
+    SUBPROCESS_BUCKETS = (0.1, 0.5, 1, 2.5, 5, 10, 30, 60, 120, 300, 600)
+
+    def __init__(self, prefix, snapshot_dir, dump_interval=5):
+        self.prefix = prefix
+        self.snapshot_dir = snapshot_dir
+        self.dump_interval = dump_interval
+        self._metrics = {}
+        self._values = {}
+        self._lock = threading.Lock()
+        self._thread = None
+        self._pid = None
+
+    def counter(self, name, description):
+        self._metrics[name] = ('counter', description, None)
+
+    def histogram(self, name, description, buckets):
+        self._metrics[name] = ('histogram', description, tuple(buckets))
+
+    @staticmethod
+    def _key(labels):
+        return json.dumps(sorted(labels.items()))
+
+    def inc(self, name, value=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            values[key] = values.get(key, 0) + value
+        self.start()
+
+    def observe(self, name, value, **labels):
+        buckets = self._metrics[name][2]
+        key = self._key(labels)
+        with self._lock:
+            values = self._values.setdefault(name, {})
+            # Счётчики по корзинам (не накопительные), сумма и количество
+            item = values.get(key)
+            if item is None:
+                item = values[key] = [0] * (len(buckets) + 3)
+            item[bisect.bisect_left(buckets, value)] += 1
+            item[-2] += value
+            item[-1] += 1
+        self.start()
+
+    @contextmanager
+    def timer(self, name, **labels):
+        started = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.observe(name, time.perf_counter() - started, **labels)
+
+    def snapshot(self):
+        with self._lock:
+            return {name: {key: list(value) if isinstance(value, list) else value for key, value in values.items()}
+                    for name, values in self._values.items()}
+
+    def start(self):
+        if self._pid == os.getpid() and self._thread is not None:
+            return
+        with self._lock:
+            if self._pid == os.getpid() and self._thread is not None:
+                return
+            self._pid = os.getpid()
+            self._thread = threading.Thread(target=self._run, name='metrics', daemon=True)
+            self._thread.start()
+
+    def _run(self):
+        while True:
+            time.sleep(self.dump_interval)
+            try:
+                self.dump()
+            except OSError as e:
+                print(f"Ошибка сохранения метрик: {str(e)}")
+
+    def dump(self):
+        os.makedirs(self.snapshot_dir, exist_ok=True)
+        atomic_write(os.path.join(self.snapshot_dir, f'{os.getpid()}.json'), json.dumps(self.snapshot()))
+
+    def _collect(self):
+        """Сумма снимков всех живых воркеров (свой берётся из памяти)"""
+        merged = self.snapshot()
+        for path in glob.glob(os.path.join(self.snapshot_dir, '*.json')):
+            try:
+                pid = int(os.path.basename(path)[:-len('.json')])
+            except ValueError:
+                continue
+            if pid == os.getpid():
+                continue
+            if not JobManager._pid_alive(pid):
+                try:
+                    os.remove(path)
+                except OSError:
+                    pass
+                continue
+            try:
+                with open(path, 'r') as f:
+                    snapshot = json.load(f)
+            except (OSError, ValueError):
+                continue
+            for name, values in snapshot.items():
+                target = merged.setdefault(name, {})
+                for key, value in values.items():
+                    if isinstance(value, list):
+                        current = target.setdefault(key, [0] * len(value))
+                        target[key] = [a + b for a, b in zip(current, value)]
+                    else:
+                        target[key] = target.get(key, 0) + value
+        return merged
+
+    @staticmethod
+    def _format_labels(labels, extra=()):
+        items = list(labels) + list(extra)
+        if not items:
+            return ''
+        escaped = (str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n') for _, value in items)
+        return '{' + ','.join(f'{name}="{value}"' for (name, _), value in zip(items, escaped)) + '}'
+
+    @staticmethod
+    def _format_value(value):
+        return repr(float(value)) if isinstance(value, float) else str(value)
+
+    def render(self):
+        collected = self._collect()
+        lines = []
+        for name, (kind, description, buckets) in self._metrics.items():
+            full_name = f'{self.prefix}_{name}'
+            lines.append(f'# HELP {full_name} {description}')
+            lines.append(f'# TYPE {full_name} {kind}')
+            for key, value in sorted(collected.get(name, {}).items()):
+                labels = json.loads(key)
+                if kind == 'counter':
+                    lines.append(f'{full_name}{self._format_labels(labels)} {self._format_value(value)}')
+                    continue
+                cumulative = 0
+                for bound, count in zip(list(buckets) + ['+Inf'], value[:-2]):
+                    cumulative += count
+                    lines.append(f'{full_name}_bucket{self._format_labels(labels, [("le", bound)])} {cumulative}')
+                lines.append(f'{full_name}_sum{self._format_labels(labels)} {self._format_value(value[-2])}')
+                lines.append(f'{full_name}_count{self._format_labels(labels)} {value[-1]}')
+        return '\n'.join(lines) + '\n'
+
+class RequestProfiler:
+    """Профилирование следующих N запросов через cProfile.
+
+    Счётчик оставшихся запросов хранится в файле, поэтому включение действует на
+    все воркеры. Пока профилирование выключено, на запрос приходится один stat().
+    """
+
+    NAME_RE = re.compile(r'^[0-9A-Za-z._-]+\.prof$')
+
+    def __init__(self, state_path, output_dir, keep):
+        self.state_path = state_path
+        self.output_dir = output_dir
+        self.keep = keep
+        self._lock = threading.Lock()
+        self._cached = (None, 0)
+
+    def _read_remaining(self):
+        try:
+            with open(self.state_path, 'r') as f:
+                return int(json.load(f).get('remaining', 0))
+        except (OSError, ValueError):
+            return 0
+
+    @contextmanager
+    def _state_lock(self):
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        with self._lock, open(self.state_path + '.lock', 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def enable(self, count):
+        with self._state_lock():
+            atomic_write(self.state_path, json.dumps({'remaining': count, 'enabled_at': time.time()}))
+
+    def get_remaining(self):
+        return self._read_remaining()
+
+    def claim(self):
+        """True, если текущий запрос нужно профилировать"""
+        try:
+            mtime = os.stat(self.state_path).st_mtime_ns
+        except OSError:
+            return False
+        if self._cached[0] == mtime and self._cached[1] <= 0:
+            return False
+        with self._state_lock():
+            remaining = self._read_remaining()
+            if remaining > 0:
+                atomic_write(self.state_path, json.dumps({'remaining': remaining - 1}))
+            self._cached = (os.stat(self.state_path).st_mtime_ns, remaining - 1)
+            return remaining > 0
+
+    @staticmethod
+    def start():
+        profile = cProfile.Profile()
+        try:
+            profile.enable()
+        except ValueError:
+            # Уже профилируется другой запрос в этом потоке
+            return None
+        return profile
+
+    def finish(self, profile, route):
+        profile.disable()
+        os.makedirs(self.output_dir, exist_ok=True)
+        slug = re.sub(r'[^0-9A-Za-z]+', '_', route).strip('_') or 'root'
+        name = f"{time.strftime('%Y%m%d-%H%M%S')}-{slug}-{os.getpid()}-{uuid.uuid4().hex[:6]}.prof"
+        profile.dump_stats(os.path.join(self.output_dir, name))
+        for stale in self.list_profiles()[self.keep:]:
+            try:
+                os.remove(os.path.join(self.output_dir, stale['name']))
+            except OSError:
+                pass
+
+    def list_profiles(self):
+        """Сохранённые профили, новые первыми"""
+        profiles = []
+        for path in glob.glob(os.path.join(self.output_dir, '*.prof')):
+            try:
+                file_stat = os.stat(path)
+            except OSError:
+                continue
+            profiles.append({'name': os.path.basename(path), 'size': file_stat.st_size, 'created_at': file_stat.st_mtime})
+        return sorted(profiles, key=lambda item: item['created_at'], reverse=True)
+
+class JobManager:
+    FINISHED_STATUSES = ('succeeded', 'failed')
+    # Как часто задача, ресурсы которой заняты, пытается захватить их снова
+    LOCK_RETRY_INTERVAL = 1
+
+    def __init__(self, max_workers, lock_manager):
+        self.max_workers = max_workers
+        self.lock_manager = lock_manager
+        self._handlers = {}
+        self._executor = None
+        self._executor_pid = None
+        self._lock = threading.Lock()
+        self._live = {}
+
+    def register(self, kind, handler, resources):
+        """handler(params, on_line) -> (stdout, stderr[, result]); resources(params) -> список ресурсов"""
+        self._handlers[kind] = (handler, resources)
+
+    def _get_executor(self):
+        with self._lock:
+            # Потоки пула не переживают fork воркера gunicorn
+            if self._executor is None or self._executor_pid != os.getpid():
+                self._executor = ThreadPoolExecutor(max_workers=self.max_workers, thread_name_prefix='job')
+                self._executor_pid = os.getpid()
+            return self._executor
+
+    def shutdown(self):
+        """Дожидается запущенных задач перед остановкой процесса"""
+        with self._lock:
+            executor = self._executor if self._executor_pid == os.getpid() else None
+        if executor is not None:
+            executor.shutdown(wait=True)
+
+    def submit(self, kind, params, username=None, scheduled_at=None):
+        if kind not in self._handlers:
+            raise ValueError(f"Неизвестный тип задачи: {kind}")
+
+        job = Job(
+            id=uuid.uuid4().hex,
+            kind=kind,
+            params=json.dumps(params),
+            status='queued',
+            username=username,
+            pid=os.getpid(),
+            created_at=time.time(),
+            scheduled_at=scheduled_at
+        )
+        db.session.add(job)
+        db.session.commit()
+        with self._lock:
+            self._live[job.id] = JobOutput(JOB_OUTPUT_LINES)
+        self._dispatch(job.id, (scheduled_at or 0) - time.time())
+        return job.id
+
+    def _dispatch(self, job_id, delay=0):
+        """Передаёт задачу в пул сразу или по таймеру - ожидание не занимает поток пула"""
+        if delay <= 0:
+            self._get_executor().submit(self._run, job_id)
+            return
+        timer = threading.Timer(delay, self._dispatch, (job_id,))
+        timer.daemon = True
+        timer.start()
+
+    def _update(self, job_id, **fields):
+        job = db.session.get(Job, job_id)
+        for key, value in fields.items():
+            setattr(job, key, value)
+        db.session.commit()
+        return job
+
+    def _run(self, job_id):
+        with app.app_context():
+            job = db.session.get(Job, job_id)
+            if job is None or job.status != 'queued':
+                return
+            # Время запуска может быть отодвинуто, пока задача ждёт (см. DoallScheduler)
+            if job.scheduled_at and job.scheduled_at > time.time():
+                self._dispatch(job_id, job.scheduled_at - time.time())
+                return
+            params = json.loads(job.params)
+            handler, resources = self._handlers[job.kind]
+            with ExitStack() as stack:
+                try:
+                    stack.enter_context(self.lock_manager.acquire(resources(params), blocking=False))
+                except BlockingIOError:
+                    # Ресурс занят другой задачей: задача ждёт вне пула, не блокируя задачи с другими ресурсами
+                    self._dispatch(job_id, self.LOCK_RETRY_INTERVAL)
+                    return
+                self._execute(job_id, params, handler)
+
+    def _execute(self, job_id, params, handler):
+        with self._lock:
+            output = self._live.setdefault(job_id, JobOutput(JOB_OUTPUT_LINES))
+        stdout_tail = deque(maxlen=JOB_OUTPUT_LINES)
+        stdout_count = 0
+        last_flush = time.monotonic()
+
+        def on_line(stream, line):
+            nonlocal last_flush, stdout_count
+            output.append(stream, line)
+            if stream != 'stdout':
+                return
+            stdout_tail.append(line)
+            stdout_count += 1
+            # Периодически сохраняем вывод в БД для других процессов
+            if time.monotonic() - last_flush >= 2:
+                last_flush = time.monotonic()
+                self._update(job_id, stdout='\n'.join(stdout_tail) + '\n', stdout_offset=stdout_count - len(stdout_tail))
+
+        def final_offset(stdout):
+            # Итоговый stdout - хвост того же вывода, что прошёл через on_line
+            return max(0, stdout_count - len((stdout or '').splitlines()))
+
+        try:
+            self._update(job_id, status='running', started_at=time.time(), pid=os.getpid())
+            stdout, stderr, *result = handler(params, on_line)
+            self._update(job_id, status='succeeded', exit_code=0, stdout=stdout or '', stdout_offset=final_offset(stdout),
+                         stderr=stderr or '', result=json.dumps(result[0]) if result else None,
+                         message="Операция выполнена успешно.", finished_at=time.time())
+        except subprocess.CalledProcessError as e:
+            self._update(job_id, status='failed', exit_code=e.returncode, stdout=e.stdout or '',
+                         stdout_offset=final_offset(e.stdout), stderr=e.stderr or '',
+                         message=f"Ошибка выполнения скрипта: {e.stderr}", finished_at=time.time())
+        except Exception as e:
+            db.session.rollback()
+            self._update(job_id, status='failed', message=f"Ошибка: {str(e)}", finished_at=time.time())
+        finally:
+            output.close()
+            with self._lock:
+                self._live.pop(job_id, None)
+
+    def get_live_output(self, job_id):
+        with self._lock:
+            return self._live.get(job_id)
+
+    def get(self, job_id):
+        return db.session.get(Job, job_id)
+
+    def list_recent(self, limit=50):
+        return Job.query.order_by(Job.created_at.desc()).limit(limit).all()
+
+    @staticmethod
+    def _pid_alive(pid):
+        if not pid or pid == os.getpid():
+            return False
+        try:
+            os.kill(pid, 0)
+        except ProcessLookupError:
+            return False
+        except PermissionError:
+            pass
+        return True
+
+    def is_owner_alive(self, job):
+        """Жив ли процесс, который выполнит задачу (создал её или уже выполняет)"""
+        return job.pid == os.getpid() or self._pid_alive(job.pid)
+
+    def recover(self, keep_days=30):
+        """Помечает прерванными задачи, процесс которых уже не существует"""
+        for job in Job.query.filter(Job.status.notin_(self.FINISHED_STATUSES)).all():
+            if not self._pid_alive(job.pid):
+                job.status = 'failed'
+                job.message = "Задача прервана перезапуском сервиса."
+                job.finished_at = time.time()
+        Job.query.filter(Job.status.in_(self.FINISHED_STATUSES),
+                         Job.finished_at < time.time() - keep_days * 86400).delete(synchronize_session=False)
+        db.session.commit()
+
+class DoallScheduler:
+    """Запуски doall.sh после изменения списков.
+
+    Запросы, пришедшие в течение DOALL_DEBOUNCE секунд, объединяются в одну
+    задачу: пока задача doall стоит в очереди, новые запросы лишь отодвигают её
+    старт. Одновременно выполняется не больше одного doall.sh (блокировка
+    antizapret-config) и ждёт не больше одного следующего запуска. Перед запуском
+    сравнивается отпечаток содержимого списков с последним успешным запуском -
+    если ничего не изменилось, doall.sh не выполняется.
+    """
+
+    def __init__(self, job_manager, file_editor, state_path, lock_dir, debounce):
+        self.job_manager = job_manager
+        self.file_editor = file_editor
+        self.state_path = state_path
+        self.lock_dir = lock_dir
+        self.debounce = debounce
+
+    def fingerprint(self):
+        digest = hashlib.sha256()
+        for file_type in sorted(self.file_editor.files):
+            digest.update(file_type.encode())
+            digest.update(hashlib.sha256(self.file_editor._read(file_type).encode('utf-8')).digest())
+        return digest.hexdigest()
+
+    @contextmanager
+    def _lock(self):
+        os.makedirs(self.lock_dir, exist_ok=True)
+        with open(os.path.join(self.lock_dir, 'doall-scheduler.lock'), 'w') as lock_file:
+            fcntl.flock(lock_file, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                fcntl.flock(lock_file, fcntl.LOCK_UN)
+
+    def get_state(self):
+        try:
+            with open(self.state_path, 'r', encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return {}
+
+    def _save_state(self, **fields):
+        state = self.get_state()
+        state.update(fields)
+        os.makedirs(os.path.dirname(self.state_path), exist_ok=True)
+        atomic_write(self.state_path, json.dumps(state, ensure_ascii=False))
+
+    def _pending_job(self):
+        """Ожидающая задача doall, процесс-владелец которой ещё жив.
+
+        Отложенный запуск держит таймер процесса, создавшего задачу: если воркер
+        перезапущен или убит, задача так и осталась бы в очереди, а новые запросы
+        лишь отодвигали бы её старт. Такие задачи помечаются прерванными.
+        """
+        orphaned = False
+        pending = None
+        for job in Job.query.filter_by(kind='doall', status='queued').order_by(Job.created_at):
+            if self.job_manager.is_owner_alive(job):
+                pending = job
+                break
+            job.status = 'failed'
+            job.message = "Задача прервана: процесс, который её запланировал, завершился."
+            job.finished_at = time.time()
+            orphaned = True
+        if orphaned:
+            db.session.commit()
+        return pending
+
+    def request(self, username=None, force=False):
+        """Ставит запуск doall.sh в очередь или присоединяет запрос к ожидающему; возвращает id задачи"""
+        scheduled_at = time.time() + self.debounce
+        with self._lock():
+            job = self._pending_job()
+            if job is None:
+                return self.job_manager.submit('doall', {'force': force}, username=username,
+                                               scheduled_at=scheduled_at)
+            params = json.loads(job.params)
+            params['force'] = params.get('force', False) or force
+            params['coalesced'] = params.get('coalesced', 0) + 1
+            job.params = json.dumps(params)
+            job.scheduled_at = max(job.scheduled_at or 0, scheduled_at)
+            db.session.commit()
+            return job.id
+
+    def run(self, params, on_line):
+        """Обработчик задачи doall: выполняется под блокировкой antizapret-config"""
+        fingerprint = self.fingerprint()
+        state = self.get_state()
+        if not params.get('force') and state.get('fingerprint') == fingerprint:
+            message = "Списки не изменились с последнего запуска, doall.sh пропущен."
+            on_line('stdout', message)
+            self._save_state(skipped=state.get('skipped', 0) + 1, last_skipped_at=time.time())
+            return message + '\n', '', {'skipped': True}
+
+        started_at = time.time()
+        try:
+            stdout, stderr = script_executor.run_doall(on_line=on_line)
+        except Exception as e:
+            message = e.stderr if isinstance(e, subprocess.CalledProcessError) else str(e)
+            self._save_state(last_run={'started_at': started_at, 'duration': time.time() - started_at,
+                                       'success': False, 'message': (message or '').strip()[-500:]})
+            raise
+        duration = time.time() - started_at
+        self._save_state(fingerprint=fingerprint,
+                         last_run={'started_at': started_at, 'duration': duration, 'success': True, 'message': None})
+        return stdout, stderr, {'skipped': False, 'duration': duration}
+
+    def get_status(self):
+        state = self.get_state()
+        running = Job.query.filter_by(kind='doall', status='running').first()
+        pending = self._pending_job()
+        return {
+            'last_run': state.get('last_run'),
+            'skipped': state.get('skipped', 0),
+            'last_skipped_at': state.get('last_skipped_at'),
+            'running': running.id if running else None,
+            'pending': pending.id if pending else None,
+            'pending_at': pending.scheduled_at if pending else None,
+            'debounce': self.debounce
+        }
+
+def get_download_name(file_path):
+    """Имя файла при скачивании: `клиент-AZ.ovpn`, `клиент.conf` и т.п."""
+    basename = os.path.basename(file_path)
+
+    name_parts = basename.split('-')
+    extension = basename.split('.')[-1]
+    vpn_type = '-AZ' if name_parts[0] == 'antizapret' else ''
+
+    if extension == 'ovpn':
+        client_name = '-'.join(name_parts[1:-1])
+        return f"{client_name}{vpn_type}.{extension}"
+    elif extension == 'conf':
+        client_name = '-'.join(name_parts[1:-2])[:12 if vpn_type == '-AZ' else 15]
+        return f"{client_name}{vpn_type}.{extension}"
+    return basename
+
+class ZipStream(io.RawIOBase):
+    """Несмещаемый поток для zipfile и tarfile: записанные байты забираются через drain()"""
+
+    def __init__(self):
+        super().__init__()
+        self._chunks = []
+
+    def writable(self):
+        return True
+
+    def write(self, data):
+        self._chunks.append(bytes(data))
+        return len(data)
+
+    def drain(self):
+        data = b''.join(self._chunks)
+        self._chunks = []
+        return data
+
+class ProfileBundler:
+    """Архив со всеми профилями клиента, формируемый на лету.
+
+    Файлы ищутся по имени в известных каталогах профилей (без обхода дерева),
+    архив отдаётся частями по мере сжатия и целиком в памяти не собирается.
+    """
+
+    CHUNK_SIZE = 64 * 1024
+
+    def __init__(self, client_dir, openvpn_dirs, wireguard_kinds, interfaces, qr_generator):
+        self.client_dir = client_dir
+        self.openvpn_dirs = openvpn_dirs
+        self.wireguard_kinds = wireguard_kinds
+        self.interfaces = interfaces
+        self.qr_generator = qr_generator
+
+    @staticmethod
+    def _find(directory, prefix, suffix):
+        try:
+            with os.scandir(directory) as entries:
+                return sorted(entry.path for entry in entries
+                              if entry.is_file() and entry.name.startswith(prefix) and entry.name.endswith(suffix))
+        except FileNotFoundError:
+            return []
+
+    def collect(self, client_name):
+        """Список (путь, имя в архиве, нужен ли QR) для всех профилей клиента"""
+        files = []
+        file_name = get_profile_base_name(client_name)
+        for directory in self.openvpn_dirs:
+            prefix, _, transport = directory.partition('-')
+            suffix = f'-{transport}.ovpn' if transport else ').ovpn'
+            for path in self._find(os.path.join(self.client_dir, 'openvpn', directory), f'{prefix}-{file_name}-(', suffix):
+                files.append((path, f'openvpn/{directory}/{get_download_name(path)}', False))
+        for directory, suffix in self.wireguard_kinds:
+            for interface in self.interfaces:
+                for path in self._find(os.path.join(self.client_dir, directory, interface),
+                                       f'{interface}-{file_name}-(', f'-{suffix}.conf'):
+                    files.append((path, f'{directory}/{get_download_name(path)}', True))
+        return files
+
+    def stream(self, files, with_qr=False):
+        """Генератор частей zip-архива"""
+        output = ZipStream()
+        with zipfile.ZipFile(output, 'w', zipfile.ZIP_DEFLATED) as archive:
+            for path, arcname, qr_supported in files:
+                with open(path, 'rb') as source, archive.open(arcname, 'w') as target:
+                    while True:
+                        chunk = source.read(self.CHUNK_SIZE)
+                        if not chunk:
+                            break
+                        target.write(chunk)
+                        yield output.drain()
+                if with_qr and qr_supported:
+                    with open(path, 'r') as source:
+                        png, _ = self.qr_generator.get_qr_png(source.read())
+                    # PNG уже сжат
+                    archive.writestr(os.path.splitext(arcname)[0] + '.png', png, zipfile.ZIP_STORED)
+                yield output.drain()
+        yield output.drain()
 
-    def run_bash_script(self, option, client_name, cert_expire=None):
-        if not option.isdigit():
-            raise ValueError("Некорректный параметр option")
+class HashingReader:
+    """Обёртка над файлом, считающая sha256 прочитанных данных"""
 
-        safe_client_name = shlex.quote(client_name)
-        command = ['./client.sh', option, safe_client_name]
+    def __init__(self, file):
+        self.file = file
+        self.digest = hashlib.sha256()
 
-        if cert_expire:
-            if not cert_expire.isdigit() or not (self.min_cert_expire <= int(cert_expire) <= self.max_cert_expire):
-                raise ValueError("Некорректный срок действия сертификата")
-            command.append(cert_expire)
+    def read(self, size=-1):
+        data = self.file.read(size)
+        self.digest.update(data)
+        return data
 
-        result = subprocess.run(
-            command,
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            shell=False
-        )
-        if result.returncode != 0:
-            raise subprocess.CalledProcessError(result.returncode, command, output=result.stdout, stderr=result.stderr)
-        return result.stdout, result.stderr
+class BackupManager:
+    """Резервные копии PKI easy-rsa и конфигов WireGuard (те же файлы, что у опции 8 client.sh).
 
-class ConfigFileHandler:
-    def __init__(self, config_paths):
-        self.config_paths = config_paths
+    Полная копия собирается tar.gz-потоком во временный файл (под блокировкой,
+    которая держится только на время сборки, а не всей загрузки); в конец архива
+    дописывается MANIFEST.json с sha256 каждого файла. Снимки
+    хранятся по содержимому: objects/<sha256> и snapshots/<id>.json со списком
+    файлов. Файл, у которого размер и mtime совпадают с предыдущим снимком, не
+    перечитывается, а в хранилище попадают только объекты, которых там ещё нет.
+    Восстановление сначала сверяет все контрольные суммы и только потом пишет файлы.
+    """
 
-    def _collect_files(self, paths, extension):
-        collected = []
-        for directory in paths:
-            if os.path.exists(directory):
-                for root, _, files in os.walk(directory):
-                    collected.extend(os.path.join(root, f) for f in files if f.endswith(extension))
-        return collected
+    RESOURCES = ('openvpn', 'wireguard')
+    MANIFEST_NAME = 'MANIFEST.json'
+    CHUNK_SIZE = 64 * 1024
+    # Архив меньше этого размера не покидает память
+    SPOOL_MAX_SIZE = 8 * 1024 * 1024
 
-    def get_config_files(self):
-        openvpn_files = self._collect_files(self.config_paths["openvpn"], '.ovpn')
-        wg_files = self._collect_files(self.config_paths["wg"], '.conf')
-        amneziawg_files = self._collect_files(self.config_paths["amneziawg"], '.conf')
-        return openvpn_files, wg_files, amneziawg_files
+    def __init__(self, sources, store_dir, keep):
+        # (путь на сервере, имя в архиве)
+        self.sources = sources
+        self.store_dir = store_dir
+        self.keep = keep
 
+    def iter_entries(self):
+        """(путь, имя в архиве, stat) для каталогов и обычных файлов в порядке обхода"""
+        for source, arcname in self.sources:
+            try:
+                st = os.lstat(source)
+            except FileNotFoundError:
+                continue
+            if stat.S_ISREG(st.st_mode):
+                yield source, arcname, st
+                continue
+            if not stat.S_ISDIR(st.st_mode):
+                continue
+            for root, dirs, files in os.walk(source):
+                dirs.sort()
+                relative = os.path.relpath(root, source)
+                base = arcname if relative == '.' else f"{arcname}/{relative.replace(os.sep, '/')}"
+                yield root, base, os.lstat(root)
+                for name in sorted(files):
+                    path = os.path.join(root, name)
+                    st = os.lstat(path)
+                    if stat.S_ISREG(st.st_mode):
+                        yield path, f'{base}/{name}', st
 
-class AuthenticationManager:
-    def __init__(self):
-        pass
+    def resolve(self, arcname, target=None):
+        """Путь для восстановления файла из архива; имена вне известных источников отклоняются"""
+        parts = arcname.split('/')
+        if arcname.startswith('/') or '' in parts or '.' in parts or '..' in parts:
+            raise ValueError(f'Недопустимое имя в архиве: {arcname}')
+        for source, source_name in self.sources:
+            if arcname == source_name or arcname.startswith(source_name + '/'):
+                if target:
+                    return os.path.join(target, *parts)
+                return os.path.join(source, *parts[source_name.count('/') + 1:])
+        raise ValueError(f'Файл не относится к резервной копии: {arcname}')
 
-    def login_required(self, f):
-        @wraps(f)
-        def decorated_function(*args, **kwargs):
-            if 'username' not in session:
-                flash('Пожалуйста, войдите в систему для доступа к этой странице.', 'info')
-                return redirect(url_for('login'))
-            return f(*args, **kwargs)
-        return decorated_function
+    # Потоковый архив
+    def stream(self):
+        """Генератор частей tar.gz со всеми файлами и MANIFEST.json в конце"""
+        output = ZipStream()
+        manifest = {'created_at': time.time(), 'dirs': {}, 'files': {}}
+        with tarfile.open(fileobj=output, mode='w|gz') as archive:
+            for path, arcname, st in self.iter_entries():
+                info = tarfile.TarInfo(arcname)
+                info.mode = stat.S_IMODE(st.st_mode)
+                info.mtime = st.st_mtime
+                if stat.S_ISDIR(st.st_mode):
+                    info.type = tarfile.DIRTYPE
+                    archive.addfile(info)
+                    manifest['dirs'][arcname] = info.mode
+                    continue
+                with open(path, 'rb') as source:
+                    reader = HashingReader(source)
+                    info.size = os.fstat(source.fileno()).st_size
+                    archive.addfile(info, reader)
+                manifest['files'][arcname] = {'sha256': reader.digest.hexdigest(), 'size': info.size, 'mode': info.mode}
+                yield output.drain()
+            data = json.dumps(manifest, ensure_ascii=False, indent=1).encode('utf-8')
+            info = tarfile.TarInfo(self.MANIFEST_NAME)
+            info.size = len(data)
+            info.mtime = manifest['created_at']
+            archive.addfile(info, io.BytesIO(data))
+        yield output.drain()
 
-class CaptchaGenerator:
-    def __init__(self):
-        pass
+    def spool(self):
+        """Архив stream() во временном файле, перемотанном в начало; вызывающий закрывает файл"""
+        os.makedirs(self.store_dir, exist_ok=True)
+        archive = tempfile.SpooledTemporaryFile(max_size=self.SPOOL_MAX_SIZE, dir=self.store_dir)
+        try:
+            for chunk in self.stream():
+                archive.write(chunk)
+            size = archive.tell()
+            archive.seek(0)
+        except BaseException:
+            archive.close()
+            raise
+        return archive, size
 
-    def generate_captcha(self):
-        text = ''.join(random.choices(string.ascii_uppercase + string.digits, k=6))
-        return text
-    
-    def generate_captcha_image(self):
-        text = session.get('captcha', '')
+    # Снимки
+    def _object_path(self, digest):
+        return os.path.join(self.store_dir, 'objects', digest[:2], digest)
 
-        width = 200
-        height = 60
-        image = Image.new('RGB', (width, height), color=(255, 255, 255))
-        draw = ImageDraw.Draw(image)
-        font = ImageFont.truetype('./static/assets/fonts/SabirMono-Regular.ttf', 42)
-        x_offset = 22
-        y_offset = 10
-        current_x = x_offset
+    def _snapshot_path(self, snapshot_id):
+        if not re.fullmatch(r'\d{8}-\d{6}(-\d+)?', snapshot_id or ''):
+            raise ValueError(f'Недопустимый идентификатор снимка: {snapshot_id}')
+        return os.path.join(self.store_dir, 'snapshots', f'{snapshot_id}.json')
 
-        for char in text:
+    def list_snapshots(self):
+        """Снимки от новых к старым"""
+        try:
+            names = os.listdir(os.path.join(self.store_dir, 'snapshots'))
+        except FileNotFoundError:
+            return []
+        snapshots = []
+        for name in names:
+            if not name.endswith('.json'):
+                continue
             try:
-                bbox = draw.textbbox((0, 0), char, font=font)
-                char_width = bbox[2] - bbox[0]
-                char_height = bbox[3] - bbox[1]
-            except AttributeError:
-                char_width, char_height = draw.textsize(char, font=font)
-            
-            angle = random.randint(-15, 15)
-            
-            char_img = Image.new('RGBA', (char_width*2, char_height*2), (255, 255, 255, 0))
-            char_draw = ImageDraw.Draw(char_img)
-            char_draw.text((0, 0), char, font=font, fill=(0, 0, 0))
-            
-            char_img = char_img.rotate(angle, expand=1, resample=Image.BICUBIC)
-            new_width, new_height = char_img.size
-            
-            char_x = current_x + (char_width//2) - (new_width//2)
-            char_y = y_offset + (char_height//2) - (new_height//2)
-            
-            image.paste(char_img, (char_x, char_y), char_img)
-            
-            current_x += char_width + 10
+                manifest = self.load_snapshot(name[:-len('.json')])
+            except (OSError, ValueError):
+                continue
+            snapshots.append({key: manifest[key] for key in ('id', 'created_at', 'files_count', 'size', 'added', 'added_size')})
+        snapshots.sort(key=lambda item: item['created_at'], reverse=True)
+        return snapshots
 
-        for _ in range(200):
-            x = random.randint(0, width)
-            y = random.randint(0, height)
-            size = random.randint(1, 3)
-            draw.ellipse((x, y, x+size, y+size), fill=(200, 200, 200))
+    def load_snapshot(self, snapshot_id):
+        with open(self._snapshot_path(snapshot_id), 'r', encoding='utf-8') as f:
+            return json.load(f)
 
-        distortion = Image.new('L', (width, height), 255)
-        draw_dist = ImageDraw.Draw(distortion)
-        for _ in range(5):
-            x1 = random.randint(0, width)
-            y1 = random.randint(0, height)
-            x2 = random.randint(0, width)
-            y2 = random.randint(0, height)
-            draw_dist.line((x1, y1, x2, y2), fill=0, width=2)
+    def _store_object(self, path):
+        """Копирует файл в хранилище, если такого содержимого там ещё нет; возвращает (sha256, добавлен ли)"""
+        objects_dir = os.path.join(self.store_dir, 'objects')
+        os.makedirs(objects_dir, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=objects_dir, prefix='.tmp-')
+        try:
+            digest = hashlib.sha256()
+            with open(path, 'rb') as source, os.fdopen(fd, 'wb') as target:
+                while True:
+                    chunk = source.read(self.CHUNK_SIZE)
+                    if not chunk:
+                        break
+                    digest.update(chunk)
+                    target.write(chunk)
+            digest = digest.hexdigest()
+            object_path = self._object_path(digest)
+            if os.path.exists(object_path):
+                return digest, False
+            os.makedirs(os.path.dirname(object_path), exist_ok=True)
+            os.chmod(tmp_path, 0o400)
+            os.replace(tmp_path, object_path)
+            return digest, True
+        finally:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
 
-        image = Image.composite(image, Image.new('RGB', (width, height), (255, 255, 255)), distortion)
-        
-        image = image.filter(ImageFilter.GaussianBlur(radius=0.5))
-        
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(1.5)
+    def create_snapshot(self, on_line=None):
+        """Инкрементальный снимок; вызывать под блокировкой RESOURCES"""
+        snapshots = self.list_snapshots()
+        previous = self.load_snapshot(snapshots[0]['id'])['files'] if snapshots else {}
+        manifest = {'dirs': {}, 'files': {}, 'created_at': time.time()}
+        added = added_size = size = 0
+        for path, arcname, st in self.iter_entries():
+            mode = stat.S_IMODE(st.st_mode)
+            if stat.S_ISDIR(st.st_mode):
+                manifest['dirs'][arcname] = mode
+                continue
+            entry = previous.get(arcname)
+            if entry and entry['size'] == st.st_size and entry['mtime_ns'] == st.st_mtime_ns \
+                    and os.path.exists(self._object_path(entry['sha256'])):
+                digest = entry['sha256']
+            else:
+                digest, is_new = self._store_object(path)
+                if is_new:
+                    added += 1
+                    added_size += st.st_size
+                    if on_line:
+                        on_line('stdout', f'+ {arcname}')
+            manifest['files'][arcname] = {'sha256': digest, 'size': st.st_size, 'mode': mode, 'mtime_ns': st.st_mtime_ns}
+            size += st.st_size
 
-        image = image.convert('RGB')
-        img_io = io.BytesIO()
-        image.save(img_io, 'PNG')
-        img_io.seek(0)
-        
-        return img_io
+        snapshot_id = time.strftime('%Y%m%d-%H%M%S', time.localtime(manifest['created_at']))
+        os.makedirs(os.path.join(self.store_dir, 'snapshots'), exist_ok=True)
+        suffix = 1
+        candidate = snapshot_id
+        while os.path.exists(self._snapshot_path(candidate)):
+            suffix += 1
+            candidate = f'{snapshot_id}-{suffix}'
+        manifest.update(id=candidate, files_count=len(manifest['files']), size=size, added=added, added_size=added_size)
+        atomic_write(self._snapshot_path(candidate), json.dumps(manifest, ensure_ascii=False), mode=0o600)
+        self.prune()
+        return manifest
 
-class FileValidator:
-    def __init__(self, config_paths):
-        self.config_paths = config_paths
+    def prune(self):
+        """Оставляет последние keep снимков и удаляет объекты, на которые они больше не ссылаются"""
+        snapshots = self.list_snapshots()
+        if len(snapshots) <= self.keep:
+            return 0
+        for item in snapshots[self.keep:]:
+            os.unlink(self._snapshot_path(item['id']))
+        referenced = set()
+        for item in snapshots[:self.keep]:
+            referenced.update(entry['sha256'] for entry in self.load_snapshot(item['id'])['files'].values())
+        removed = 0
+        for path in glob.glob(os.path.join(self.store_dir, 'objects', '??', '*')):
+            if os.path.basename(path) not in referenced:
+                os.unlink(path)
+                removed += 1
+        return removed
 
-    def validate_file(self, func):
-        @wraps(func)
-        def wrapper(file_type, filename, *args, **kwargs):
+    def verify_snapshot(self, manifest):
+        """Список проблем: отсутствующие объекты и несовпадения контрольных сумм"""
+        problems = []
+        for arcname, entry in sorted(manifest['files'].items()):
             try:
-                if file_type not in self.config_paths:
-                    abort(400, description="Недопустимый тип файла")
+                digest = hashlib.sha256()
+                with open(self._object_path(entry['sha256']), 'rb') as f:
+                    for chunk in iter(lambda: f.read(self.CHUNK_SIZE), b''):
+                        digest.update(chunk)
+            except FileNotFoundError:
+                problems.append(f'{arcname}: объект {entry["sha256"]} отсутствует')
+                continue
+            if digest.hexdigest() != entry['sha256']:
+                problems.append(f'{arcname}: контрольная сумма не совпадает')
+        return problems
 
-                for config_dir in self.config_paths[file_type]:
-                    for root, _, files in os.walk(config_dir):
-                        for file in files:
-                            if file.replace("(", "").replace(")", "") == filename.replace("(", "").replace(")", ""):
-                                file_path = os.path.join(root, file)
-                                clean_name = file.replace("(", "").replace(")", "")
-                                return func(file_path, clean_name, *args, **kwargs)
+    # Восстановление
+    def _restore_file(self, destination, read, mode):
+        directory = os.path.dirname(destination)
+        os.makedirs(directory, exist_ok=True)
+        fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(destination) + '.')
+        try:
+            with os.fdopen(fd, 'wb') as target:
+                for chunk in iter(lambda: read(self.CHUNK_SIZE), b''):
+                    target.write(chunk)
+            os.chmod(tmp_path, mode)
+            os.replace(tmp_path, destination)
+        except BaseException:
+            try:
+                os.unlink(tmp_path)
+            except FileNotFoundError:
+                pass
+            raise
 
-                abort(404, description="Файл не найден")
+    def restore_snapshot(self, snapshot_id, target=None, on_line=None):
+        """Проверяет снимок и восстанавливает файлы на место (или в каталог target)"""
+        manifest = self.load_snapshot(snapshot_id)
+        problems = self.verify_snapshot(manifest)
+        if problems:
+            raise ValueError('Снимок повреждён:\n' + '\n'.join(problems))
+        destinations = {arcname: self.resolve(arcname, target) for arcname in manifest['files']}
+        for arcname, mode in sorted(manifest['dirs'].items()):
+            os.makedirs(self.resolve(arcname, target), mode=mode, exist_ok=True)
+        for arcname, entry in sorted(manifest['files'].items()):
+            with open(self._object_path(entry['sha256']), 'rb') as source:
+                self._restore_file(destinations[arcname], source.read, entry['mode'])
+            if on_line:
+                on_line('stdout', destinations[arcname])
+        return len(manifest['files'])
 
-            except Exception as e:
-                print(f"Аларм! ошибка: {str(e)}")
-                abort(500)
+    def restore_archive(self, archive_path, target=None, verify=True, on_line=None):
+        """Восстановление из tar.gz: сначала все файлы сверяются с MANIFEST.json, затем распаковываются"""
+        with tarfile.open(archive_path, 'r:gz') as archive:
+            # Родительские каталоги источников (wireguard/ в архивах client.sh) отдельно не восстанавливаются
+            parents = {name.rsplit('/', 1)[0] for _, name in self.sources if '/' in name}
+            members = [member for member in archive.getmembers()
+                       if member.name != self.MANIFEST_NAME and not (member.isdir() and member.name.rstrip('/') in parents)]
+            for member in members:
+                if not (member.isfile() or member.isdir()):
+                    raise ValueError(f'Недопустимый тип записи в архиве: {member.name}')
+                self.resolve(member.name.rstrip('/'), target)
+            if verify:
+                try:
+                    manifest = json.load(archive.extractfile(self.MANIFEST_NAME))
+                except KeyError:
+                    raise ValueError(f'В архиве нет {self.MANIFEST_NAME}, проверить контрольные суммы нельзя')
+                files = {member.name: member for member in members if member.isfile()}
+                problems = [f'{name}: отсутствует в архиве' for name in sorted(manifest['files'].keys() - files.keys())]
+                problems += [f'{name}: нет в {self.MANIFEST_NAME}' for name in sorted(files.keys() - manifest['files'].keys())]
+                for name in sorted(files.keys() & manifest['files'].keys()):
+                    reader = HashingReader(archive.extractfile(files[name]))
+                    while reader.read(self.CHUNK_SIZE):
+                        pass
+                    if reader.digest.hexdigest() != manifest['files'][name]['sha256']:
+                        problems.append(f'{name}: контрольная сумма не совпадает')
+                if problems:
+                    raise ValueError('Архив повреждён:\n' + '\n'.join(problems))
+            for member in members:
+                destination = self.resolve(member.name.rstrip('/'), target)
+                if member.isdir():
+                    os.makedirs(destination, mode=member.mode, exist_ok=True)
+                    continue
+                self._restore_file(destination, archive.extractfile(member).read, member.mode)
+                if on_line:
+                    on_line('stdout', destination)
+            return sum(1 for member in members if member.isfile())
 
-        return wrapper
+class CertificateInventory:
+    """Сводка по сертификатам OpenVPN из PKI easy-rsa.
 
-class QRGenerator:
-    def __init__(self):
-        pass
+    Каждый сертификат из pki/issued разбирается один раз: серийный номер, CN и срок
+    действия кэшируются по (mtime, размер) файла, при обновлении повторно читаются
+    только новые и изменённые файлы. Отзыв сверяется с crl.pem, который также
+    разбирается заново только после изменения. Кэш сохраняется в instance, чтобы
+    перезапуск и другие воркеры не разбирали весь каталог заново.
+    Для разбора достаточно небольшого чтения DER, внешние библиотеки не нужны.
+    """
 
-    def generate_qr_code(self, config_text):
-        qr = qrcode.QRCode(
-            version=1,
-            error_correction=qrcode.constants.ERROR_CORRECT_H,
-            box_size=10,
-            border=4,
-        )
-        qr.add_data(config_text)
-        qr.make(fit=True)
+    SERVER_NAME = 'antizapret-server'
+    PEM_RE = re.compile(r'-----BEGIN ([A-Z509 ]+)-----\s+([A-Za-z0-9+/=\s]+?)-----END \1-----')
+    OID_COMMON_NAME = bytes.fromhex('550403')
 
-        img = qr.make_image(fill_color="black", back_color="white", image_factory=PilImage)
+    def __init__(self, issued_dir, crl_path, cache_path, expiring_days):
+        self.issued_dir = issued_dir
+        self.crl_path = crl_path
+        self.cache_path = cache_path
+        self.expiring_days = expiring_days
+        self._lock = threading.Lock()
+        self._certs = None
+        self._crl_key = None
+        self._crl = {'revoked': {}, 'this_update': None, 'next_update': None}
 
-        img_byte_arr = io.BytesIO()
-        img.save(img_byte_arr, format='PNG')
-        img_byte_arr.seek(0)
-        
-        return img_byte_arr
+    # Разбор DER
+    @staticmethod
+    def _der_read(data, offset):
+        """(тег, начало содержимого, конец содержимого) для элемента DER по смещению"""
+        tag = data[offset]
+        length = data[offset + 1]
+        offset += 2
+        if length & 0x80:
+            size = length & 0x7f
+            length = int.from_bytes(data[offset:offset + size], 'big')
+            offset += size
+        if offset + length > len(data):
+            raise ValueError('Обрезанная структура DER')
+        return tag, offset, offset + length
 
-class FileEditor:
-    def __init__(self):
-        self.files = {
-            "include_hosts": "/root/antizapret/config/include-hosts.txt",
-            "exclude_hosts": "/root/antizapret/config/exclude-hosts.txt",
-            "include_ips": "/root/antizapret/config/include-ips.txt"
+    @classmethod
+    def _der_children(cls, data, start, end):
+        items = []
+        while start < end:
+            item = cls._der_read(data, start)
+            items.append(item)
+            start = item[2]
+        return items
+
+    @staticmethod
+    def _der_time(data, tag, start, end):
+        value = data[start:end].decode('ascii').rstrip('Z')
+        if tag == 0x17:  # UTCTime
+            year = int(value[:2])
+            value = f"{1900 + year if year >= 50 else 2000 + year}{value[2:]}"
+        return int(calendar.timegm(time.strptime(value[:14], '%Y%m%d%H%M%S')))
+
+    @staticmethod
+    def _serial(data, start, end):
+        return data[start:end].hex().lstrip('0').upper() or '0'
+
+    @classmethod
+    def _common_name(cls, data, start, end):
+        for _, set_start, set_end in cls._der_children(data, start, end):
+            for _, attr_start, attr_end in cls._der_children(data, set_start, set_end):
+                oid, value = cls._der_children(data, attr_start, attr_end)[:2]
+                if data[oid[1]:oid[2]] == cls.OID_COMMON_NAME:
+                    return data[value[1]:value[2]].decode('utf-8', 'replace')
+        return None
+
+    @classmethod
+    def _pem_to_der(cls, text, kind):
+        for match in cls.PEM_RE.finditer(text):
+            if match.group(1) == kind:
+                return base64.b64decode(''.join(match.group(2).split()))
+        raise ValueError(f'Блок {kind} не найден')
+
+    @classmethod
+    def parse_certificate(cls, text):
+        """Серийный номер, CN и срок действия сертификата в PEM"""
+        data = cls._pem_to_der(text, 'CERTIFICATE')
+        _, start, end = cls._der_read(data, 0)
+        _, tbs_start, tbs_end = cls._der_read(data, start)
+        fields = cls._der_children(data, tbs_start, tbs_end)
+        if fields[0][0] == 0xa0:  # [0] version
+            fields = fields[1:]
+        serial, _, _, validity, subject = fields[:5]
+        not_before, not_after = cls._der_children(data, validity[1], validity[2])[:2]
+        return {
+            'serial': cls._serial(data, serial[1], serial[2]),
+            'common_name': cls._common_name(data, subject[1], subject[2]),
+            'not_before': cls._der_time(data, *not_before),
+            'not_after': cls._der_time(data, *not_after)
         }
 
-    def update_file_content(self, file_type, content):
-        if file_type in self.files:
-            try:
-                with open(self.files[file_type], 'w', encoding='utf-8') as f:
-                    f.write(content)
-                return True
-            except Exception as e:
-                print(f"Ошибка записи в файл: {str(e)}")
-                return False
-        return False
+    @classmethod
+    def parse_crl(cls, text):
+        """Отозванные серийные номера (с датой отзыва) и срок действия CRL"""
+        data = cls._pem_to_der(text, 'X509 CRL')
+        _, start, end = cls._der_read(data, 0)
+        _, tbs_start, tbs_end = cls._der_read(data, start)
+        fields = cls._der_children(data, tbs_start, tbs_end)
+        if fields[0][0] == 0x02:  # version
+            fields = fields[1:]
+        this_update = cls._der_time(data, *fields[2])
+        next_update = None
+        rest = fields[3:]
+        if rest and rest[0][0] in (0x17, 0x18):
+            next_update = cls._der_time(data, *rest[0])
+            rest = rest[1:]
+        revoked = {}
+        if rest and rest[0][0] == 0x30:
+            for _, entry_start, entry_end in cls._der_children(data, rest[0][1], rest[0][2]):
+                serial, revoked_at = cls._der_children(data, entry_start, entry_end)[:2]
+                revoked[cls._serial(data, serial[1], serial[2])] = cls._der_time(data, *revoked_at)
+        return {'revoked': revoked, 'this_update': this_update, 'next_update': next_update}
 
-    def get_file_contents(self):
-        file_contents = {}
-        for key, path in self.files.items():
+    # Кэш
+    def _load_cache(self):
+        try:
+            with open(self.cache_path, 'r', encoding='utf-8') as f:
+                return {name: tuple(item) for name, item in json.load(f).items()}
+        except (OSError, ValueError, TypeError):
+            return {}
+
+    def _save_cache(self):
+        os.makedirs(os.path.dirname(self.cache_path), exist_ok=True)
+        atomic_write(self.cache_path, json.dumps(self._certs, ensure_ascii=False))
+
+    def _refresh_crl(self):
+        try:
+            st = os.stat(self.crl_path)
+        except FileNotFoundError:
+            self._crl_key = None
+            self._crl = {'revoked': {}, 'this_update': None, 'next_update': None}
+            return
+        key = (st.st_mtime_ns, st.st_size, st.st_ino)
+        if key == self._crl_key:
+            return
+        try:
+            with open(self.crl_path, 'r', encoding='ascii', errors='replace') as f:
+                self._crl = self.parse_crl(f.read())
+        except (OSError, ValueError, IndexError) as e:
+            app.logger.warning("Не удалось разобрать %s: %s", self.crl_path, e)
+            self._crl = {'revoked': {}, 'this_update': None, 'next_update': None}
+        self._crl_key = key
+
+    def refresh(self):
+        """Перечитывает только новые и изменённые сертификаты; возвращает число разобранных файлов"""
+        with self._lock:
+            if self._certs is None:
+                self._certs = self._load_cache()
+            self._refresh_crl()
+            certs = {}
+            parsed = 0
             try:
-                with open(path, 'r', encoding='utf-8') as f:
-                    file_contents[key] = f.read()
+                with os.scandir(self.issued_dir) as entries:
+                    for entry in entries:
+                        if not entry.name.endswith('.crt') or not entry.is_file():
+                            continue
+                        st = entry.stat()
+                        cached = self._certs.get(entry.name)
+                        if cached and cached[0] == st.st_mtime_ns and cached[1] == st.st_size:
+                            certs[entry.name] = cached
+                            continue
+                        try:
+                            with open(entry.path, 'r', encoding='utf-8', errors='replace') as f:
+                                record = self.parse_certificate(f.read())
+                        except (OSError, ValueError, IndexError) as e:
+                            app.logger.warning("Не удалось разобрать сертификат %s: %s", entry.path, e)
+                            record = None
+                        certs[entry.name] = (st.st_mtime_ns, st.st_size, record)
+                        parsed += 1
             except FileNotFoundError:
-                file_contents[key] = ""
-        return file_contents
-
-class ServerMonitor:
-    def __init__(self):
-        pass
+                pass
+            if parsed or certs.keys() != self._certs.keys():
+                self._certs = certs
+                self._save_cache()
+            return parsed
 
-    def get_cpu_usage(self):
-        return psutil.cpu_percent(interval=1)
+    def _status(self, record, now, threshold):
+        if record['serial'] in self._crl['revoked']:
+            return 'revoked'
+        if record['not_after'] <= now:
+            return 'expired'
+        if record['not_after'] <= threshold:
+            return 'expiring'
+        return 'valid'
 
-    def get_memory_usage(self):
-        memory = psutil.virtual_memory()
-        return memory.percent
+    def get_certificates(self, days=None):
+        """Сертификаты по возрастанию даты окончания; days - порог для статуса expiring"""
+        self.refresh()
+        now = int(time.time())
+        threshold = now + (self.expiring_days if days is None else days) * 86400
+        result = []
+        with self._lock:
+            for file_name, (_, _, record) in self._certs.items():
+                if record is None:
+                    continue
+                item = dict(record)
+                item['name'] = file_name[:-len('.crt')]
+                item['server'] = item['name'] == self.SERVER_NAME
+                item['status'] = self._status(record, now, threshold)
+                item['days_left'] = (record['not_after'] - now) // 86400
+                item['revoked_at'] = self._crl['revoked'].get(record['serial'])
+                result.append(item)
+        result.sort(key=lambda item: (item['not_after'], item['name']))
+        return result
 
-    def get_uptime(self):
-        boot_time = psutil.boot_time()
-        current_time = time.time()
-        uptime_seconds = current_time - boot_time
-        days, remainder = divmod(uptime_seconds, 86400)
-        hours, remainder = divmod(remainder, 3600)
-        minutes, _ = divmod(remainder, 60)
-        return f"{int(days)}д {int(hours)}ч {int(minutes)}м"
+    def get_summary(self, certificates):
+        counts = {'valid': 0, 'expiring': 0, 'expired': 0, 'revoked': 0}
+        for item in certificates:
+            counts[item['status']] += 1
+        with self._lock:
+            crl = {'this_update': self._crl['this_update'], 'next_update': self._crl['next_update'],
+                   'revoked': len(self._crl['revoked'])}
+            unreadable = sum(1 for _, _, record in (self._certs or {}).values() if record is None)
+        return {'total': len(certificates), 'counts': counts, 'crl': crl, 'unreadable': unreadable}
 
 # Инициализация классов
-script_executor = ScriptExecutor()
+metrics = MetricsRegistry('adminantizapret', os.path.join(app.instance_path, 'metrics'))
+metrics.counter('http_requests_total', 'Запросы по маршруту, методу и коду ответа')
+metrics.histogram('http_request_duration_seconds', 'Время обработки запроса', MetricsRegistry.REQUEST_BUCKETS)
+metrics.histogram('subprocess_duration_seconds', 'Время выполнения client.sh (по опциям) и doall.sh',
+                  MetricsRegistry.SUBPROCESS_BUCKETS)
+metrics.histogram('render_duration_seconds', 'Время отрисовки QR-кодов и капчи', MetricsRegistry.RENDER_BUCKETS)
+metrics.counter('login_attempts_total', 'Попытки входа по результату')
+request_profiler = RequestProfiler(os.path.join(app.instance_path, 'profiling.json'),
+                                   os.path.join(app.instance_path, 'profiles'), PROFILE_KEEP)
+profile_renderer = ProfileRenderer()
+wireguard_manager = WireGuardPeerManager(WIREGUARD_DIR, CLIENT_PROFILES_DIR, WIREGUARD_INTERFACES, profile_renderer)
+script_executor = ScriptExecutor(wireguard_manager if USE_NATIVE_WIREGUARD else None)
+openvpn_manager = OpenVPNClientManager(script_executor, EASYRSA_DIR, CLIENT_PROFILES_DIR,
+                                       OPENVPN_SERVER_KEYS_DIR, OPENVPN_CLIENT_KEYS_DIR, profile_renderer)
+profile_recreator = ProfileRecreator(openvpn_manager, wireguard_manager, CLIENT_PROFILES_DIR, RECREATE_WORKERS)
+if USE_NATIVE_OPENVPN:
+    script_executor.openvpn_manager = openvpn_manager
+    if USE_NATIVE_WIREGUARD:
+        script_executor.recreator = profile_recreator
 config_file_handler = ConfigFileHandler(CONFIG_PATHS)
 auth_manager = AuthenticationManager()
+login_limiter = LoginRateLimiter()
+audit_logger = AuditLogger()
+# События, оставшиеся в очереди, записываются при остановке процесса
+atexit.register(audit_logger.flush)
 captcha_generator = CaptchaGenerator()
 file_validator = FileValidator(CONFIG_PATHS)
 qr_generator = QRGenerator()
-file_editor = FileEditor()
+profile_bundler = ProfileBundler(CLIENT_PROFILES_DIR, OpenVPNClientManager.PROFILE_DIRS,
+                                 WireGuardPeerManager.PROFILE_KINDS, WIREGUARD_INTERFACES, qr_generator)
+file_editor = FileEditor(os.path.join(app.instance_path, 'locks'), ListNormalizer() if NORMALIZE_LISTS else None)
 server_monitor_proc = ServerMonitor()
 
+job_manager = JobManager(JOB_WORKERS, ResourceLockManager(os.path.join(app.instance_path, 'locks')))
+doall_scheduler = DoallScheduler(job_manager, file_editor, os.path.join(app.instance_path, 'doall_state.json'),
+                                 os.path.join(app.instance_path, 'locks'), DOALL_DEBOUNCE)
+backup_manager = BackupManager(((EASYRSA_DIR, 'easyrsa3'),
+                                *((os.path.join(WIREGUARD_DIR, name), f'wireguard/{name}')
+                                  for name in ('antizapret.conf', 'vpn.conf', 'key'))),
+                               BACKUP_DIR, BACKUP_KEEP)
+certificate_inventory = CertificateInventory(os.path.join(EASYRSA_DIR, 'pki', 'issued'),
+                                            os.path.join(OPENVPN_SERVER_KEYS_DIR, 'crl.pem'),
+                                            os.path.join(app.instance_path, 'cert_inventory.json'),
+                                            CERT_EXPIRING_DAYS)
+traffic_collector = TrafficStatsCollector(STATS_INTERVAL, WIREGUARD_INTERFACES, OPENVPN_STATUS_GLOB,
+                                          os.path.join(app.instance_path, 'locks'))
+
+def invalidate_client_caches():
+    """Сбрасывает кэши клиентских конфигураций после работы client.sh"""
+    config_file_handler.invalidate()
+    file_validator.invalidate()
+
+def run_client_job(params, on_line):
+    option = params['option']
+    client_name = params['client_name']
+    try:
+        output = script_executor.run_bash_script(option, client_name, params.get('cert_expire'), on_line=on_line)
+    finally:
+        invalidate_client_caches()
+
+    if option == '4':
+        client_files = config_file_handler.get_client_files(client_name)
+        qr_generator.prerender(client_files['wg'] + client_files['amneziawg'])
+    return output
+
+def run_backup_snapshot(params, on_line):
+    manifest = backup_manager.create_snapshot(on_line)
+    message = (f"Снимок {manifest['id']}: файлов {manifest['files_count']}, "
+               f"новых {manifest['added']} ({manifest['added_size']} Б)")
+    on_line('stdout', message)
+    return message + '\n', '', {key: manifest[key] for key in ('id', 'files_count', 'size', 'added', 'added_size')}
+
+BULK_PROTOCOLS = {'openvpn': ('openvpn',), 'wireguard': ('wireguard',), 'all': ('openvpn', 'wireguard')}
+
+def parse_bulk_request(data):
+    """Проверяет пакетный запрос и возвращает параметры задачи; ошибки - ValueError"""
+    action = data.get('action')
+    protocol = data.get('protocol', 'all')
+    if action not in ('add', 'delete'):
+        raise ValueError("Параметр action должен быть add или delete")
+    if protocol not in BULK_PROTOCOLS:
+        raise ValueError("Параметр protocol должен быть openvpn, wireguard или all")
+
+    clients = []
+    seen = set()
+    for item in data.get('clients') or []:
+        if isinstance(item, str):
+            item = {'name': item}
+        name = str(item.get('name', '')).strip()
+        cert_expire = str(item.get('cert_expire') or '').strip()
+        if not CLIENT_NAME_RE.match(name):
+            raise ValueError(f"Некорректное имя клиента: {name}")
+        if cert_expire and not (cert_expire.isdigit() and MIN_CERT_EXPIRE <= int(cert_expire) <= MAX_CERT_EXPIRE):
+            raise ValueError(f"Срок действия сертификата для {name} должен быть числом от {MIN_CERT_EXPIRE} до {MAX_CERT_EXPIRE}")
+        if name not in seen:
+            seen.add(name)
+            clients.append({'name': name, 'cert_expire': cert_expire})
+
+    if not clients:
+        raise ValueError("Список клиентов пуст")
+    if len(clients) > BULK_MAX_CLIENTS:
+        raise ValueError(f"За один запрос можно обработать не более {BULK_MAX_CLIENTS} клиентов")
+    return {'action': action, 'protocol': protocol, 'clients': clients}
+
+def run_bulk_clients(params, on_line):
+    """Пакетно добавляет или удаляет клиентов. Возвращает (stdout, stderr, отчёт по клиентам)"""
+    action = params['action']
+    clients = params['clients']
+    names = [client['name'] for client in clients]
+    report = {name: {} for name in names}
+    output = []
+
+    def emit(stream, line):
+        if stream == 'stdout':
+            output.append(line)
+        on_line(stream, line)
+
+    try:
+        if 'openvpn' in BULK_PROTOCOLS[params['protocol']]:
+            emit('stdout', f"OpenVPN - {action} {len(names)} clients")
+            if action == 'add':
+                results = openvpn_manager.add_clients([(c['name'], c['cert_expire'] or None) for c in clients], emit)
+            else:
+                results = openvpn_manager.delete_clients(names, emit)
+            for name, (success, message) in results.items():
+                report[name]['openvpn'] = {'success': success, 'message': message}
+
+        if 'wireguard' in BULK_PROTOCOLS[params['protocol']]:
+            emit('stdout', f"WireGuard/AmneziaWG - {action} {len(names)} clients")
+            if wireguard_manager.available():
+                results = {}
+                try:
+                    if action == 'add':
+                        wireguard_manager.add_clients(names, emit, results)
+                    else:
+                        results = wireguard_manager.delete_clients(names, emit)
+                except (RuntimeError, OSError, subprocess.CalledProcessError) as e:
+                    emit('stderr', str(e))
+                for name in names:
+                    message = results.get(name)
+                    if message is None:
+                        message = (f"Failed to delete client '{name}', please check if the client exists"
+                                   if action == 'delete' and name in results else "Клиент не обработан")
+                    report[name]['wireguard'] = {'success': bool(results.get(name)), 'message': message}
+            else:
+                option = '4' if action == 'add' else '5'
+                for name in names:
+                    try:
+                        stdout, _ = script_executor.run_bash_script(option, name, on_line=emit)
+                        report[name]['wireguard'] = {'success': True, 'message': stdout.strip().splitlines()[-1]}
+                    except subprocess.CalledProcessError as e:
+                        report[name]['wireguard'] = {'success': False, 'message': (e.stderr or e.stdout or '').strip()}
+    finally:
+        invalidate_client_caches()
+
+    failed = sorted(name for name, result in report.items() if not all(item['success'] for item in result.values()))
+    emit('stdout', f"Обработано клиентов: {len(names)}, с ошибками: {len(failed)}")
+    return '\n'.join(output) + '\n', '', report
+
+job_manager.register('client', run_client_job, lambda params: CLIENT_OPTION_RESOURCES.get(params['option'], ('openvpn', 'wireguard')))
+job_manager.register('doall', doall_scheduler.run, lambda params: ('antizapret-config',))
+job_manager.register('bulk', run_bulk_clients, lambda params: BULK_PROTOCOLS[params['protocol']])
+job_manager.register('backup', run_backup_snapshot, lambda params: BackupManager.RESOURCES)
+
+# Столбцы, добавленные после первого создания таблиц (db.create_all их не добавляет)
+SCHEMA_UPGRADES = (('job', 'result', 'TEXT'), ('job', 'scheduled_at', 'FLOAT'),
+                   ('job', 'stdout_offset', 'INTEGER NOT NULL DEFAULT 0'))
+
+def upgrade_schema():
+    inspector = sa_inspect(db.engine)
+    with db.engine.begin() as connection:
+        for table, column, column_type in SCHEMA_UPGRADES:
+            if column not in {item['name'] for item in inspector.get_columns(table)}:
+                connection.exec_driver_sql(f'ALTER TABLE {table} ADD COLUMN {column} {column_type}')
+
+with app.app_context():
+    db.create_all()
+    upgrade_schema()
+    job_manager.recover()
+    audit_logger.prune(int(os.getenv('AUDIT_RETENTION_DAYS', '365')))
+
+# Фоновые сборщики запускаются в процессе, который обслуживает запросы
+@app.before_request
+def start_background_services():
+    traffic_collector.start()
+
+# Маршруты, которые не профилируются (статика и управление самим профилированием)
+PROFILING_EXCLUDED_ENDPOINTS = ('static', 'metrics_view', 'profiling', 'profiling_download')
+
+@app.before_request
+def start_request_metrics():
+    g.request_started = time.perf_counter()
+    g.request_profile = None
+    if request.endpoint not in PROFILING_EXCLUDED_ENDPOINTS and request_profiler.claim():
+        g.request_profile = request_profiler.start()
+
+@app.after_request
+def record_request_metrics(response):
+    route = request.url_rule.rule if request.url_rule else 'unmatched'
+    started = g.get('request_started')
+    if started is not None:
+        # Для потоковых ответов (SSE, архивы) это время до начала отдачи
+        metrics.observe('http_request_duration_seconds', time.perf_counter() - started, route=route,
+                        method=request.method)
+    metrics.inc('http_requests_total', route=route, method=request.method, status=str(response.status_code))
+    return response
+
+@app.teardown_request
+def finish_request_profile(exception=None):
+    profile = g.pop('request_profile', None)
+    if profile is not None:
+        route = request.url_rule.rule if request.url_rule else 'unmatched'
+        try:
+            request_profiler.finish(profile, route)
+        except OSError as e:
+            print(f"Ошибка сохранения профиля: {str(e)}")
+
+@app.template_filter('filesize')
+def filesize_filter(value):
+    for unit in ('Б', 'КБ', 'МБ', 'ГБ'):
+        if value < 1024:
+            return f"{value:.0f} {unit}" if unit == 'Б' else f"{value:.1f} {unit}"
+        value /= 1024
+    return f"{value:.1f} ТБ"
+
+@app.template_filter('timeago')
+def timeago_filter(timestamp):
+    if not timestamp:
+        return 'нет подключений'
+    seconds = int(time.time() - timestamp)
+    if seconds < 60:
+        return 'только что'
+    if seconds < 3600:
+        return f"{seconds // 60} мин назад"
+    if seconds < 86400:
+        return f"{seconds // 3600} ч назад"
+    return f"{seconds // 86400} д назад"
+
+@app.template_filter('date')
+def date_filter(timestamp):
+    return time.strftime('%d.%m.%Y', time.localtime(timestamp)) if timestamp else '—'
+
 # Главная страница
 @app.route('/', methods=['GET', 'POST'])
 @auth_manager.login_required
 def index():
     if request.method == 'GET':
-        openvpn_files, wg_files, amneziawg_files = config_file_handler.get_config_files()
-        return render_template('index.html', openvpn_files=openvpn_files, wg_files=wg_files, amneziawg_files=amneziawg_files)
+        return render_template('index.html', **get_clients_page_context())
 
     if request.method == 'POST':
         try:
@@ -321,13 +3948,39 @@ def index():
             if not option or not client_name:
                 return jsonify({"success": False, "message": "Не указаны обязательные параметры."}), 400
 
-            stdout, stderr = script_executor.run_bash_script(option, client_name, cert_expire)
-            return jsonify({"success": True, "message": "Операция выполнена успешно.", "output": stdout})
-        except subprocess.CalledProcessError as e:
-            return jsonify({"success": False, "message": f"Ошибка выполнения скрипта: {e.stderr}", "output": e.stdout}), 500
+            script_executor.build_command(option, client_name, cert_expire)
+            job_id = job_manager.submit('client', {
+                'option': option,
+                'client_name': client_name,
+                'cert_expire': cert_expire
+            }, username=session.get('username'))
+            if option in CLIENT_OPTION_ACTIONS:
+                audit_logger.record(CLIENT_OPTION_ACTIONS[option], client_name, {
+                    'protocol': CLIENT_OPTION_RESOURCES.get(option), 'cert_expire': cert_expire or None, 'job_id': job_id
+                })
+            return jsonify({"success": True, "message": "Задача поставлена в очередь.", "job_id": job_id}), 202
+        except ValueError as e:
+            return jsonify({"success": False, "message": f"Ошибка: {str(e)}"}), 400
         except Exception as e:
             return jsonify({"success": False, "message": f"Ошибка: {str(e)}"}), 500
 
+def get_clients_page_context():
+    """Данные таблиц клиентов на главной: только текущая страница"""
+    clients_page = config_file_handler.get_page(request.args.get('q'), request.args.get('page', 1, type=int),
+                                                CLIENTS_PAGE_SIZE)
+    names = {name for table in clients_page['tables'].values() for name, _ in table['rows']}
+    return {'clients_page': clients_page, 'client_stats': traffic_collector.get_client_summary(names)}
+
+# Таблицы клиентов без остальной страницы (поиск и обновление после изменений)
+@app.route('/clients-table')
+@auth_manager.login_required
+def clients_table():
+    context = get_clients_page_context()
+    response = make_response(render_template('client_tables.html', **context))
+    response.headers.set('X-Clients-Version', context['clients_page']['version'] or '')
+    response.cache_control.no_store = True
+    return response
+
 # Страница логина
 @app.route('/login', methods=['GET', 'POST'])
 def login():
@@ -335,6 +3988,17 @@ def login():
         session['captcha'] = captcha_generator.generate_captcha()
     
     if request.method == 'POST':
+        remote_addr = request.remote_addr
+        username = request.form.get('username', '')
+        # Отсекаем перебор до запроса к БД и дорогого check_password_hash
+        retry_after = login_limiter.check(remote_addr, username)
+        if retry_after:
+            metrics.inc('login_attempts_total', result='blocked')
+            flash(f'Слишком много попыток входа. Повторите через {retry_after} с.', 'error')
+            response = make_response(render_template('login.html', captcha=session['captcha']), 429)
+            response.headers.set('Retry-After', str(retry_after))
+            return response
+
         attempts = session.get('attempts', 0)
         attempts += 1
         session['attempts'] = attempts
@@ -343,18 +4007,25 @@ def login():
             correct_captcha = session.get('captcha', '')
             
             if user_captcha != correct_captcha:
+                metrics.inc('login_attempts_total', result='captcha')
+                login_limiter.record_failure(remote_addr, username)
                 flash('Неверный код!', 'error')
                 session['captcha'] = captcha_generator.generate_captcha()
                 return redirect(url_for('login'))
                 
-        username = request.form['username']
         password = request.form['password']
 
         user = User.query.filter_by(username=username).first()
         if user and user.check_password(password):
+            metrics.inc('login_attempts_total', result='success')
+            login_limiter.record_success(remote_addr, username)
             session['username'] = user.username
+            audit_logger.record('auth.login')
             session['attempts'] = 0
             return redirect(url_for('index'))
+        metrics.inc('login_attempts_total', result='failure')
+        login_limiter.record_failure(remote_addr, username)
+        audit_logger.record('auth.login_failed', username[:80], username=None)
         flash('Неверные учетные данные. Попробуйте снова.', 'error')
         return redirect(url_for('login'))
     return render_template('login.html', captcha=session['captcha'])
@@ -374,11 +4045,17 @@ def refresh_captcha():
 # Декоратор для капчи (графическое представление)
 @app.route('/captcha.png')
 def captcha():
-    session['captcha'] = captcha_generator.generate_captcha()
-    img_io = captcha_generator.generate_captcha_image()
-    
-    response = make_response(img_io.getvalue())
+    try:
+        text, png = captcha_generator.take()
+    except CaptchaBudgetExceeded:
+        response = make_response('Слишком много запросов капчи, повторите позже.', 429)
+        response.headers.set('Retry-After', '1')
+        return response
+    session['captcha'] = text
+
+    response = make_response(png)
     response.headers.set('Content-Type', 'image/png')
+    response.cache_control.no_store = True
     return response
 
 # Роут для скачивания конфигурационных файлов
@@ -387,31 +4064,32 @@ def captcha():
 @file_validator.validate_file
 def download(file_path, clean_name):
     try:
-        basename = os.path.basename(file_path)
-        
-        name_parts = basename.split('-')
-        extension = basename.split('.')[-1]
-        vpn_type = '-AZ' if name_parts[0] == 'antizapret' else ''
-        
-        if extension == 'ovpn':
-            client_name = '-'.join(name_parts[1:-1])
-            download_name = f"{client_name}{vpn_type}.{extension}"
-        elif extension == 'conf':
-            client_name = '-'.join(name_parts[1:-2])[:12 if vpn_type == '-AZ' else 15]
-            download_name = f"{client_name}{vpn_type}.{extension}"
-        else:
-            download_name = basename
-        
         return send_from_directory(
             os.path.dirname(file_path),
             os.path.basename(file_path),
             as_attachment=True,
-            download_name=download_name
+            download_name=get_download_name(file_path)
         )
     except Exception as e:
         print(f"Аларм! ошибка: {str(e)}")
         abort(500)
 
+# Роут для скачивания всех профилей клиента одним архивом
+@app.route('/download-bundle/<client_name>')
+@auth_manager.login_required
+def download_bundle(client_name):
+    if not CLIENT_NAME_RE.match(client_name):
+        abort(400, description="Недопустимое имя клиента")
+    files = profile_bundler.collect(client_name)
+    if not files:
+        abort(404, description="Файлы клиента не найдены")
+
+    with_qr = request.args.get('qr', '').lower() in ('1', 'true', 'yes')
+    response = Response(profile_bundler.stream(files, with_qr), mimetype='application/zip')
+    response.headers.set('Content-Disposition', 'attachment', filename=f'{client_name}.zip')
+    response.cache_control.no_store = True
+    return response
+
 # Роут для формирования QR кода
 @app.route('/generate_qr/<file_type>/<path:filename>')
 @auth_manager.login_required
@@ -421,9 +4099,18 @@ def generate_qr(file_path, clean_name):
         with open(file_path, 'r') as file:
             config_text = file.read()
 
-        img_byte_arr = qr_generator.generate_qr_code(config_text)
-        
-        return send_file(img_byte_arr, mimetype='image/png')
+        etag = qr_generator.get_etag(config_text)
+        if request.if_none_match.contains(etag):
+            response = make_response('', 304)
+        else:
+            img_bytes, etag = qr_generator.get_qr_png(config_text)
+            response = make_response(img_bytes)
+            response.headers.set('Content-Type', 'image/png')
+
+        response.set_etag(etag)
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
     except Exception as e:
         print(f"Аларм! ошибка: {str(e)}")
         abort(500)
@@ -436,67 +4123,365 @@ def edit_files():
         file_type = request.form.get('file_type')
         content = request.form.get('content', '')
 
-        if file_editor.update_file_content(file_type, content):
+        try:
+            saved = file_editor.update_file_content(file_type, content, request.form.get('version') or None)
+        except VersionConflict as e:
+            return jsonify({"success": False, "message": "Файл был изменён другим пользователем. Обновите страницу.",
+                            "version": e.current_version}), 412
+        if saved:
+            version, report = saved
             try:
-                result = subprocess.run(
-                    ['/root/antizapret/doall.sh'],
-                    stdout=subprocess.PIPE,
-                    stderr=subprocess.PIPE,
-                    text=True,
-                    check=True
-                )
-                return jsonify({"success": True, "message": "Файл успешно обновлен и изменения применены.", "output": result.stdout})
-            except subprocess.CalledProcessError as e:
-                return jsonify({"success": False, "message": f"Ошибка выполнения скрипта: {e.stderr}", "output": e.stdout}), 500
+                job_id = doall_scheduler.request(username=session.get('username'))
+                audit_logger.record('hosts.edit', file_type, {'lines': content.count('\n') + 1, 'job_id': job_id,
+                                                               'normalized': report})
+                return jsonify({"success": True, "message": "Файл успешно обновлен" + describe_normalization(report) +
+                                ", применение изменений поставлено в очередь.", "job_id": job_id,
+                                "version": version, "normalized": report}), 202
             except Exception as e:
                 return jsonify({"success": False, "message": f"Ошибка: {str(e)}"}), 500
 
         return jsonify({"success": False, "message": "Неверный тип файла."}), 400
 
-    file_contents = file_editor.get_file_contents()
+    file_contents = file_editor.get_file_contents(EDITOR_INLINE_LIMIT)
     return render_template('edit_files.html', file_contents=file_contents)
 
+def describe_normalization(report):
+    """Краткое описание отчёта нормализации для уведомления"""
+    if not report or report['before'] == report['after']:
+        return ""
+    return f" (записей: {report['before']} → {report['after']})"
+
+# Постраничное чтение и построчное изменение списков хостов
+@app.route('/api/lists/<file_type>', methods=['GET', 'PATCH'])
+@auth_manager.login_required
+def api_lists(file_type):
+    if file_type not in file_editor.files:
+        return jsonify({"success": False, "message": "Неверный тип файла."}), 404
+
+    if request.method == 'GET':
+        offset = max(request.args.get('offset', 0, type=int), 0)
+        limit = min(max(request.args.get('limit', 100, type=int), 1), 1000)
+        page = file_editor.get_page(file_type, offset, limit, request.args.get('q'), request.args.get('prefix'))
+        if request.if_none_match.contains(page['version']):
+            response = make_response('', 304)
+        else:
+            response = jsonify(page)
+        response.set_etag(page['version'])
+        response.cache_control.private = True
+        response.cache_control.no_cache = True
+        return response
+
+    data = request.get_json(silent=True) or {}
+    expected_version = next(iter(request.if_match), None) if request.if_match else data.get('version')
+    if not expected_version:
+        return jsonify({"success": False, "message": "Не указана версия списка (If-Match или version)."}), 428
+    try:
+        result = file_editor.patch(file_type, data.get('add') or [], data.get('remove') or [], expected_version)
+    except VersionConflict as e:
+        response = jsonify({"success": False, "message": "Список был изменён другим пользователем.",
+                            "version": e.current_version})
+        response.set_etag(e.current_version)
+        return response, 412
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Ошибка: {str(e)}"}), 400
+
+    result['success'] = True
+    result['message'] = "Список не изменился."
+    if result['version'] != expected_version:
+        audit_logger.record('hosts.patch', file_type, {'added': result['added'], 'removed': result['removed'],
+                                                        'normalized': result['normalized']})
+        result['message'] = "Список обновлён" + describe_normalization(result['normalized']) + "."
+        if data.get('apply', True):
+            result['job_id'] = doall_scheduler.request(username=session.get('username'))
+            result['message'] = result['message'][:-1] + ", применение изменений поставлено в очередь."
+    response = jsonify(result)
+    response.set_etag(result['version'])
+    return response
+
 # Роут для запуска скрипта doall.sh
 @app.route('/run-doall', methods=['POST'])
 @auth_manager.login_required
 def run_doall():
     try:
-        result = subprocess.run(
-            ['/root/antizapret/doall.sh'],
-            stdout=subprocess.PIPE,
-            stderr=subprocess.PIPE,
-            text=True,
-            check=True
-        )
-        return jsonify({"success": True, "message": "Скрипт успешно выполнен.", "output": result.stdout})
-    except subprocess.CalledProcessError as e:
-        return jsonify({"success": False, "message": f"Ошибка выполнения скрипта: {e.stderr}", "output": e.stdout}), 500
+        # Ручной запуск выполняется даже без изменений в списках (doall.sh обновляет и внешние списки)
+        job_id = doall_scheduler.request(username=session.get('username'), force=True)
+        audit_logger.record('doall.run', details={'job_id': job_id})
+        return jsonify({"success": True, "message": "Запуск скрипта поставлен в очередь.", "job_id": job_id}), 202
     except Exception as e:
         return jsonify({"success": False, "message": f"Ошибка: {str(e)}"}), 500
 
+@app.route('/api/doall/status')
+@auth_manager.login_required
+def doall_status():
+    return jsonify(doall_scheduler.get_status())
+
+# Роуты для получения статуса фоновых задач
+@app.route('/jobs')
+@auth_manager.login_required
+def jobs_list():
+    return jsonify({"jobs": [job.to_dict(with_output=False) for job in job_manager.list_recent()]})
+
+@app.route('/jobs/<job_id>')
+@auth_manager.login_required
+def job_status(job_id):
+    job = job_manager.get(job_id)
+    if job is None:
+        return jsonify({"success": False, "message": "Задача не найдена."}), 404
+    return jsonify(job.to_dict())
+
+def format_sse(data, event=None, event_id=None):
+    message = ''
+    if event_id is not None:
+        message += f'id: {event_id}\n'
+    if event is not None:
+        message += f'event: {event}\n'
+    return message + f'data: {data}\n\n'
+
+@app.route('/jobs/<job_id>/stream')
+@auth_manager.login_required
+def job_stream(job_id):
+    if job_manager.get(job_id) is None:
+        return jsonify({"success": False, "message": "Задача не найдена."}), 404
+
+    last_event_id = request.headers.get('Last-Event-ID', '0')
+    last_seq = int(last_event_id) if last_event_id.isdigit() else 0
+
+    def generate():
+        seq = last_seq
+        output = job_manager.get_live_output(job_id)
+        if output is not None:
+            while True:
+                lines, skipped, finished = output.read_since(seq, timeout=15)
+                if skipped:
+                    yield format_sse(json.dumps({'stream': 'info', 'line': f'... пропущено строк: {skipped}'}))
+                for seq, stream, line in lines:
+                    yield format_sse(json.dumps({'stream': stream, 'line': line}), event_id=seq)
+                if finished:
+                    break
+                if not lines:
+                    yield ': keepalive\n\n'
+        else:
+            # Задача выполняется в другом процессе (или уже завершена): читаем вывод из БД
+            while True:
+                db.session.expire_all()
+                job = job_manager.get(job_id)
+                # В БД хранится только хвост вывода; seq - номер строки stdout от начала задачи
+                offset = job.stdout_offset or 0
+                if seq < offset:
+                    yield format_sse(json.dumps({'stream': 'info', 'line': f'... пропущено строк: {offset - seq}'}))
+                    seq = offset
+                for line in job.stdout.splitlines()[seq - offset:]:
+                    seq += 1
+                    yield format_sse(json.dumps({'stream': 'stdout', 'line': line}), event_id=seq)
+                if job.status in JobManager.FINISHED_STATUSES:
+                    break
+                time.sleep(1)
+
+        db.session.expire_all()
+        yield format_sse(json.dumps(job_manager.get(job_id).to_dict(with_output=False)), event='done')
+
+    response = Response(stream_with_context(generate()), mimetype='text/event-stream')
+    response.headers['Cache-Control'] = 'no-cache'
+    response.headers['X-Accel-Buffering'] = 'no'
+    return response
+
+# JSON-список клиентов для обновления таблиц без загрузки HTML
+@app.route('/api/clients')
+@auth_manager.login_required
+def api_clients():
+    since = request.args.get('since')
+    if since:
+        delta = config_file_handler.get_clients_delta(since)
+        if delta is not None:
+            version, changed, removed = delta
+            response = jsonify({"version": version, "full": False, "changed": changed, "removed": removed})
+            response.cache_control.no_store = True
+            return response
+
+    version, clients = config_file_handler.get_clients()
+    if request.if_none_match.contains(version):
+        response = make_response('', 304)
+    else:
+        response = jsonify({"version": version, "full": True, "clients": clients})
+    response.set_etag(version)
+    response.cache_control.private = True
+    response.cache_control.no_cache = True
+    return response
+
+# Пакетное добавление и удаление клиентов
+@app.route('/api/clients/bulk', methods=['POST'])
+@auth_manager.login_required
+def api_clients_bulk():
+    try:
+        params = parse_bulk_request(request.get_json(silent=True) or {})
+    except ValueError as e:
+        return jsonify({"success": False, "message": f"Ошибка: {str(e)}"}), 400
+    job_id = job_manager.submit('bulk', params, username=session.get('username'))
+    audit_logger.record(f"clients.bulk_{params['action']}", params['protocol'], {
+        'clients': [client['name'] for client in params['clients']], 'job_id': job_id
+    })
+    return jsonify({"success": True, "message": "Задача поставлена в очередь.", "job_id": job_id,
+                    "clients": len(params['clients'])}), 202
+
+# Журнал действий администраторов
+@app.route('/api/audit')
+@auth_manager.login_required
+def api_audit():
+    limit = min(request.args.get('limit', 100, type=int), 500)
+    events = audit_logger.get_recent(limit, request.args.get('action'), request.args.get('before', type=int))
+    return jsonify({"events": [item.to_dict() for item in events]})
+
+# Роут для получения истории трафика клиента
+@app.route('/api/traffic/<client_name>')
+@auth_manager.login_required
+def client_traffic(client_name):
+    period = request.args.get('period', 'hour')
+    if period not in ('hour', 'day', 'month'):
+        return jsonify({"success": False, "message": "Недопустимый период."}), 400
+    return jsonify({"client": client_name, "period": period, "series": traffic_collector.get_series(client_name, period)})
+
+def get_certificate_filters():
+    days = request.args.get('days', CERT_EXPIRING_DAYS, type=int)
+    status = request.args.get('status') or None
+    if days < 0 or days > 3650:
+        raise ValueError("Порог должен быть от 0 до 3650 дней.")
+    if status not in (None, 'valid', 'expiring', 'expired', 'revoked'):
+        raise ValueError("Недопустимый статус.")
+    return days, status
+
+# Полная резервная копия PKI и конфигов WireGuard одним tar.gz-потоком
+@app.route('/backup')
+@auth_manager.login_required
+def backup():
+    # Пока архив собирается, client.sh не изменит PKI и конфиги WireGuard;
+    # медленная загрузка готового архива задачи уже не задерживает
+    with job_manager.lock_manager.acquire(BackupManager.RESOURCES):
+        archive, size = backup_manager.spool()
+
+    def generate():
+        with archive:
+            while True:
+                chunk = archive.read(BackupManager.CHUNK_SIZE)
+                if not chunk:
+                    break
+                yield chunk
+
+    audit_logger.record('clients.backup', details={'mode': 'download'})
+    response = Response(generate(), mimetype='application/gzip')
+    response.content_length = size
+    response.headers['Content-Disposition'] = f"attachment; filename=backup-{time.strftime('%Y%m%d-%H%M%S')}.tar.gz"
+    response.headers['X-Accel-Buffering'] = 'no'
+    response.cache_control.no_store = True
+    return response
+
+# Инкрементальные снимки: список и создание
+@app.route('/api/backups', methods=['GET', 'POST'])
+@auth_manager.login_required
+def api_backups():
+    if request.method == 'POST':
+        job_id = job_manager.submit('backup', {}, username=session.get('username'))
+        audit_logger.record('clients.backup', details={'mode': 'snapshot', 'job_id': job_id})
+        return jsonify({"success": True, "message": "Создание снимка поставлено в очередь.", "job_id": job_id}), 202
+    return jsonify({"snapshots": backup_manager.list_snapshots()})
+
+# Сертификаты OpenVPN и сроки их действия
+@app.route('/certificates')
+@auth_manager.login_required
+def certificates():
+    try:
+        days, status = get_certificate_filters()
+    except ValueError as e:
+        flash(str(e), 'error')
+        days, status = CERT_EXPIRING_DAYS, None
+    items = certificate_inventory.get_certificates(days)
+    summary = certificate_inventory.get_summary(items)
+    if status:
+        items = [item for item in items if item['status'] == status]
+    return render_template('certificates.html', certificates=items, summary=summary, days=days, status=status)
+
+@app.route('/api/certificates')
+@auth_manager.login_required
+def api_certificates():
+    try:
+        days, status = get_certificate_filters()
+    except ValueError as e:
+        return jsonify({"success": False, "message": str(e)}), 400
+    items = certificate_inventory.get_certificates(days)
+    summary = certificate_inventory.get_summary(items)
+    if status:
+        items = [item for item in items if item['status'] == status]
+    return jsonify({"days": days, "summary": summary, "certificates": items})
+
 # Маршрут для страницы мониторинга и обновления данных
 @app.route('/server_monitor', methods=['GET', 'POST'])
 @auth_manager.login_required
 def server_monitor():
     if request.method == 'GET':
-        cpu_usage = server_monitor_proc.get_cpu_usage()
-        memory_usage = server_monitor_proc.get_memory_usage()
+        sample = server_monitor_proc.get_latest()
         uptime = server_monitor_proc.get_uptime()
-        return render_template('server_monitor.html', cpu_usage=cpu_usage, memory_usage=memory_usage, uptime=uptime)
+        return render_template('server_monitor.html', cpu_usage=sample['cpu_usage'], memory_usage=sample['memory_usage'],
+                               uptime=uptime, sample=sample, login_stats=login_limiter.get_stats(),
+                               profiling_remaining=request_profiler.get_remaining())
     elif request.method == 'POST':
         try:
-            cpu_usage = server_monitor_proc.get_cpu_usage()
-            memory_usage = server_monitor_proc.get_memory_usage()
-            uptime = server_monitor_proc.get_uptime()
-            return jsonify({
-                'cpu_usage': cpu_usage,
-                'memory_usage': memory_usage,
-                'uptime': uptime
+            sample = server_monitor_proc.get_latest()
+            data = dict(sample)
+            data.update({
+                'uptime': server_monitor_proc.get_uptime(),
+                'config_index': config_file_handler.get_stats(),
+                'qr_cache': qr_generator.get_stats(),
+                'profile_templates': profile_renderer.get_stats(),
+                'captcha': captcha_generator.get_stats(),
+                'login_limiter': login_limiter.get_stats(),
+                'audit_log': audit_logger.get_stats()
             })
+            since = request.args.get('since', type=float)
+            if since is not None:
+                data['history'] = server_monitor_proc.get_history(since)
+            return jsonify(data)
         except Exception as e:
             app.logger.error(f"Ошибка при обновлении данных мониторинга: {e}")
             return jsonify({'error': 'Ошибка при обновлении данных мониторинга'}), 500
 
+# Метрики в формате Prometheus: для сессии администратора или по METRICS_TOKEN
+@app.route('/metrics')
+def metrics_view():
+    token = request.headers.get('Authorization', '')
+    authorized = 'username' in session or (
+        METRICS_TOKEN and hmac.compare_digest(token.encode(), f'Bearer {METRICS_TOKEN}'.encode()))
+    if not authorized:
+        response = make_response('Unauthorized\n', 401)
+        response.headers.set('WWW-Authenticate', 'Bearer')
+        return response
+    response = make_response(metrics.render())
+    response.headers.set('Content-Type', 'text/plain; version=0.0.4; charset=utf-8')
+    response.cache_control.no_store = True
+    return response
+
+# Профилирование следующих N запросов
+@app.route('/api/profiling', methods=['GET', 'POST'])
+@auth_manager.login_required
+def profiling():
+    if request.method == 'POST':
+        data = request.get_json(silent=True) or {}
+        try:
+            count = int(data.get('requests', 0))
+        except (TypeError, ValueError):
+            count = -1
+        if not 0 <= count <= 1000:
+            return jsonify({"success": False, "message": "Число запросов должно быть от 0 до 1000."}), 400
+        request_profiler.enable(count)
+        audit_logger.record('profiling.enable', details={'requests': count})
+    return jsonify({"success": True, "remaining": request_profiler.get_remaining(),
+                    "profiles": request_profiler.list_profiles()})
+
+@app.route('/api/profiling/<name>')
+@auth_manager.login_required
+def profiling_download(name):
+    if not RequestProfiler.NAME_RE.match(name):
+        abort(400)
+    return send_from_directory(request_profiler.output_dir, name, as_attachment=True)
+
 @app.route('/settings', methods=['GET', 'POST'])
 @auth_manager.login_required
 def settings():
@@ -511,13 +4496,16 @@ def settings():
                         file.write(f'APP_PORT={new_port}\n')
                     else:
                         file.write(line)
-            flash('Порт успешно изменён. Перезапуск службы...', 'success')
+            audit_logger.record('settings.port', new_port)
+            flash('Порт успешно изменён. Перезагрузка службы...', 'success')
 
             try:
                 if platform.system() == "Linux":
-                    subprocess.run(["systemctl", "restart", "admin-antizapret.service"], check=True)
+                    # gunicorn перечитывает конфигурацию по SIGHUP без обрыва запросов;
+                    # службы со старым unit-файлом без ExecReload будут перезапущены
+                    subprocess.run(["systemctl", "reload-or-restart", "admin-antizapret.service"], check=True)
             except subprocess.CalledProcessError as e:
-                flash(f'Ошибка при перезапуске службы: {e}', 'error')
+                flash(f'Ошибка при перезагрузке службы: {e}', 'error')
         
         username = request.form.get('username')
         password = request.form.get('password')
@@ -533,8 +4521,14 @@ def settings():
                         user.set_password(password)
                         db.session.add(user)
                         db.session.commit()
+                        audit_logger.record('user.add', username)
                         flash(f"Пользователь '{username}' успешно добавлен!", 'success')
         
+        if request.form.get('backup') == 'snapshot':
+            job_manager.submit('backup', {}, username=session.get('username'))
+            audit_logger.record('clients.backup', details={'mode': 'snapshot'})
+            flash('Создание снимка поставлено в очередь.', 'success')
+
         delete_username = request.form.get('delete_username')
         if delete_username:
             with app.app_context():
@@ -542,6 +4536,7 @@ def settings():
                 if user:
                     db.session.delete(user)
                     db.session.commit()
+                    audit_logger.record('user.delete', delete_username)
                     flash(f"Пользователь '{delete_username}' успешно удалён!", 'success')
                 else:
                     flash(f"Пользователь '{delete_username}' не найден!", 'error')
@@ -550,7 +4545,8 @@ def settings():
 
     current_port = os.getenv('APP_PORT', '5050')
     users = User.query.all()
-    return render_template('settings.html', port=current_port, users=users)
+    return render_template('settings.html', port=current_port, users=users,
+                           snapshots=backup_manager.list_snapshots()[:10], backup_keep=BACKUP_KEEP)
 
 if __name__ == '__main__':
     use_https = os.getenv('USE_HTTPS', 'false').lower() == 'true'
@@ -0,0 +1,349 @@
+#!/usr/bin/env python3
+"""Воспроизводимые замеры производительности AdminAntizapret.
+
+Строит синтетическое дерево конфигураций (CONFIG_PATHS) на заданное число
+клиентов, подменяет client.sh и doall.sh быстрыми скриптами-заглушками и
+гоняет горячие маршруты через тестовый клиент Flask. Результат - JSON с
+p50/p95/p99 и пиковым RSS, пригодный для сравнения прогонов между собой.
+
+Примеры:
+    python benchmarks/run.py --clients 100,1000 --output bench.json
+    python benchmarks/run.py --clients 10000 --scenarios index,api_clients --concurrency 8
+"""
+import argparse
+import base64
+import json
+import os
+import platform
+import resource
+import secrets
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+REPO_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+FAKE_SCRIPT = """#!/bin/bash
+echo "fake $(basename "$0") $*"
+sleep {delay}
+echo "done"
+"""
+
+def pem_block(kind, size):
+    body = base64.b64encode(os.urandom(size)).decode()
+    lines = [body[i:i + 64] for i in range(0, len(body), 64)]
+    return f"-----BEGIN {kind}-----\n" + '\n'.join(lines) + f"\n-----END {kind}-----\n"
+
+def ovpn_profile(client_name):
+    """Профиль, по размеру и структуре похожий на результат client.sh"""
+    return (f"# {client_name}\nclient\ndev tun\nproto udp\nremote 203.0.113.10 1194\nresolv-retry infinite\n"
+            "nobind\npersist-key\npersist-tun\nremote-cert-tls server\ncipher AES-128-GCM\nverb 3\n"
+            f"<ca>\n{pem_block('CERTIFICATE', 900)}</ca>\n"
+            f"<cert>\n{pem_block('CERTIFICATE', 900)}</cert>\n"
+            f"<key>\n{pem_block('PRIVATE KEY', 1200)}</key>\n")
+
+def wireguard_profile(client_index, amnezia):
+    key = lambda: base64.b64encode(os.urandom(32)).decode()
+    extra = "Jc = 4\nJmin = 40\nJmax = 70\nS1 = 0\nS2 = 0\nH1 = 1\nH2 = 2\nH3 = 3\nH4 = 4\n" if amnezia else ""
+    return (f"[Interface]\nPrivateKey = {key()}\nAddress = 10.29.{client_index // 250 % 250}.{client_index % 250 + 2}/32\n"
+            f"DNS = 10.29.0.1\n{extra}\n[Peer]\nPublicKey = {key()}\nPresharedKey = {key()}\n"
+            "AllowedIPs = 0.0.0.0/0\nEndpoint = 203.0.113.10:51443\nPersistentKeepalive = 15\n")
+
+def build_tree(root, clients, bundle_clients=100):
+    """Дерево /root/antizapret/client в миниатюре; возвращает CONFIG_PATHS для него"""
+    config_paths = {'openvpn': [], 'wg': [], 'amneziawg': []}
+    host = '(203.0.113.10)'
+    for interface in ('antizapret', 'vpn'):
+        openvpn_dir = os.path.join(root, 'openvpn', interface)
+        wireguard_dir = os.path.join(root, 'wireguard', interface)
+        amneziawg_dir = os.path.join(root, 'amneziawg', interface)
+        for directory in (openvpn_dir, wireguard_dir, amneziawg_dir,
+                          openvpn_dir + '-udp', openvpn_dir + '-tcp'):
+            os.makedirs(directory, exist_ok=True)
+        config_paths['openvpn'].append(openvpn_dir)
+        config_paths['wg'].append(wireguard_dir)
+        config_paths['amneziawg'].append(amneziawg_dir)
+
+        for index in range(clients):
+            name = f'client{index:05d}'
+            profile = ovpn_profile(name)
+            with open(os.path.join(openvpn_dir, f'{interface}-{name}-{host}.ovpn'), 'w') as f:
+                f.write(profile)
+            # Варианты udp/tcp нужны только для архивов профилей, не раздуваем дерево
+            if index < bundle_clients:
+                for transport in ('udp', 'tcp'):
+                    with open(os.path.join(f'{openvpn_dir}-{transport}', f'{interface}-{name}-{host}-{transport}.ovpn'), 'w') as f:
+                        f.write(profile)
+            with open(os.path.join(wireguard_dir, f'{interface}-{name}-{host}-wg.conf'), 'w') as f:
+                f.write(wireguard_profile(index, False))
+            with open(os.path.join(amneziawg_dir, f'{interface}-{name}-{host}-am.conf'), 'w') as f:
+                f.write(wireguard_profile(index, True))
+    return config_paths
+
+def write_fake_script(path, delay):
+    with open(path, 'w') as f:
+        f.write(FAKE_SCRIPT.format(delay=delay))
+    os.chmod(path, 0o755)
+
+def percentile(sorted_values, fraction):
+    if not sorted_values:
+        return None
+    index = min(len(sorted_values) - 1, max(0, round(fraction * (len(sorted_values) - 1))))
+    return sorted_values[index]
+
+def summarize(latencies, errors, wall_time):
+    values = sorted(latencies)
+    return {
+        'count': len(values),
+        'errors': errors,
+        'mean_ms': statistics.fmean(values) * 1000 if values else None,
+        'min_ms': values[0] * 1000 if values else None,
+        'p50_ms': percentile(values, 0.50) * 1000 if values else None,
+        'p95_ms': percentile(values, 0.95) * 1000 if values else None,
+        'p99_ms': percentile(values, 0.99) * 1000 if values else None,
+        'max_ms': values[-1] * 1000 if values else None,
+        'throughput_rps': len(values) / wall_time if wall_time > 0 else None,
+        'peak_rss_mb': resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024
+    }
+
+class Bench:
+    def __init__(self, A, clients, args):
+        self.A = A
+        self.clients = clients
+        self.args = args
+        self.sample_client = f'client{min(clients - 1, 42):05d}'
+
+    def make_client(self):
+        client = self.A.app.test_client()
+        with client.session_transaction() as session:
+            session['username'] = 'bench'
+        return client
+
+    def wait_job(self, job_id):
+        A = self.A
+        while True:
+            with A.app.app_context():
+                job = A.job_manager.get(job_id)
+                if job.status in A.JobManager.FINISHED_STATUSES:
+                    return job.status == 'succeeded'
+            time.sleep(0.005)
+
+    def http(self, path, expected=200, method='get', **kwargs):
+        def run(client):
+            response = getattr(client, method)(path, **kwargs)
+            response.get_data()
+            response.close()
+            return response.status_code == expected
+        return run
+
+    def scenarios(self):
+        A = self.A
+        name = self.sample_client
+        ovpn = f'antizapret-{name}-(203.0.113.10).ovpn'
+        wg = f'vpn-{name}-(203.0.113.10)-wg.conf'
+        qr_text = wireguard_profile(1, False)
+        captcha_text = A.captcha_generator.generate_captcha()
+
+        def config_index_cold(client):
+            A.config_file_handler.invalidate()
+            A.config_file_handler.get_clients()
+            return True
+
+        def file_validator_cold(client):
+            A.file_validator.invalidate()
+            return A.file_validator.resolve('openvpn', ovpn) is not None
+
+        def qr_render(client):
+            return bool(A.qr_generator._render_png(qr_text))
+
+        def captcha_render(client):
+            return bool(A.captcha_generator.render(captcha_text))
+
+        def client_job(client):
+            response = client.post('/', data={'option': '4', 'client-name': 'benchclient'})
+            return response.status_code == 202 and self.wait_job(response.get_json()['job_id'])
+
+        def doall_job(client):
+            with A.app.app_context():
+                job_id = A.doall_scheduler.request(force=True)
+            return self.wait_job(job_id)
+
+        return {
+            # Маршруты
+            'index': self.http('/'),
+            'index_search': self.http('/?q=client001'),
+            'clients_table': self.http('/clients-table?page=2'),
+            'api_clients': self.http('/api/clients'),
+            'download': self.http(f'/download/openvpn/{ovpn}'),
+            'generate_qr': self.http(f'/generate_qr/wg/{wg}'),
+            'captcha': self.http('/captcha.png'),
+            'download_bundle': self.http(f'/download-bundle/{name}?qr=1'),
+            # Компоненты без кэшей
+            'config_index_cold': config_index_cold,
+            'file_validator_cold': file_validator_cold,
+            'qr_render': qr_render,
+            'captcha_render': captcha_render,
+            # Фоновые задачи со скриптами-заглушками
+            'client_job': client_job,
+            'doall_job': doall_job
+        }
+
+    def run(self, scenario, func):
+        iterations = self.args.iterations if not scenario.endswith('_job') else self.args.job_iterations
+        concurrency = max(1, self.args.concurrency)
+        # Прогрев: кэши и ленивые потоки не должны попадать в замер
+        warm_client = self.make_client()
+        for _ in range(min(self.args.warmup, iterations)):
+            func(warm_client)
+
+        latencies, errors = [], 0
+        lock = threading.Lock()
+
+        def worker(count):
+            nonlocal errors
+            client = self.make_client()
+            local, failed = [], 0
+            for _ in range(count):
+                started = time.perf_counter()
+                try:
+                    ok = func(client)
+                except Exception as e:
+                    print(f"{scenario}: {e}", file=sys.stderr)
+                    ok = False
+                local.append(time.perf_counter() - started)
+                failed += not ok
+            with lock:
+                latencies.extend(local)
+                errors += failed
+
+        counts = [iterations // concurrency + (1 if i < iterations % concurrency else 0) for i in range(concurrency)]
+        started = time.perf_counter()
+        with ThreadPoolExecutor(max_workers=concurrency) as executor:
+            list(executor.map(worker, counts))
+        result = summarize(latencies, errors, time.perf_counter() - started)
+        result.update({'scenario': scenario, 'clients': self.clients, 'concurrency': concurrency})
+        return result
+
+def git_revision():
+    try:
+        return subprocess.run(['git', 'rev-parse', '--short', 'HEAD'], cwd=REPO_DIR, capture_output=True,
+                              text=True, check=True).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+def run_for_size(clients, args, workdir):
+    """Отдельный процесс на каждый размер дерева: иначе пиковый RSS и кэши смешиваются"""
+    command = [sys.executable, os.path.abspath(__file__), '--clients', str(clients), '--single',
+               '--iterations', str(args.iterations), '--job-iterations', str(args.job_iterations),
+               '--warmup', str(args.warmup), '--concurrency', str(args.concurrency),
+               '--script-delay', str(args.script_delay)]
+    if workdir:
+        command += ['--workdir', workdir]
+    if args.scenarios:
+        command += ['--scenarios', args.scenarios]
+    output = subprocess.run(command, capture_output=True, text=True)
+    if output.returncode != 0:
+        raise RuntimeError(f"Замер на {clients} клиентах завершился с ошибкой:\n{output.stderr}")
+    return json.loads(output.stdout)
+
+def run_single(args):
+    workdir = tempfile.mkdtemp(prefix='bench-', dir=args.workdir)
+    try:
+        os.environ.setdefault('SECRET_KEY', secrets.token_hex(16))
+        os.environ['DATABASE_URL'] = f"sqlite:///{os.path.join(workdir, 'bench.db')}"
+        # Замеры капчи не должны упираться в бюджет отрисовок
+        os.environ.setdefault('CAPTCHA_RENDERS_PER_SECOND', '1000000')
+        os.chdir(REPO_DIR)
+        sys.path.insert(0, REPO_DIR)
+
+        started = time.perf_counter()
+        config_paths = build_tree(os.path.join(workdir, 'client'), args.clients)
+        build_time = time.perf_counter() - started
+
+        import app as A
+        for file_type, paths in config_paths.items():
+            A.CONFIG_PATHS[file_type][:] = paths
+        A.config_file_handler.invalidate()
+        A.file_validator.invalidate()
+        A.profile_bundler.client_dir = os.path.join(workdir, 'client')
+
+        client_script = os.path.join(workdir, 'client.sh')
+        doall_script = os.path.join(workdir, 'doall.sh')
+        write_fake_script(client_script, args.script_delay)
+        write_fake_script(doall_script, args.script_delay)
+        A.CLIENT_SCRIPT = client_script
+        A.DOALL_SCRIPT = doall_script
+        # Замеряется путь через скрипты, а не нативные менеджеры
+        A.script_executor.wireguard_manager = None
+        A.script_executor.openvpn_manager = None
+        A.script_executor.recreator = None
+        for file_type in A.file_editor.files:
+            A.file_editor.files[file_type] = os.path.join(workdir, f'{file_type}.txt')
+        A.doall_scheduler.debounce = 0
+        A.doall_scheduler.state_path = os.path.join(workdir, 'doall_state.json')
+        A.app.config['WTF_CSRF_ENABLED'] = False
+        with A.app.app_context():
+            A.db.create_all()
+            A.upgrade_schema()
+
+        bench = Bench(A, args.clients, args)
+        scenarios = bench.scenarios()
+        selected = args.scenarios.split(',') if args.scenarios else list(scenarios)
+        unknown = [name for name in selected if name not in scenarios]
+        if unknown:
+            raise SystemExit(f"Неизвестные сценарии: {', '.join(unknown)}")
+
+        results = []
+        for name in selected:
+            print(f"{args.clients} клиентов: {name}", file=sys.stderr)
+            results.append(bench.run(name, scenarios[name]))
+        return {'clients': args.clients, 'tree_build_seconds': build_time, 'results': results}
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Замеры производительности AdminAntizapret')
+    parser.add_argument('--clients', default='100,1000', help='Число клиентов, через запятую (по умолчанию 100,1000)')
+    parser.add_argument('--scenarios', help='Сценарии через запятую (по умолчанию все)')
+    parser.add_argument('--iterations', type=int, default=200, help='Повторов на сценарий')
+    parser.add_argument('--job-iterations', type=int, default=10, help='Повторов для сценариев с фоновыми задачами')
+    parser.add_argument('--warmup', type=int, default=5, help='Прогревочных повторов')
+    parser.add_argument('--concurrency', type=int, default=1, help='Параллельных клиентов (режим нагрузки)')
+    parser.add_argument('--script-delay', type=float, default=0.05, help='Задержка заглушек client.sh/doall.sh, с')
+    parser.add_argument('--workdir', help='Каталог для временных деревьев (по умолчанию системный tmp)')
+    parser.add_argument('--output', metavar='PATH', help='Куда записать JSON (по умолчанию stdout)')
+    parser.add_argument('--single', action='store_true', help=argparse.SUPPRESS)
+
+    args = parser.parse_args()
+
+    if args.single:
+        args.clients = int(args.clients)
+        # stdout занят JSON-результатом, остальной вывод приложения уходит в stderr
+        result_stream, sys.stdout = sys.stdout, sys.stderr
+        result_stream.write(json.dumps(run_single(args)))
+        sys.exit(0)
+
+    report = {
+        'meta': {
+            'timestamp': time.time(),
+            'revision': git_revision(),
+            'python': platform.python_version(),
+            'platform': platform.platform(),
+            'cpu_count': os.cpu_count(),
+            'iterations': args.iterations,
+            'concurrency': args.concurrency,
+            'script_delay': args.script_delay
+        },
+        'runs': [run_for_size(int(clients), args, args.workdir) for clients in args.clients.split(',')]
+    }
+    output = json.dumps(report, ensure_ascii=False, indent=2)
+    if args.output:
+        with open(args.output, 'w', encoding='utf-8') as f:
+            f.write(output + '\n')
+    else:
+        print(output)
@@ -0,0 +1,53 @@
+# Конфигурация gunicorn для AdminAntizapret
+#
+# Запуск: gunicorn --config gunicorn.conf.py
+# Файл перечитывается при SIGHUP (systemctl reload admin-antizapret), поэтому
+# смена порта или сертификатов в .env применяется без обрыва текущих запросов.
+import os
+import multiprocessing
+from dotenv import dotenv_values
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+
+# .env читается заново при каждой перезагрузке конфигурации, а не только при старте
+env = dict(os.environ)
+env.update({key: value for key, value in dotenv_values(os.path.join(BASE_DIR, '.env')).items() if value is not None})
+os.environ.update(env)
+
+wsgi_app = 'wsgi:app'
+chdir = BASE_DIR
+bind = [f"0.0.0.0:{env.get('APP_PORT', '5050')}"]
+
+worker_class = 'gthread'
+workers = int(env.get('GUNICORN_WORKERS', str(min(2, multiprocessing.cpu_count()))))
+# SSE-потоки вывода задач занимают поток на всё время работы задачи
+threads = int(env.get('GUNICORN_THREADS', '16'))
+preload_app = env.get('GUNICORN_PRELOAD', 'true').lower() == 'true'
+# Воркер при остановке дожидается текущих запросов и запущенных задач client.sh/doall.sh
+graceful_timeout = int(env.get('GUNICORN_GRACEFUL_TIMEOUT', '120'))
+timeout = 60
+keepalive = 5
+
+accesslog = env.get('GUNICORN_ACCESS_LOG') or None
+errorlog = '-'
+loglevel = env.get('GUNICORN_LOG_LEVEL', 'info')
+
+if env.get('USE_HTTPS', 'false').lower() == 'true':
+    cert_file = env.get('SSL_CERT')
+    key_file = env.get('SSL_KEY')
+    if cert_file and key_file and os.path.exists(cert_file) and os.path.exists(key_file):
+        certfile = cert_file
+        keyfile = key_file
+    else:
+        print("Предупреждение: HTTPS включен, но сертификаты не найдены. Используется HTTP.")
+
+def post_fork(server, worker):
+    # Соединения SQLite, открытые в мастере при preload, не должны использоваться воркерами
+    from app import app, db
+    with app.app_context():
+        db.engine.dispose(close=False)
+
+def worker_exit(server, worker):
+    from app import job_manager, audit_logger
+    job_manager.shutdown()
+    audit_logger.flush()
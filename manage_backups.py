@@ -0,0 +1,76 @@
+#!/usr/bin/env python3
+import sys
+import io
+
+# Принудительно устанавливаем UTF-8 для вывода
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+from app import app, job_manager, backup_manager, BackupManager
+import argparse
+import tarfile
+import time
+
+def on_line(stream, line):
+    print(line, file=sys.stderr if stream == 'stderr' else sys.stdout)
+
+def list_snapshots():
+    snapshots = backup_manager.list_snapshots()
+    if not snapshots:
+        print("Снимков нет")
+    for item in snapshots:
+        created = time.strftime('%d.%m.%Y %H:%M:%S', time.localtime(item['created_at']))
+        print(f"{item['id']}  {created}  файлов: {item['files_count']}, {item['size']} Б, "
+              f"новых: {item['added']} ({item['added_size']} Б)")
+    return True
+
+def verify_snapshots(snapshot_ids):
+    ok = True
+    for snapshot_id in snapshot_ids or [item['id'] for item in backup_manager.list_snapshots()]:
+        problems = backup_manager.verify_snapshot(backup_manager.load_snapshot(snapshot_id))
+        print(f"{'OK ' if not problems else 'ERR'} {snapshot_id}")
+        for problem in problems:
+            print(f"    {problem}")
+        ok = ok and not problems
+    return ok
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Резервные копии PKI и конфигураций WireGuard AdminAntizapret')
+    subparsers = parser.add_subparsers(dest='command', required=True)
+    subparsers.add_parser('snapshot', help='Создать инкрементальный снимок')
+    subparsers.add_parser('list', help='Список снимков')
+    verify_parser = subparsers.add_parser('verify', help='Проверить контрольные суммы снимков (по умолчанию всех)')
+    verify_parser.add_argument('ids', nargs='*', metavar='ID', help='Идентификаторы снимков')
+    restore_parser = subparsers.add_parser('restore', help='Восстановить файлы из снимка или архива')
+    source = restore_parser.add_mutually_exclusive_group(required=True)
+    source.add_argument('id', nargs='?', metavar='ID', help='Идентификатор снимка')
+    source.add_argument('--archive', metavar='PATH', help='Архив tar.gz, скачанный из панели или созданный client.sh')
+    restore_parser.add_argument('--target', metavar='DIR',
+                                help='Распаковать в каталог вместо исходных путей (easyrsa3/, wireguard/)')
+    restore_parser.add_argument('--no-verify', action='store_true',
+                                help='Не требовать MANIFEST.json в архиве (архивы опции 8 client.sh)')
+
+    args = parser.parse_args()
+
+    try:
+        if args.command == 'list':
+            sys.exit(0 if list_snapshots() else 1)
+        if args.command == 'verify':
+            sys.exit(0 if verify_snapshots(args.ids) else 1)
+
+        with app.app_context():
+            # Те же блокировки, что и у задач веб-интерфейса
+            with job_manager.lock_manager.acquire(BackupManager.RESOURCES):
+                if args.command == 'snapshot':
+                    manifest = backup_manager.create_snapshot(on_line)
+                    print(f"Снимок {manifest['id']}: файлов {manifest['files_count']}, "
+                          f"новых {manifest['added']} ({manifest['added_size']} Б)")
+                elif args.archive:
+                    count = backup_manager.restore_archive(args.archive, args.target, not args.no_verify, on_line)
+                    print(f"\nВосстановлено файлов: {count}")
+                else:
+                    count = backup_manager.restore_snapshot(args.id, args.target, on_line)
+                    print(f"\nВосстановлено файлов: {count}")
+    except (ValueError, OSError, tarfile.TarError) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        sys.exit(2)
@@ -0,0 +1,68 @@
+#!/usr/bin/env python3
+import sys
+import io
+
+# Принудительно устанавливаем UTF-8 для вывода
+sys.stdout = io.TextIOWrapper(sys.stdout.buffer, encoding='utf-8')
+sys.stderr = io.TextIOWrapper(sys.stderr.buffer, encoding='utf-8')
+
+from app import app, job_manager, parse_bulk_request, run_bulk_clients, BULK_PROTOCOLS
+import argparse
+import json
+
+def read_clients(args):
+    """Клиенты из аргументов и файла: по одному на строку, `имя[,срок]`"""
+    clients = [{'name': name, 'cert_expire': args.cert_expire} for name in args.names]
+    if args.file:
+        with (sys.stdin if args.file == '-' else open(args.file, 'r', encoding='utf-8')) as file:
+            for line in file:
+                line = line.strip()
+                if not line or line.startswith('#'):
+                    continue
+                name, _, cert_expire = line.partition(',')
+                clients.append({'name': name.strip(), 'cert_expire': cert_expire.strip() or args.cert_expire})
+    return clients
+
+def print_report(report):
+    failed = 0
+    for name, results in report.items():
+        ok = all(item['success'] for item in results.values())
+        failed += not ok
+        print(f"{'OK ' if ok else 'ERR'} {name}")
+        for protocol, item in results.items():
+            if not item['success']:
+                print(f"    {protocol}: {item['message']}")
+    print(f"\nОбработано клиентов: {len(report)}, с ошибками: {failed}")
+    return failed == 0
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description='Пакетное управление клиентами AdminAntizapret')
+    parser.add_argument('action', choices=('add', 'delete'), help='Добавить или удалить клиентов')
+    parser.add_argument('names', nargs='*', metavar='NAME', help='Имена клиентов')
+    parser.add_argument('--file', metavar='PATH', help='Файл со списком клиентов (`имя[,срок]` в строке, - для stdin)')
+    parser.add_argument('--protocol', choices=tuple(BULK_PROTOCOLS), default='all', help='Протокол (по умолчанию all)')
+    parser.add_argument('--cert-expire', metavar='DAYS', default='', help='Срок действия сертификатов OpenVPN в днях')
+    parser.add_argument('--json', action='store_true', help='Вывести отчёт в формате JSON')
+    parser.add_argument('--verbose', action='store_true', help='Показывать вывод скриптов')
+
+    args = parser.parse_args()
+
+    try:
+        params = parse_bulk_request({'action': args.action, 'protocol': args.protocol, 'clients': read_clients(args)})
+    except (ValueError, OSError) as e:
+        print(f"Ошибка: {e}", file=sys.stderr)
+        sys.exit(2)
+
+    def on_line(stream, line):
+        if args.verbose:
+            print(line, file=sys.stderr if stream == 'stderr' else sys.stdout)
+
+    with app.app_context():
+        # Те же блокировки, что и у задач веб-интерфейса
+        with job_manager.lock_manager.acquire(BULK_PROTOCOLS[params['protocol']]):
+            _, _, report = run_bulk_clients(params, on_line)
+
+    if args.json:
+        print(json.dumps(report, ensure_ascii=False, indent=2))
+        sys.exit(0 if all(all(item['success'] for item in results.values()) for results in report.values()) else 1)
+    sys.exit(0 if print_report(report) else 1)
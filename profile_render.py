@@ -0,0 +1,149 @@
+# Рендер профилей клиентов по шаблонам, совместимый с render() из client.sh.
+#
+# Модуль не зависит от приложения: его импортируют процессы пула ProfileRecreator
+# (контекст forkserver), которым не нужны Flask, БД и фоновые потоки воркера.
+import os
+import re
+import stat
+import tempfile
+import threading
+
+TEMPLATE_VARIABLE_RE = re.compile(r'\$\{([a-zA-Z_][a-zA-Z_0-9]*)\}')
+
+def render_template_text(template_text, variables):
+    """Подставляет ${VAR} так же, как функция render() в client.sh.
+
+    Как и `while read -r line`, последняя строка без перевода строки отбрасывается,
+    а неизвестные переменные берутся из окружения или заменяются пустой строкой.
+    """
+    lines = template_text.split('\n')[:-1]
+    rendered = []
+    for line in lines:
+        for _ in range(100):
+            match = TEMPLATE_VARIABLE_RE.search(line)
+            if match is None:
+                break
+            name = match.group(1)
+            value = variables.get(name, os.environ.get(name, ''))
+            line = line.replace(match.group(0), value.rstrip('\n'))
+        rendered.append(line + '\n')
+    return ''.join(rendered)
+
+class ProfileRenderer:
+    """Рендерер шаблонов профилей, совместимый с render() из client.sh.
+
+    Шаблон разбирается один раз на строки из литералов и имён переменных и
+    кэшируется до изменения mtime/размера файла, поэтому рендер профиля - это
+    одна склейка строк вместо eval на каждую переменную каждой строки.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._cache = {}
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def compile(template_text):
+        compiled = []
+        # Последняя строка без перевода строки не читается `while read -r line`
+        for line in template_text.split('\n')[:-1]:
+            parts = []
+            position = 0
+            for match in TEMPLATE_VARIABLE_RE.finditer(line):
+                parts.append((line[position:match.start()], match.group(1)))
+                position = match.end()
+            compiled.append((tuple(parts), line[position:] + '\n', line))
+        return compiled
+
+    def get_template(self, path):
+        file_stat = os.stat(path)
+        key = (file_stat.st_mtime_ns, file_stat.st_size)
+        with self._lock:
+            cached = self._cache.get(path)
+            if cached is not None and cached[0] == key:
+                self.hits += 1
+                return cached[1]
+        with open(path, 'r', encoding='utf-8', newline='') as file:
+            compiled = self.compile(file.read())
+        with self._lock:
+            self.misses += 1
+            self._cache[path] = (key, compiled)
+        return compiled
+
+    def render(self, path, variables):
+        compiled = self.get_template(path)
+        values = {}
+        chunks = []
+        for parts, tail, line in compiled:
+            if not parts:
+                chunks.append(tail)
+                continue
+            for _, name in parts:
+                if name not in values:
+                    values[name] = variables.get(name, os.environ.get(name, '')).rstrip('\n')
+            if any('${' in values[name] for _, name in parts):
+                # Значение само содержит ${...}: bash подставит его повторно - повторяем медленный путь
+                chunks.append(render_template_text(line + '\n', variables))
+                continue
+            for literal, name in parts:
+                chunks.append(literal)
+                chunks.append(values[name])
+            chunks.append(tail)
+        return ''.join(chunks)
+
+    def render_to(self, template_path, output_path, variables, mode=None):
+        content = self.render(template_path, variables)
+        # Не переписываем файл, если содержимое не изменилось (сохраняем mtime для кэшей)
+        try:
+            with open(output_path, 'r', encoding='utf-8', newline='') as file:
+                if file.read() == content:
+                    return False
+        except (FileNotFoundError, UnicodeDecodeError):
+            pass
+        atomic_write(output_path, content, mode)
+        return True
+
+    def get_stats(self):
+        with self._lock:
+            return {'templates': len(self._cache), 'hits': self.hits, 'misses': self.misses}
+
+def atomic_write(path, content, mode=None):
+    """Записывает файл через временный файл и rename, чтобы читатели не видели его наполовину"""
+    directory = os.path.dirname(path)
+    fd, tmp_path = tempfile.mkstemp(dir=directory, prefix='.' + os.path.basename(path) + '.')
+    try:
+        with os.fdopen(fd, 'w', encoding='utf-8', newline='') as file:
+            file.write(content)
+        if mode is None:
+            try:
+                mode = stat.S_IMODE(os.stat(path).st_mode)
+            except FileNotFoundError:
+                mode = 0o644
+        os.chmod(tmp_path, mode)
+        os.replace(tmp_path, path)
+    except BaseException:
+        try:
+            os.unlink(tmp_path)
+        except FileNotFoundError:
+            pass
+        raise
+
+# Кэш шаблонов процесса пула
+_renderer = ProfileRenderer()
+
+def render_profile_batch(batch):
+    """Рендерит профили пачки клиентов; выполняется в процессах пула ProfileRecreator.
+
+    batch - список (метка, имя клиента, [(шаблон, профиль)], переменные).
+    Возвращает список (метка, имя клиента, ошибка или None).
+    """
+    results = []
+    for label, client_name, paths, variables in batch:
+        try:
+            for template_path, output_path in paths:
+                atomic_write(output_path, _renderer.render(template_path, variables))
+            results.append((label, client_name, None))
+        except OSError as e:
+            results.append((label, client_name, str(e)))
+    return results
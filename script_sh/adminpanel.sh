@@ -126,6 +126,30 @@ install_antizapret() {
     exit 1
 }
 
+# Создание unit-файла systemd (gunicorn, перезагрузка конфигурации по SIGHUP)
+create_service_unit() {
+    cat > "/etc/systemd/system/$SERVICE_NAME.service" <<EOL
+[Unit]
+Description=AdminAntizapret VPN Management
+After=network.target
+
+[Service]
+User=root
+Group=root
+WorkingDirectory=$INSTALL_DIR
+EnvironmentFile=$INSTALL_DIR/.env
+ExecStart=$VENV_PATH/bin/gunicorn --config $INSTALL_DIR/gunicorn.conf.py
+ExecReload=/bin/kill -HUP \$MAINPID
+KillMode=mixed
+TimeoutStopSec=150
+Restart=always
+Environment="PYTHONUNBUFFERED=1"
+
+[Install]
+WantedBy=multi-user.target
+EOL
+}
+
 # Автоматическое обновление
 auto_update() {
     log "Проверка обновлений"
@@ -138,6 +162,8 @@ auto_update() {
         echo "${GREEN}Найдены обновления. Установка...${NC}"
         git pull origin main
         "$VENV_PATH/bin/pip" install -q -r requirements.txt
+        create_service_unit
+        systemctl daemon-reload
         systemctl restart $SERVICE_NAME
         echo "${GREEN}Обновление завершено!${NC}"
     else
@@ -257,23 +283,7 @@ check_antizapret_installed() {
 
     # Создание systemd сервиса
     echo "${YELLOW}Создание systemd сервиса...${NC}"
-    cat > "/etc/systemd/system/$SERVICE_NAME.service" <<EOL
-[Unit]
-Description=AdminAntizapret VPN Management
-After=network.target
-
-[Service]
-User=root
-Group=root
-WorkingDirectory=$INSTALL_DIR
-EnvironmentFile=$INSTALL_DIR/.env
-ExecStart=$VENV_PATH/bin/python $INSTALL_DIR/app.py
-Restart=always
-Environment="PYTHONUNBUFFERED=1"
-
-[Install]
-WantedBy=multi-user.target
-EOL
+    create_service_unit
 
     # Включение и запуск сервиса
     systemctl daemon-reload
@@ -42,12 +42,8 @@ document.addEventListener('DOMContentLoaded', function () {
      const captchaImg = document.querySelector('#captcha-img');
      if (refreshButton && captchaImg) {
         refreshButton.addEventListener('click', function() {
-            captchaImg.src = '/captcha.png?' + new Date().getTime();  
-            // Делаем запрос на сервер для генерации новой капчи
-            fetch('/refresh_captcha')
-                .catch(error => {
-                    console.error('Ошибка обновления капчи:', error);
-                });
+            // /captcha.png сам сохраняет в сессии текст выданной картинки
+            captchaImg.src = '/captcha.png?' + new Date().getTime();
         });
     }
     
@@ -24,12 +24,12 @@ document.addEventListener('DOMContentLoaded', function() {
     // Функция для отображения/скрытия индикатора загрузки
     function toggleLoadingIndicator(show) {
         loadingIndicator.style.display = show ? 'block' : 'none';
+        if (show) setLoadingText('Выполняется запрос...');
     }
 
-    // Функция для извлечения имени клиента из имени файла
-    function extractClientName(filename) {
-        const parts = filename.split('-');
-        return parts.slice(1, -2).join('-'); // Извлекаем имя клиента между первым и предпоследними частями
+    // Показываем в индикаторе последнюю строку вывода скрипта
+    function setLoadingText(text) {
+        loadingIndicator.querySelector('.loading-indicator-text').textContent = text;
     }
 
     // Функция для обновления видимости элементов формы
@@ -52,36 +52,30 @@ document.addEventListener('DOMContentLoaded', function() {
     }
 
     // Функция для заполнения выпадающего списка клиентами
+    // (в таблицах только текущая страница, поэтому список берётся из /api/clients)
     function populateClientSelect(option) {
         clientSelect.innerHTML = '<option value="">-- Выберите клиента --</option>';
-        const uniqueClientNames = new Set();
-
-        // Определяем, какую таблицу использовать в зависимости от выбранной опции
-        let tableIndex = option === '2' ? 0 : option === '5' ? 1 : 2;
-        const table = document.querySelectorAll('.file-list .column')[tableIndex]?.querySelector('table');
-
-        if (table) {
-            const rows = table.querySelectorAll('tbody tr:nth-child(odd)'); // Берем только строки с именами клиентов
-            rows.forEach(row => {
-                const clientNameCell = row.querySelector('td:first-child');
-                if (clientNameCell) {
-                    const clientName = clientNameCell.textContent.trim();
-                    if (clientName) {
-                        uniqueClientNames.add(clientName);
-                    }
-                }
-            });
-        }
-
-        // Добавляем клиентов в выпадающий список
-        uniqueClientNames.forEach(clientName => {
-            const optionElement = document.createElement('option');
-            optionElement.value = clientName;
-            optionElement.textContent = clientName;
-            clientSelect.appendChild(optionElement);
-        });
+        const fileType = option === '2' ? 'openvpn' : option === '5' ? 'amneziawg' : 'wg';
+
+        fetch('/api/clients')
+            .then(response => response.json())
+            .then(data => {
+                Object.keys(data.clients)
+                    .filter(clientName => data.clients[clientName][fileType])
+                    .sort((a, b) => a.toLowerCase().localeCompare(b.toLowerCase()))
+                    .forEach(clientName => {
+                        const optionElement = document.createElement('option');
+                        optionElement.value = clientName;
+                        optionElement.textContent = clientName;
+                        clientSelect.appendChild(optionElement);
+                    });
+            })
+            .catch(error => console.error('Ошибка загрузки списка клиентов:', error));
+    }
 
-        // Автозаполнение поля имени клиента при выборе из списка
+    // Автозаполнение поля имени клиента при выборе из списка
+    // (скрипт подключается и на странице мониторинга, где формы нет)
+    if (clientSelect) {
         clientSelect.addEventListener('change', function() {
             clientNameInput.value = clientSelect.value;
         });
@@ -97,93 +91,109 @@ document.addEventListener('DOMContentLoaded', function() {
         }, 3000);
     }
 
-    // Функция для обновления таблиц конфигураций
-    function updateConfigTables() {
-        fetch('/')
+    // Функция ожидания завершения фоновой задачи (живой вывод через SSE, иначе опрос статуса)
+    function waitForJob(jobId, onLine) {
+        return new Promise((resolve, reject) => {
+            const poll = () => {
+                fetch(`/jobs/${jobId}`)
+                    .then(response => {
+                        if (!response.ok) {
+                            throw new Error(`HTTP ошибка: ${response.status}`);
+                        }
+                        return response.json();
+                    })
+                    .then(job => {
+                        if (job.finished) {
+                            resolve(job);
+                        } else {
+                            setTimeout(poll, 1000);
+                        }
+                    })
+                    .catch(reject);
+            };
+
+            if (!window.EventSource) {
+                poll();
+                return;
+            }
+
+            const source = new EventSource(`/jobs/${jobId}/stream`);
+            source.onmessage = event => {
+                if (onLine) onLine(JSON.parse(event.data));
+            };
+            source.addEventListener('done', event => {
+                source.close();
+                resolve(JSON.parse(event.data));
+            });
+            source.onerror = () => {
+                source.close();
+                poll();
+            };
+        });
+    }
+
+    // Таблицы клиентов группируются и разбиваются на страницы на сервере,
+    // здесь только подгружается нужная страница (/clients-table)
+    const clientTables = document.getElementById('client-tables');
+    const clientSearch = document.getElementById('client-search');
+    let clientSearchTimer = null;
+
+    function loadClientTables(page) {
+        if (!clientTables) {
+            return Promise.resolve();
+        }
+        const params = new URLSearchParams();
+        const query = clientSearch ? clientSearch.value.trim() : '';
+        if (query) params.set('q', query);
+        if (page && page > 1) params.set('page', page);
+
+        return fetch(`/clients-table?${params}`, { cache: 'no-store' })
             .then(response => {
                 if (!response.ok) {
                     throw new Error(`HTTP ошибка: ${response.status}`);
                 }
-                return response.text(); // Получаем HTML главной страницы
+                return response.text();
             })
             .then(html => {
-                const parser = new DOMParser();
-                const doc = parser.parseFromString(html, 'text/html');
-
-                // Обновляем содержимое таблиц
-                const newTables = doc.querySelectorAll('.file-list .column table');
-                const currentTables = document.querySelectorAll('.file-list .column table');
-
-                newTables.forEach((newTable, index) => {
-                    if (currentTables[index]) {
-                        currentTables[index].innerHTML = newTable.innerHTML;
-                    }
-                });
+                clientTables.innerHTML = html;
+                const search = params.toString();
+                history.replaceState(null, '', search ? `/?${search}` : '/');
             })
             .catch(error => {
                 console.error('Ошибка обновления таблиц конфигураций:', error);
             });
     }
 
-    // Функция для обновления выпадающего списка клиентов
-    function updateClientSelect(option) {
-        clientSelect.innerHTML = '<option value="">-- Выберите клиента --</option>';
-        const uniqueClientNames = new Set();
-
-        // Определяем, какую таблицу использовать в зависимости от выбранной опции
-        let tableIndex = option === '2' ? 0 : option === '5' ? 1 : 2;
-        const table = document.querySelectorAll('.file-list .column')[tableIndex]?.querySelector('table');
-
-        if (table) {
-            const rows = table.querySelectorAll('tbody tr');
-            rows.forEach(row => {
-                const clientNameCell = row.querySelector('td:first-child');
-                if (clientNameCell) {
-                    const clientName = extractClientName(clientNameCell.textContent.trim());
-                    if (clientName && !clientName.toLowerCase().includes('client')) {
-                        uniqueClientNames.add(clientName);
-                    }
-                }
-            });
-        }
+    // Функция для обновления таблиц конфигураций (текущая страница)
+    function updateConfigTables() {
+        const pagination = clientTables ? clientTables.querySelector('.pagination') : null;
+        return loadClientTables(pagination ? Number(pagination.dataset.page) : 1);
+    }
 
-        // Добавляем клиентов в выпадающий список
-        uniqueClientNames.forEach(clientName => {
-            const optionElement = document.createElement('option');
-            optionElement.value = clientName;
-            optionElement.textContent = clientName;
-            clientSelect.appendChild(optionElement);
+    if (clientSearch) {
+        clientSearch.form.addEventListener('submit', event => {
+            event.preventDefault();
+            loadClientTables(1);
+        });
+        clientSearch.addEventListener('input', () => {
+            clearTimeout(clientSearchTimer);
+            clientSearchTimer = setTimeout(() => loadClientTables(1), 300);
+        });
+    }
+
+    if (clientTables) {
+        clientTables.addEventListener('click', event => {
+            const link = event.target.closest('.pagination a');
+            if (link) {
+                event.preventDefault();
+                loadClientTables(Number(link.dataset.page));
+            }
         });
     }
 
     // Функция для обновления таблиц конфигураций и выпадающего списка клиентов
     function refreshData() {
-        fetch('/')
-            .then(response => {
-                if (!response.ok) {
-                    throw new Error(`HTTP ошибка: ${response.status}`);
-                }
-                return response.text(); // Получаем HTML главной страницы
-            })
-            .then(html => {
-                const parser = new DOMParser();
-                const doc = parser.parseFromString(html, 'text/html');
-
-                // Обновляем содержимое таблиц
-                const newTables = doc.querySelectorAll('.file-list .column table');
-                const currentTables = document.querySelectorAll('.file-list .column table');
-
-                newTables.forEach((newTable, index) => {
-                    if (currentTables[index]) {
-                        currentTables[index].innerHTML = newTable.innerHTML;
-                    }
-                });
-                 // Обновляем выпадающий список клиентов
-                const selectedOption = optionSelect.value;
-            })
-            .catch(error => {
-                console.error('Ошибка обновления данных:', error);
-            });
+        updateConfigTables();
     }
 
     // Функция для обновления данных о сервере
@@ -209,9 +219,29 @@ document.addEventListener('DOMContentLoaded', function() {
             const memoryElement = document.getElementById('memory-usage');
             const uptimeElement = document.getElementById('uptime');
     
+            const netElement = document.getElementById('net-usage');
+            const diskElement = document.getElementById('disk-usage');
+            const loadElement = document.getElementById('load-average');
+            const toKb = value => (value / 1024).toFixed(1);
+
             if (cpuElement) cpuElement.textContent = data.cpu_usage + '%';
             if (memoryElement) memoryElement.textContent = data.memory_usage + '%';
             if (uptimeElement) uptimeElement.textContent = data.uptime;
+            if (netElement) netElement.textContent = `${toKb(data.net_recv_rate)} / ${toKb(data.net_sent_rate)} КБ/с`;
+            if (diskElement) diskElement.textContent = `${toKb(data.disk_read_rate)} / ${toKb(data.disk_write_rate)} КБ/с`;
+            if (loadElement) loadElement.textContent = data.load_average.join(' / ');
+
+            if (data.login_limiter) {
+                const loginStats = {
+                    'login-failures': data.login_limiter.failures,
+                    'login-blocked': data.login_limiter.blocked,
+                    'login-rejected': data.login_limiter.rejected
+                };
+                Object.entries(loginStats).forEach(([id, value]) => {
+                    const element = document.getElementById(id);
+                    if (element) element.textContent = value;
+                });
+            }
         })
         .catch(error => console.error('Ошибка при обновлении данных:', error));
     }
@@ -258,15 +288,24 @@ document.addEventListener('DOMContentLoaded', function() {
             return response.json(); // Предполагаем, что сервер возвращает JSON
         })
         .then(data => {
-            // Скрываем индикатор загрузки
-            toggleLoadingIndicator(false);
-
-            if (data.success) {
-                showNotification(data.message, 'success');
-                refreshData(); // Обновляем таблицы и выпадающий список
-            } else {
+            if (!data.success) {
+                toggleLoadingIndicator(false);
                 showNotification(data.message || 'Неизвестная ошибка', 'error');
+                return;
             }
+
+            // Ждём завершения фоновой задачи
+            return waitForJob(data.job_id, event => setLoadingText(event.line)).then(job => {
+                // Скрываем индикатор загрузки
+                toggleLoadingIndicator(false);
+
+                if (job.success) {
+                    showNotification(job.message, 'success');
+                    refreshData(); // Обновляем таблицы и выпадающий список
+                } else {
+                    showNotification(job.message || 'Неизвестная ошибка', 'error');
+                }
+            });
         })
         .catch(error => {
             // Скрываем индикатор загрузки
@@ -0,0 +1,16 @@
+import os
+import sys
+import tempfile
+
+# Окружение задаётся до импорта app: настройки читаются при загрузке модуля
+TMP_DIR = tempfile.mkdtemp(prefix='adminantizapret-test-')
+os.environ.setdefault('SECRET_KEY', 'test')
+os.environ['DATABASE_URL'] = f'sqlite:///{os.path.join(TMP_DIR, "test.db")}'
+
+ROOT_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+FIXTURES_DIR = os.path.join(ROOT_DIR, 'tests', 'fixtures')
+sys.path.insert(0, ROOT_DIR)
+
+def read_fixture(name):
+    with open(os.path.join(FIXTURES_DIR, name), 'r') as file:
+        return file.read()
@@ -0,0 +1,90 @@
+import calendar
+import os
+import shutil
+import tempfile
+import time
+import unittest
+from unittest import mock
+
+from support import FIXTURES_DIR
+from app import CertificateInventory
+
+PKI_DIR = os.path.join(FIXTURES_DIR, 'pki')
+
+def read_pki(name):
+    with open(os.path.join(PKI_DIR, name), 'r', encoding='utf-8') as file:
+        return file.read()
+
+def utc(*parts):
+    return calendar.timegm(parts + (0,) * (6 - len(parts)))
+
+class DerParserTest(unittest.TestCase):
+    def test_v1_certificate_with_utc_time(self):
+        record = CertificateInventory.parse_certificate(read_pki('alice.crt'))
+        self.assertEqual(record, {'serial': '8F3A09C1D2', 'common_name': 'alice',
+                                  'not_before': utc(2026, 10, 1, 12), 'not_after': utc(2027, 10, 1, 12)})
+
+    def test_generalized_time_and_utf8_common_name(self):
+        record = CertificateInventory.parse_certificate(read_pki('bob.crt'))
+        self.assertEqual(int(record['serial'], 16), 0x0A)
+        self.assertEqual(record['common_name'], 'vpn-боб')
+        self.assertEqual(record['not_after'], utc(2056, 1, 1))
+
+    def test_v3_certificate_with_version_field(self):
+        record = CertificateInventory.parse_certificate(read_pki('ca.crt'))
+        self.assertEqual((record['serial'], record['common_name']), ('1', 'AntiZapret CA'))
+        self.assertEqual(record['not_after'] - record['not_before'], 3650 * 86400)
+
+    def test_crl(self):
+        crl = CertificateInventory.parse_crl(read_pki('crl.pem'))
+        self.assertEqual(crl, {'revoked': {'8F3A09C1D2': utc(2026, 10, 18, 12, 32, 3)},
+                               'this_update': utc(2026, 10, 18, 12, 32, 3),
+                               'next_update': utc(2027, 4, 16, 12, 32, 3)})
+
+    def test_invalid_input(self):
+        text = read_pki('alice.crt')
+        with self.assertRaises(ValueError):
+            CertificateInventory.parse_certificate(text.replace('CERTIFICATE', 'PRIVATE KEY'))
+        lines = text.splitlines()
+        with self.assertRaises(ValueError):
+            CertificateInventory.parse_certificate('\n'.join(lines[:3] + lines[-1:]))
+
+class CertificateInventoryTest(unittest.TestCase):
+    def setUp(self):
+        directory = tempfile.mkdtemp(prefix='adminantizapret-pki-')
+        self.addCleanup(shutil.rmtree, directory)
+        self.issued_dir = os.path.join(directory, 'issued')
+        os.mkdir(self.issued_dir)
+        for name in ('alice.crt', 'bob.crt', 'ca.crt'):
+            shutil.copy(os.path.join(PKI_DIR, name), self.issued_dir)
+        self.crl_path = os.path.join(directory, 'crl.pem')
+        shutil.copy(os.path.join(PKI_DIR, 'crl.pem'), self.crl_path)
+        self.cache_path = os.path.join(directory, 'cache', 'certificates.json')
+        patcher = mock.patch.object(time, 'time', lambda: utc(2027, 9, 1))
+        patcher.start()
+        self.addCleanup(patcher.stop)
+
+    def inventory(self):
+        return CertificateInventory(self.issued_dir, self.crl_path, self.cache_path, 30)
+
+    def test_statuses_and_summary(self):
+        inventory = self.inventory()
+        certificates = inventory.get_certificates(days=60)
+        self.assertEqual([(item['name'], item['status']) for item in certificates],
+                         [('alice', 'revoked'), ('ca', 'valid'), ('bob', 'valid')])
+        self.assertEqual(certificates[0]['revoked_at'], utc(2026, 10, 18, 12, 32, 3))
+        summary = inventory.get_summary(certificates)
+        self.assertEqual(summary['counts'], {'valid': 2, 'expiring': 0, 'expired': 0, 'revoked': 1})
+        self.assertEqual(summary['crl']['revoked'], 1)
+
+    def test_only_changed_files_are_parsed(self):
+        self.assertEqual(self.inventory().refresh(), 3)
+        inventory = self.inventory()
+        self.assertEqual(inventory.refresh(), 0)
+        with open(os.path.join(self.issued_dir, 'broken.crt'), 'w') as file:
+            file.write('not a certificate\n')
+        self.assertEqual(inventory.refresh(), 1)
+        self.assertEqual(inventory.get_summary(inventory.get_certificates())['unreadable'], 1)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,65 @@
+import os
+import subprocess
+import time
+import unittest
+
+from support import TMP_DIR
+from app import app, db, Job, JobManager, ResourceLockManager, DoallScheduler, file_editor
+
+class OrphanedDoallJobTest(unittest.TestCase):
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        Job.query.delete()
+        db.session.commit()
+        lock_dir = os.path.join(TMP_DIR, 'locks')
+        self.job_manager = JobManager(1, ResourceLockManager(lock_dir))
+        self.job_manager.register('doall', lambda params, on_line: ('', '', params), lambda params: ('antizapret-config',))
+        self.scheduler = DoallScheduler(self.job_manager, file_editor, os.path.join(TMP_DIR, 'doall_state.json'),
+                                        lock_dir, 0.1)
+
+    def tearDown(self):
+        self.job_manager.shutdown()
+        self.context.pop()
+
+    @staticmethod
+    def dead_pid():
+        process = subprocess.Popen(['true'])
+        process.wait()
+        return process.pid
+
+    def add_queued_job(self, job_id, pid):
+        db.session.add(Job(id=job_id, kind='doall', params='{}', status='queued', pid=pid,
+                           created_at=time.time(), scheduled_at=time.time() + 3600))
+        db.session.commit()
+
+    def wait_finished(self, job_id):
+        for _ in range(50):
+            db.session.expire_all()
+            job = db.session.get(Job, job_id)
+            if job.status in JobManager.FINISHED_STATUSES:
+                return job
+            time.sleep(0.1)
+        self.fail(f'Задача {job_id} не завершилась')
+
+    def test_request_does_not_join_orphaned_job(self):
+        self.add_queued_job('orphaned', self.dead_pid())
+
+        job_id = self.scheduler.request('admin')
+
+        self.assertNotEqual(job_id, 'orphaned')
+        self.assertEqual(db.session.get(Job, 'orphaned').status, 'failed')
+        self.assertEqual(self.wait_finished(job_id).status, 'succeeded')
+
+    def test_request_joins_job_of_live_process(self):
+        self.add_queued_job('pending', os.getpid())
+
+        job_id = self.scheduler.request('admin', force=True)
+
+        self.assertEqual(job_id, 'pending')
+        job = db.session.get(Job, 'pending')
+        self.assertEqual(job.status, 'queued')
+        self.assertIn('"force": true', job.params)
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,57 @@
+import ipaddress
+import random
+import unittest
+
+import support  # noqa: F401 - окружение до импорта app
+from app import ListNormalizer
+
+class NormalizeIpsTest(unittest.TestCase):
+    def setUp(self):
+        self.normalizer = ListNormalizer()
+
+    def test_merge_matches_collapse_addresses(self):
+        generator = random.Random(20261018)
+        for _ in range(50):
+            entries = []
+            for _ in range(generator.randint(1, 200)):
+                prefix = generator.randint(20, 32)
+                address = ipaddress.IPv4Address(generator.randint(0xC0A80000, 0xC0A8FFFF))
+                entries.append(f'{address}/{prefix}' if prefix < 32 else str(address))
+            expected = [network.with_prefixlen if network.prefixlen < 32 else str(network.network_address)
+                        for network in ipaddress.collapse_addresses(
+                            ipaddress.ip_network(entry, strict=False) for entry in entries)]
+            networks, invalid = self.normalizer._collapse(entries)
+            self.assertEqual(networks, expected)
+            self.assertEqual(invalid, [])
+
+    def test_edge_ranges(self):
+        self.assertEqual(self.normalizer._collapse(['0.0.0.0/1', '128.0.0.0/1'])[0], ['0.0.0.0/0'])
+        self.assertEqual(self.normalizer._collapse(['255.255.255.255', '255.255.255.254'])[0],
+                         ['255.255.255.254/31'])
+        self.assertEqual(self.normalizer._collapse(['10.0.0.1', '10.0.0.2', '10.0.0.3'])[0],
+                         ['10.0.0.1', '10.0.0.2/31'])
+
+    def test_host_bits_ipv6_and_invalid(self):
+        networks, invalid = self.normalizer._collapse(['10.1.2.3/24', '2001:db8::1/64', '2001:db8::/64',
+                                                       'not-an-ip', '10.0.0.0/33'])
+        self.assertEqual(networks, ['10.1.2.0/24', '2001:db8::/64'])
+        self.assertEqual(invalid, ['not-an-ip', '10.0.0.0/33'])
+
+    def test_comments_and_blank_lines_stay_in_place(self):
+        content = ('# Провайдер A\n10.0.0.0/25\n10.0.0.128/25\n\n'
+                   '# Провайдер B\n10.0.1.0/24\n10.0.0.5\n\n\n')
+        text, report = self.normalizer.normalize('ips', content)
+        self.assertEqual(text, '# Провайдер A\n10.0.0.0/24\n\n# Провайдер B\n10.0.0.5\n10.0.1.0/24\n')
+        self.assertEqual((report['before'], report['after'], report['merged']), (4, 3, 1))
+
+class NormalizeHostsTest(unittest.TestCase):
+    def test_duplicates_and_covered_subdomains(self):
+        content = ('# Видео\nYouTube.com.\n*.googlevideo.com\nwww.youtube.com\n\n'
+                   'youtube.com\nnotyoutube.com\ncdn.googlevideo.com\n')
+        text, report = ListNormalizer().normalize('hosts', content)
+        self.assertEqual(text, '# Видео\nyoutube.com\ngooglevideo.com\n\nnotyoutube.com\n')
+        self.assertEqual(report, {'before': 6, 'after': 3, 'duplicates': 1, 'covered': 2,
+                                  'merged': 0, 'invalid': 0})
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,68 @@
+import time
+import unittest
+from unittest import mock
+
+import support  # noqa: F401 - окружение до импорта app
+from app import LoginRateLimiter
+
+class LoginRateLimiterTest(unittest.TestCase):
+    def setUp(self):
+        self.now = 1000000.0
+        patcher = mock.patch.object(time, 'time', lambda: self.now)
+        patcher.start()
+        self.addCleanup(patcher.stop)
+        self.limiter = LoginRateLimiter(ip_limit=3, username_limit=2, window=60, max_keys=4,
+                                        base_backoff=30, max_backoff=100)
+
+    def record_failures(self, times, ip='192.0.2.1', username=None):
+        for _ in range(times):
+            self.limiter.record_failure(ip, username)
+
+    def test_blocks_ip_after_limit_within_window(self):
+        self.record_failures(2)
+        self.assertEqual(self.limiter.check('192.0.2.1'), 0)
+        self.record_failures(1)
+        self.assertEqual(self.limiter.check('192.0.2.1'), 31)
+        self.assertEqual(self.limiter.check('192.0.2.2'), 0)
+
+    def test_failures_outside_window_are_forgotten(self):
+        self.record_failures(2)
+        self.now += 61
+        self.record_failures(2)
+        self.assertEqual(self.limiter.check('192.0.2.1'), 0)
+
+    def test_block_expires(self):
+        self.record_failures(3)
+        self.now += 29
+        self.assertEqual(self.limiter.check('192.0.2.1'), 2)
+        self.now += 1
+        self.assertEqual(self.limiter.check('192.0.2.1'), 0)
+
+    def test_backoff_doubles_up_to_maximum(self):
+        retries = []
+        for _ in range(4):
+            self.record_failures(3)
+            retries.append(self.limiter.check('192.0.2.1'))
+            self.now += retries[-1]
+        self.assertEqual(retries, [31, 61, 101, 101])
+
+    def test_username_is_limited_across_ips(self):
+        self.limiter.record_failure('192.0.2.1', 'Admin')
+        self.limiter.record_failure('192.0.2.2', 'admin')
+        self.assertEqual(self.limiter.check('192.0.2.3', 'ADMIN'), 31)
+        self.assertEqual(self.limiter.check('192.0.2.3', 'other'), 0)
+
+    def test_success_resets_keys(self):
+        self.record_failures(2, username='admin')
+        self.limiter.record_success('192.0.2.1', 'admin')
+        self.record_failures(1, username='admin')
+        self.assertEqual(self.limiter.check('192.0.2.1', 'admin'), 0)
+
+    def test_oldest_keys_are_evicted(self):
+        for index in range(6):
+            self.limiter.record_failure(f'192.0.2.{index}')
+        stats = self.limiter.get_stats()
+        self.assertEqual((stats['tracked'], stats['evicted'], stats['failures']), (4, 2, 6))
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,44 @@
+import os
+import tempfile
+import unittest
+
+import support  # noqa: F401 - окружение до импорта app
+from app import ProfileBundler, OpenVPNClientManager, WireGuardPeerManager, get_profile_file_name
+
+class ProfileBundlerCollectTest(unittest.TestCase):
+    def setUp(self):
+        self.directory = tempfile.TemporaryDirectory()
+        self.addCleanup(self.directory.cleanup)
+        self.bundler = ProfileBundler(self.directory.name, OpenVPNClientManager.PROFILE_DIRS,
+                                      WireGuardPeerManager.PROFILE_KINDS, ('antizapret', 'vpn'), None)
+
+    def touch(self, *parts):
+        path = os.path.join(self.directory.name, *parts)
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        open(path, 'w').close()
+
+    def create_profiles(self, client_name):
+        file_name = get_profile_file_name(client_name, '203.0.113.1')
+        self.touch('openvpn', 'antizapret-udp', f'antizapret-{file_name}-udp.ovpn')
+        self.touch('openvpn', 'vpn', f'vpn-{file_name}.ovpn')
+        self.touch('wireguard', 'antizapret', f'antizapret-{file_name}-wg.conf')
+        self.touch('amneziawg', 'vpn', f'vpn-{file_name}-am.conf')
+
+    def test_prefixed_client_name_finds_stripped_file_names(self):
+        self.create_profiles('vpn-foo')
+        self.create_profiles('foobar')
+        files = self.bundler.collect('vpn-foo')
+        self.assertEqual([os.path.basename(path) for path, _, _ in files], [
+            'antizapret-foo-(203.0.113.1)-udp.ovpn',
+            'vpn-foo-(203.0.113.1).ovpn',
+            'antizapret-foo-(203.0.113.1)-wg.conf',
+            'vpn-foo-(203.0.113.1)-am.conf',
+        ])
+        self.assertEqual([qr for _, _, qr in files], [False, False, True, True])
+
+    def test_antizapret_prefix_is_stripped(self):
+        self.create_profiles('antizapret-bar')
+        self.assertEqual(len(self.bundler.collect('antizapret-bar')), 4)
+
+if __name__ == '__main__':
+    unittest.main()
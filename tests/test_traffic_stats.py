@@ -0,0 +1,108 @@
+import unittest
+
+from support import TMP_DIR, read_fixture
+from app import app, db, ClientSession, TrafficSample, TrafficStatsCollector
+
+# Начало часа: минутные и часовые корзины совпадают с моментом первого чтения
+NOW = 1792324800
+
+class TrafficParsersTest(unittest.TestCase):
+    def test_wireguard_readings_use_client_names_from_config(self):
+        readings = TrafficStatsCollector.wireguard_readings('antizapret', read_fixture('wg_dump.txt'),
+                                                            read_fixture('antizapret.conf'))
+        self.assertEqual(readings, [
+            ('wireguard', 'antizapret', 'alice', '203.0.113.5:40001', 'ALICEPUB=', 1792324790, 1000, 5000),
+            ('wireguard', 'antizapret', 'bob', None, 'BOBPUB=', None, 0, 0),
+        ])
+
+    def test_openvpn_status_versions_give_same_sessions(self):
+        expected = {'client': 'carol', 'endpoint': '192.0.2.10:1194', 'rx': 3000, 'tx': 4000}
+        for name in ('openvpn_status_v1.txt', 'openvpn_status_v2.txt', 'openvpn_status_v3.txt'):
+            with self.subTest(name=name):
+                sessions = TrafficStatsCollector.parse_openvpn_status(read_fixture(name))
+                self.assertEqual(len(sessions), 1)
+                self.assertEqual({key: sessions[0][key] for key in expected}, expected)
+        v2 = TrafficStatsCollector.parse_openvpn_status(read_fixture('openvpn_status_v2.txt'))
+        self.assertEqual(v2[0]['connected_since'], '1792321200')
+
+class TrafficCollectTest(unittest.TestCase):
+    def setUp(self):
+        self.context = app.app_context()
+        self.context.push()
+        TrafficSample.query.delete()
+        ClientSession.query.delete()
+        db.session.commit()
+        self.collector = TrafficStatsCollector(60, ['antizapret'], '', TMP_DIR)
+
+    def tearDown(self):
+        db.session.remove()
+        self.context.pop()
+
+    @staticmethod
+    def wg(rx, tx, public_key='ALICEPUB='):
+        return ('wireguard', 'antizapret', 'alice', '203.0.113.5:40001', public_key, NOW, rx, tx)
+
+    @staticmethod
+    def samples(resolution):
+        rows = TrafficSample.query.filter_by(resolution=resolution).order_by(TrafficSample.bucket).all()
+        return [(row.bucket, row.client, row.rx, row.tx) for row in rows]
+
+    def session(self, client='alice'):
+        return ClientSession.query.filter_by(client=client).one()
+
+    def test_first_reading_is_baseline(self):
+        self.collector.collect(readings=[self.wg(1000, 5000)], now=NOW)
+        self.assertEqual(TrafficSample.query.count(), 0)
+        row = self.session()
+        self.assertEqual((row.rx_counter, row.tx_counter, row.rx_total, row.tx_total), (1000, 5000, 0, 0))
+
+    def test_deltas_are_stored_for_every_resolution(self):
+        self.collector.collect(readings=[self.wg(1000, 5000)], now=NOW)
+        self.collector.collect(readings=[self.wg(1600, 5900)], now=NOW + 10)
+        self.assertEqual(self.samples('raw'), [(NOW + 10, 'alice', 600, 900)])
+        self.assertEqual(self.samples('1m'), [(NOW, 'alice', 600, 900)])
+        self.assertEqual(self.samples('1h'), [(NOW, 'alice', 600, 900)])
+        row = self.session()
+        self.assertEqual((row.rx_total, row.tx_total), (600, 900))
+
+    def test_rollups_sum_readings_in_same_bucket(self):
+        self.collector.collect(readings=[self.wg(0, 0)], now=NOW)
+        self.collector.collect(readings=[self.wg(100, 10)], now=NOW + 20)
+        self.collector.collect(readings=[self.wg(300, 30)], now=NOW + 40)
+        self.collector.collect(readings=[self.wg(600, 60)], now=NOW + 70)
+        self.assertEqual(self.samples('raw'), [(NOW + 20, 'alice', 100, 10), (NOW + 40, 'alice', 200, 20),
+                                               (NOW + 70, 'alice', 300, 30)])
+        self.assertEqual(self.samples('1m'), [(NOW, 'alice', 300, 30), (NOW + 60, 'alice', 300, 30)])
+        self.assertEqual(self.samples('1h'), [(NOW, 'alice', 600, 60)])
+
+    def test_counter_reset_counts_new_counters_as_delta(self):
+        self.collector.collect(readings=[self.wg(1000, 5000)], now=NOW)
+        self.collector.collect(readings=[self.wg(2000, 6000)], now=NOW + 1)
+        # Интерфейс перезапущен: счётчики начались заново
+        self.collector.collect(readings=[self.wg(300, 400)], now=NOW + 2)
+        self.assertEqual(self.samples('raw'), [(NOW + 1, 'alice', 1000, 1000), (NOW + 2, 'alice', 300, 400)])
+        row = self.session()
+        self.assertEqual((row.rx_counter, row.rx_total, row.tx_total), (300, 1300, 1400))
+
+    def test_openvpn_reconnect_starts_new_session(self):
+        status = read_fixture('openvpn_status_v2.txt')
+        self.collector.collect(readings=TrafficStatsCollector.openvpn_readings('antizapret-udp', status, NOW),
+                               now=NOW)
+        # Клиент переподключился: счётчики выросли, но сессия новая
+        reconnected = status.replace('1792321200', '1792324801').replace(',3000,4000,', ',3500,4500,')
+        self.collector.collect(readings=TrafficStatsCollector.openvpn_readings('antizapret-udp', reconnected, NOW + 5),
+                               now=NOW + 5)
+        self.assertEqual(self.samples('raw'), [(NOW + 5, 'carol', 3500, 4500)])
+        row = self.session('carol')
+        self.assertEqual((row.protocol, row.interface, row.session_id), ('openvpn', 'antizapret-udp', '1792324801'))
+
+    def test_old_samples_are_pruned(self):
+        self.collector.collect(readings=[self.wg(0, 0)], now=NOW)
+        self.collector.collect(readings=[self.wg(100, 100)], now=NOW + 1)
+        self.collector.collect(readings=[self.wg(200, 200)], now=NOW + 3600 + 60)
+        self.assertEqual([bucket for bucket, *_ in self.samples('raw')], [NOW + 3660])
+        self.assertEqual([bucket for bucket, *_ in self.samples('1m')], [NOW, NOW + 3660])
+        self.assertEqual([bucket for bucket, *_ in self.samples('1h')], [NOW, NOW + 3600])
+
+if __name__ == '__main__':
+    unittest.main()
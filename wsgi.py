@@ -0,0 +1,2 @@
+# Точка входа WSGI: gunicorn --config gunicorn.conf.py (см. wsgi_app в конфиге)
+from app import app